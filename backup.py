@@ -11,6 +11,9 @@ import sys
 from datetime import datetime, timezone
 
 from backup_tracker import BackupTracker
+from history import History, history_report
+from planner import crawl, format_plan, measured_model, plan, suggest, summarize_directories
+from report import report
 from restore_tracker import RestoreTracker
 
 
@@ -27,6 +30,18 @@ def verbosity_to_log_level(verbosity=2):
         return logging.DEBUG
 
 
+def workers_count(value):
+    if value == "auto":
+        return value
+    try:
+        workers = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number or 'auto', not {value!r}")
+    if workers < 1:
+        raise argparse.ArgumentTypeError("there must be at least 1 worker")
+    return workers
+
+
 class UndefinedAction(Exception):
     pass
 
@@ -61,11 +76,41 @@ def command_line():
                         help="Perform a restore",
                         action="store_true",
                         )
+    action.add_argument("--report",
+                        help="Report the slowest sources and the throughput of the finished runs in --logdir",
+                        action="store_true",
+                        )
+    action.add_argument("--history",
+                        help="Show when each PATH was last copied successfully, or the latest runs if no PATH is "
+                             "given, from the history of the finished runs in --logdir",
+                        metavar="PATH",
+                        nargs="*",
+                        default=None,
+                        )
+    parser.add_argument("--plan",
+                        help="With --backup or --restore, crawl the sources without copying anything and estimate "
+                             "the rows, wall time, transactions and cost of each --depth, from the throughput of "
+                             "the finished runs in --logdir, then suggest a --depth and --workers",
+                        action="store_true",
+                        )
+    parser.add_argument("--plan-workers",
+                        help="Worker counts to estimate the wall time for with --plan",
+                        type=int,
+                        nargs="+",
+                        default=[1, 2, 4, 8, 16, 32],
+                        )
     parser.add_argument("--retry",
                         help="Reset the tracker to the beginning and retry anything that didn't "
                              "complete successsfully.",
                         action="store_true",
                         )
+    parser.add_argument("--max-attempts",
+                        help="Times a source is tried in one run. Temporary failures are tried again after a "
+                             "backoff, and cap errors after the pause; failures rclone can't get past, like a "
+                             "missing directory, aren't.",
+                        type=int,
+                        default=3,
+                        )
     parser.add_argument("-t", "--tracker",
                         help="progress tracking file to support resuming after interruption",
                         type=str,
@@ -88,28 +133,230 @@ def command_line():
                         default=os.path.join(os.getcwd(), "logs"),
                         )
     parser.add_argument("-r", "--remote-name",
-                        help="The name given to the B2 destination remote in your rclone config",
+                        help="The name given to the B2 destination remote in your rclone config. "
+                             "Required for --backup and --restore.",
                         type=str,
-                        required=True,
+                        default=None,
                         )
     parser.add_argument("-s", "--sources",
-                        help="absolute path[s] to be backed up",
+                        help="absolute path[s] to be backed up. Required for --backup and --restore.",
                         type=str,
                         nargs="+",
-                        default=[os.getcwd()],
-                        required=True,
+                        default=None,
                         )
     parser.add_argument("-w", "--workers",
-                        help="Number of parallel workers for processing sources",
-                        type=int,
+                        help="Number of parallel workers for processing sources, or 'auto' to adjust it between "
+                             "--min-workers and --max-workers while throughput keeps improving",
+                        type=workers_count,
                         default=4,
                         )
+    parser.add_argument("--min-workers",
+                        help="Fewest parallel workers to use with --workers auto",
+                        type=int,
+                        default=1,
+                        )
+    parser.add_argument("--max-workers",
+                        help="Most parallel workers to use with --workers auto",
+                        type=int,
+                        default=16,
+                        )
     parser.add_argument("-D", "--depth",
                         help="Maximum depth of subfolders to crawl for tracking. 0 means top-level folders only.",
                         type=int,
                         default=None,
                         )
+    parser.add_argument("--non-overlapping",
+                        help="Plan the transfers so each tracked directory copies only its own files "
+                             "(rclone --max-depth 1) instead of re-checking subdirectories that have rows of "
+                             "their own. The deepest tracked directories are still copied recursively.",
+                        action="store_true",
+                        )
+    parser.add_argument("--split-bytes",
+                        help="With --non-overlapping, directories past --depth holding more than this many bytes "
+                             "get rows for their subdirectories too, so one huge directory isn't left running on a "
+                             "single worker. 0 turns this off.",
+                        type=int,
+                        default=64 * 2 ** 30,
+                        )
+    parser.add_argument("--change-index",
+                        help="For backups: where to keep the signature of each directory from the last successful "
+                             "backup, so unchanged directories can be left out. Defaults to change_index.sqlite3 "
+                             "in --logdir.",
+                        type=str,
+                        default=None,
+                        )
+    parser.add_argument("--checksum-cache",
+                        help="For backups: keep the stat and SHA-1 of every file copied, and give rclone only the "
+                             "files that are new or whose contents changed, with --files-from-raw. Files whose "
+                             "stat hasn't changed aren't read again, and touched files aren't copied again. "
+                             "Without PATH, checksum_cache.sqlite3 in --logdir is used.",
+                        metavar="PATH",
+                        nargs="?",
+                        const="",
+                        default=None,
+                        )
+    parser.add_argument("--full",
+                        help="For backups: copy every directory, even those the change index says haven't changed",
+                        action="store_true",
+                        )
+    parser.add_argument("--listing-cache",
+                        help="For restores: where to keep the remote directories that were listed, so restoring "
+                             "the same sources again doesn't list them again. Defaults to listing_cache.sqlite3 "
+                             "in --logdir.",
+                        type=str,
+                        default=None,
+                        )
+    parser.add_argument("--listing-ttl",
+                        help="For restores: seconds a cached listing is used for. Directories added to the remote since the "
+                             "listing may be missed, so keep it short while the remote is changing. Also how long "
+                             "the crawl made by --plan is used for.",
+                        type=int,
+                        default=3600,
+                        )
+    parser.add_argument("--synchronous",
+                        help="SQLite synchronous level for the tracker database. NORMAL is safe with the "
+                             "write-ahead log; FULL also survives power loss without losing the last results.",
+                        choices=["OFF", "NORMAL", "FULL", "EXTRA"],
+                        default="NORMAL",
+                        )
+    parser.add_argument("--commit-batch",
+                        help="Maximum number of results to record in the tracker per commit",
+                        type=int,
+                        default=100,
+                        )
+    parser.add_argument("--commit-interval",
+                        help="Maximum time, in milliseconds, a result waits before it's committed to the tracker",
+                        type=int,
+                        default=500,
+                        )
+    parser.add_argument("--crawl-workers",
+                        help="Number of threads listing directories while the sources are crawled",
+                        type=int,
+                        default=8,
+                        )
+    parser.add_argument("--executor",
+                        help="How copies are run: a new rclone process for each source (subprocess), or jobs sent "
+                             "to a single rclone remote control daemon (rcd), which saves the startup and "
+                             "authentication for every source",
+                        choices=["subprocess", "rcd"],
+                        default="subprocess",
+                        )
+    parser.add_argument("--engine",
+                        help="What waits on the copies: a thread for each worker (threads), or a single asyncio "
+                             "event loop (asyncio), which reads rclone's output as it comes, keeping only the last "
+                             "--max-output-bytes, and stops the rclones already running when interrupted",
+                        choices=["threads", "asyncio"],
+                        default="threads",
+                        )
+    parser.add_argument("--tpslimit",
+                        help="Most transactions per second for the whole run. Each rclone gets a share, which "
+                             "grows and shrinks as copies start and finish.",
+                        type=float,
+                        default=None,
+                        )
+    parser.add_argument("--bwlimit",
+                        help="Most bytes per second for the whole run, shared the same way as --tpslimit",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--daily-transactions",
+                        help="Transactions to spend per day (UTC). Counted roughly, as one listing per source "
+                             "plus the files checked and transferred. Once they're spent the run stops, and "
+                             "later runs of the same tracker on the same day don't start any copies.",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--daily-bytes",
+                        help="Bytes to transfer per day (UTC), kept the same way as --daily-transactions",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--slice-files",
+                        help="For backups: split a directory with more than this many files of its own into "
+                             "slices, picked by a hash of the file names, that are tracked and copied by "
+                             "different workers. Only the direct files of directories whose subdirectories have "
+                             "rows of their own, or that have none, are sliced.",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--slice-bytes",
+                        help="For backups: the same as --slice-files, for directories whose own files add up to "
+                             "more than this many bytes",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--batch-files",
+                        help="Copy runs of small neighbouring directories (siblings, then their parent) with one "
+                             "rclone, as long as they have no more than this many files between them. Their rows "
+                             "are still kept apart in the tracker, and recorded together.",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--batch-bytes",
+                        help="The most bytes a batch of small directories may have between them, see --batch-files",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--lease-seconds",
+                        help="How long a claimed source stays with this process without being renewed. Several "
+                             "processes can work through the same tracker; if one stops, the sources it claimed "
+                             "go back to the others once their leases expire.",
+                        type=int,
+                        default=300,
+                        )
+    parser.add_argument("--metrics-port",
+                        help="Serve progress on http://127.0.0.1:<port>/metrics (Prometheus) and /status (JSON) "
+                             "while sources are being copied",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--status-file",
+                        help="Write progress to this file, as JSON, every few seconds while sources are being "
+                             "copied",
+                        type=str,
+                        default=None,
+                        )
+    parser.add_argument("--max-output-bytes",
+                        help="Most of rclone's output to keep for each source, compressed in the tracker. Longer "
+                             "output keeps its start and end.",
+                        type=int,
+                        default=64 * 1024,
+                        )
+    parser.add_argument("--history-db",
+                        help="Where to keep the summary of every finished run, and when each directory was last "
+                             "copied successfully. Finished trackers are merged into it. Defaults to "
+                             "history.sqlite3 in --logdir.",
+                        type=str,
+                        default=None,
+                        )
+    parser.add_argument("--keep-archives",
+                        help="Number of finished trackers to keep in --logdir once they're in the history. "
+                             "By default they're all kept.",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--history-days",
+                        help="Days the summary of a run is kept in the history. By default they're kept forever. "
+                             "When each directory was last copied is always kept.",
+                        type=int,
+                        default=None,
+                        )
+    parser.add_argument("--report-limit",
+                        help="Number of the slowest sources to list with --report, or of runs with --history",
+                        type=int,
+                        default=20,
+                        )
     args = parser.parse_args()
+    if args.backup or args.restore:
+        for option, value in (("--remote-name", args.remote_name), ("--sources", args.sources)):
+            if value is None:
+                parser.error(f"{option} is required for --backup and --restore")
+    elif args.plan:
+        parser.error("--plan needs --backup or --restore")
+    if args.min_workers < 1 or args.max_workers < args.min_workers:
+        parser.error("--min-workers must be at least 1, and no more than --max-workers")
+    if args.restore and (args.slice_files or args.slice_bytes):
+        parser.error("--slice-files and --slice-bytes are only for --backup")
     return args
 
 
@@ -118,12 +365,41 @@ def main():
     logging_setup(args)
     logging.debug(pprint.pformat(sys.argv))
 
+    if args.report:
+        print("\n".join(report(args.logdir, limit=args.report_limit)))
+        return
+
+    history = args.history_db or os.path.join(args.logdir, "history.sqlite3")
+    if args.history is not None:
+        print("\n".join(history_report(History(history), args.logdir, args.history, limit=args.report_limit)))
+        return
+
+    change_index = None
+    options = {}
     if args.backup:
         tracker_class = BackupTracker
+        change_index = args.change_index or os.path.join(args.logdir, "change_index.sqlite3")
+        options["slice_files"] = args.slice_files
+        options["slice_bytes"] = args.slice_bytes
+        if args.checksum_cache is not None:
+            options["checksum_cache"] = args.checksum_cache or os.path.join(args.logdir, "checksum_cache.sqlite3")
     elif args.restore:
         tracker_class = RestoreTracker
+        options["listing_cache"] = args.listing_cache or os.path.join(args.logdir, "listing_cache.sqlite3")
+        options["listing_ttl"] = args.listing_ttl
     else:
         raise UndefinedAction
+
+    if args.plan:
+        sizes = crawl(tracker_class, args.sources, os.path.join(args.logdir, "plans"), ttl=args.listing_ttl,
+                      remote_name=args.remote_name, destination=args.destination,
+                      crawl_workers=args.crawl_workers, **options)
+        model = measured_model(args.logdir)
+        estimates = plan(summarize_directories(sizes), model, args.plan_workers,
+                         non_overlapping=args.non_overlapping, bandwidth=args.bwlimit)
+        print("\n".join(format_plan(estimates, model, suggest(estimates))))
+        return
+
     tracker = tracker_class(filename=args.tracker,
                             sources=args.sources,
                             remote_name=args.remote_name,
@@ -132,7 +408,34 @@ def main():
                             verbosity=(args.verbose - 2),
                             retry=args.retry,
                             workers=args.workers,
+                            min_workers=args.min_workers,
+                            max_workers=args.max_workers,
                             depth=args.depth,
+                            non_overlapping=args.non_overlapping,
+                            synchronous=args.synchronous,
+                            commit_batch=args.commit_batch,
+                            commit_interval=args.commit_interval / 1000,
+                            split_bytes=args.split_bytes,
+                            change_index=change_index,
+                            full=args.full,
+                            executor=args.executor,
+                            engine=args.engine,
+                            crawl_workers=args.crawl_workers,
+                            metrics_port=args.metrics_port,
+                            status_file=args.status_file,
+                            max_output_bytes=args.max_output_bytes,
+                            history=history,
+                            keep_archives=args.keep_archives,
+                            history_days=args.history_days,
+                            max_attempts=args.max_attempts,
+                            tps_limit=args.tpslimit,
+                            bw_limit=args.bwlimit,
+                            daily_transactions=args.daily_transactions,
+                            daily_bytes=args.daily_bytes,
+                            lease_seconds=args.lease_seconds,
+                            batch_files=args.batch_files,
+                            batch_bytes=args.batch_bytes,
+                            **options,
                             )
     tracker.resume()
 
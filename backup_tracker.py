@@ -1,11 +1,26 @@
+import hashlib
+import logging
 import os
 import socket
+import tempfile
+import zlib
+from contextlib import contextmanager
+from math import ceil
 
 from base_tracker import BaseTracker
+from checksum_cache import ChecksumCache, list_files
+from crawler import Prefetcher
 
 
 class BackupTracker(BaseTracker):
 
+    def __init__(self, *args, checksum_cache=None, slice_files=None, slice_bytes=None, **kwargs) -> None:
+        # Set before the crawl is started
+        self._slice_files = slice_files
+        self._slice_bytes = slice_bytes
+        super().__init__(*args, **kwargs)
+        self._checksum_cache = ChecksumCache(checksum_cache, self.dest_prefix) if checksum_cache else None
+
     @property
     def dest_prefix(self):
         return f"{self.remote_name}:{self.destination}{socket.gethostname()}"
@@ -14,25 +29,252 @@ class BackupTracker(BaseTracker):
     def source_prefix(self):
         return f""
 
+    @contextmanager
+    def _copy_options(self, source_path, options, members=None):
+        """
+        Copies only the files listed in a --files-from-raw file, so rclone neither reads the others nor
+        looks them up on the remote, for a slice of a directory, and with a checksum cache, for the
+        files that are new or whose contents changed.  Nothing is started when there's nothing to copy.
+        """
+        caching = self._checksum_cache is not None and not self._full
+        sliced = members is not None and any(slice for _, _, slice in members)
+        if not caching and not sliced:
+            with super()._copy_options(source_path, options, members) as copy_options:
+                yield copy_options
+            return
+        names = []
+        records = []
+        for path, max_depth, slice in members or [("", options.get("max-depth"), None)]:
+            directory = os.path.join(source_path, path)
+            select = self._slice_selector(slice)
+            if caching:
+                changed = self._checksum_cache.changed(directory, recursive=max_depth != 1, select=select)
+            else:
+                changed = [name for name, _, _ in list_files(directory, recursive=max_depth != 1) if select(name)], []
+            if changed is None or any("\n" in name for name in changed[0]):
+                # Copying everything is slower, but still right.
+                with super()._copy_options(source_path, options, None if sliced else members) as copy_options:
+                    yield copy_options
+                return
+            names.extend(os.path.join(path, name) for name in changed[0])
+            records.extend(changed[1])
+        if not names:
+            logging.debug("Nothing to copy in %s", source_path)
+            yield None
+        else:
+            with tempfile.NamedTemporaryFile(prefix="files-from-", suffix=".txt") as files_from:
+                # Overlapping rows of a batch can cover the same files.
+                files_from.write(b"".join(os.fsencode(name) + b"\n" for name in dict.fromkeys(names)))
+                files_from.flush()
+                with super()._copy_options(source_path, {**options, "files-from-raw": files_from.name,
+                                                         "no-traverse": True}) as copy_options:
+                    yield copy_options
+        if caching:
+            self._checksum_cache.record(records)
+
+    @staticmethod
+    def _slice_selector(slice):
+        """
+        Returns whether a file name is in a slice, given as "index/count".  Names are spread by a hash,
+        so files added later still fall into one slice, and the slices stay about the same size.
+        """
+        if slice is None:
+            return lambda name: True
+        index, count = (int(part) for part in slice.split("/"))
+        return lambda name: zlib.crc32(os.fsencode(name)) % count == index
+
+    def _slices(self, row, own_size):
+        """
+        Splits a row for a directory's direct files into slices of up to slice_files files and
+        slice_bytes bytes, so a huge flat directory is copied by several workers at once.
+        """
+        files, size = own_size
+        count = max(ceil(files / self._slice_files) if self._slice_files else 1,
+                    ceil(size / self._slice_bytes) if self._slice_bytes else 1)
+        count = min(count, files)
+        if count <= 1:
+            return [row]
+        logging.debug("Slicing %s, %d files, %d bytes, into %d", row["path"], files, size, count)
+        return [{**row,
+                 "max_depth": 1,
+                 "files": files // count,
+                 "bytes": size // count,
+                 "priority": size // count if self._non_overlapping else row["priority"],
+                 "slice": f"{index}/{count}"} for index in range(count)]
+
+    def _record_changes(self):
+        super()._record_changes()
+        if self._checksum_cache is not None:
+            self._checksum_cache.close()
+
     def populate_source(self, source):
-        detailed_sources = []
+        """
+        Yields a row for the source and each directory below it, down to one level past the max depth.
+        The directories are walked depth first and every directory comes after its subdirectories,
+        so the rows can be added to the tracker while the crawl is still going.
+
+        When the rows need sizes or signatures, directories past the max depth are still walked to
+        count their files and bytes.  When splitting is on, those with more than split_bytes below
+        them get rows for their subdirectories too, so one huge directory doesn't end up as a single
+        job.  Otherwise the walk stops at the max depth, and what's below is left to rclone.
+
+        Each row also gets a signature made from the stat() of the directories and files it copies,
+        which is how unchanged directories are recognised on the next run.
+
+        Directories are listed by a pool of crawl_workers threads ahead of the walk, which still
+        visits them in order, so the rows don't depend on which listing finishes first.
+        """
         if self._depth is not None and self._depth < 0:
-            return [source]
-
-        base_depth = source.rstrip(os.path.sep).count(os.path.sep)
-        for root, dirs, _ in os.walk(source, topdown=True, followlinks=False):
-            current_depth = root.rstrip(os.path.sep).count(os.path.sep) - base_depth
-
-            if self._depth is not None and current_depth >= self._depth:
-                # We have reached the max depth.
-                # Don't recurse into subdirectories by clearing the 'dirs' list.
-                # But we still want to add these subdirectories as sources.
-                detailed_sources.extend([os.path.join(root, subdir) for subdir in dirs])
-                del dirs[:]
-            else:
-                # Still below max depth, add the immediate subdirectories.
-                detailed_sources.extend([os.path.join(root, subdir) for subdir in dirs])
+            yield self._make_row(source)
+            return
+
+        scans = Prefetcher(self._scan_executor, self._scan)
+        try:
+            stack = [self._walk_into(scans, source, 0)]
+            while stack:
+                frame = stack[-1]
+                subdir = next(frame["pending"], None)
+                if subdir is not None:
+                    path, is_symlink = subdir
+                    if is_symlink:
+                        # Symlinked directories are tracked, but not followed.
+                        stack.append(self._link(path, frame["depth"] + 1))
+                    elif not self._listed(frame["depth"] + 1):
+                        # Not even counted, so nothing above it knows its size either.
+                        stack.append({**self._unlisted(path, frame["depth"] + 1), "total": None})
+                    else:
+                        stack.append(self._walk_into(scans, path, frame["depth"] + 1))
+                    continue
+
+                stack.pop()
+                rows = self._finish(frame)
+                if not stack:
+                    yield from rows
+                    continue
+                parent = stack[-1]
+                if frame["total"] is None or parent["total"] is None:
+                    parent["total"] = None
+                else:
+                    parent["total"] = [a + b for a, b in zip(parent["total"], frame["total"])]
+                if frame["subtree"] is None:
+                    # Anything below that couldn't be listed makes the whole subtree unknown.
+                    parent["subtree"] = None
+                elif parent["subtree"] is not None:
+                    parent["subtree"].update(frame["subtree"].digest())
+                if self._walked(parent["depth"]):
+                    yield from rows
+                else:
+                    parent["rows"].extend(rows)
+        finally:
+            scans.cancel()
+
+    def _walk_into(self, scans, path, depth):
+        """Returns the scan of a directory, and starts listing its subdirectories in the background."""
+        frame = scans.get((path, depth))
+        if self._listed(depth + 1):
+            scans.prefetch((subdir, depth + 1) for subdir, is_symlink in frame["subdirs"] if not is_symlink)
+        return frame
+
+    def _walked(self, depth):
+        """Whether a directory at this depth has rows for all of its subdirectories."""
+        return self._depth is None or depth <= self._depth
+
+    def _listed(self, depth):
+        """Whether a directory at this depth is listed, rather than left whole to rclone."""
+        return self._sizing or self._walked(depth)
+
+    def _finish(self, frame):
+        """Returns the rows for a directory once everything below it has been walked."""
+        path = frame["path"]
+        total_signature = frame["subtree"].hexdigest() if frame["subtree"] is not None else None
+        if not frame["listed"]:
+            # Leave it to rclone to copy (or report) the whole directory.  rclone copies through a
+            # symlink it's given, but what's behind it isn't walked, so it's never known to be unchanged.
+            return [self._make_row(path, total_signature=None if frame["symlink"] else total_signature)]
+        own_size = tuple(frame["own"])
+        total_size = tuple(frame["total"]) if frame["total"] is not None else None
+        own_row = self._make_row(path, own_files_only=True, own_size=own_size, total_size=total_size,
+                                 own_signature=frame["own_signature"], total_signature=total_signature)
+        if self._walked(frame["depth"]):
+            return self._slices(own_row, own_size)
+        if self._splitting and frame["rows"] and total_size[1] > self._split_bytes:
+            logging.debug("Splitting %s, %d bytes", path, total_size[1])
+            return frame["rows"] + self._slices(own_row, own_size)
+        row = self._make_row(path, own_size=own_size, total_size=total_size, total_signature=total_signature)
+        # Only the direct files are sliced, so only a directory without subdirectories can be.
+        return self._slices(row, own_size) if not frame["subdirs"] else [row]
+
+    @staticmethod
+    def _unlisted(path, depth):
+        return {
+            "path": path,
+            "depth": depth,
+            "listed": False,
+            "symlink": False,
+            "subdirs": [],
+            "pending": iter(()),
+            "own": [0, 0],
+            "total": [0, 0],
+            "own_signature": None,
+            "subtree": None,
+            "rows": [],
+        }
+
+    @staticmethod
+    def _link(path, depth):
+        """
+        A symlinked directory.  Its own row is always copied, but the directory above only has the
+        link, which rclone skips there, so that's known by where it points rather than by its contents.
+        """
+        frame = BackupTracker._unlisted(path, depth)
+        frame["symlink"] = True
+        try:
+            stat = os.stat(path, follow_symlinks=False)
+            frame["subtree"] = hashlib.blake2b(
+                b"link\0" + os.fsencode(os.readlink(path)) + f"\0{stat.st_mtime_ns}".encode(), digest_size=16)
+        except OSError as exception:
+            logging.debug("Unable to read link %s: %s", path, exception)
+        return frame
+
+    @staticmethod
+    def _scan(path, depth):
+        """
+        Lists a directory, returning a frame with its subdirectories still to walk, as sorted
+        (path, is_symlink), and the count, size and signature of its direct files.
+        """
+        frame = BackupTracker._unlisted(path, depth)
+        subdirs = []
+        files = []
+        try:
+            stat = os.stat(path, follow_symlinks=False)
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            subdirs.append((entry.path, entry.is_symlink()))
+                        elif entry.is_file(follow_symlinks=False):
+                            file_stat = entry.stat(follow_symlinks=False)
+                            files.append((os.fsencode(entry.name), file_stat.st_size, file_stat.st_mtime_ns,
+                                          file_stat.st_ctime_ns, file_stat.st_ino))
+                    except OSError as exception:
+                        # Probably deleted since it was listed
+                        logging.debug("Unable to stat %s: %s", entry.path, exception)
+        except OSError as exception:
+            logging.warning("Unable to list %s: %s", path, exception)
+            return frame
+
+        # Adding, removing or renaming entries changes the directory's mtime; changing a file's
+        # contents changes its size, mtime or ctime.
+        own = hashlib.blake2b(f"{stat.st_ino}\0{stat.st_mtime_ns}".encode(), digest_size=16)
+        for name, *file_stat in sorted(files):
+            own.update(b"\0" + name + "\0{}\0{}\0{}\0{}".format(*file_stat).encode())
+        size = sum(file[1] for file in files)
 
-        detailed_sources.append(source)
-        # Remove duplicates and ensure the sources are unique (if any)
-        return sorted(list(set(detailed_sources)), reverse=True, key=lambda x: x.count(os.path.sep))
+        frame["listed"] = True
+        frame["subdirs"] = sorted(subdirs)
+        frame["pending"] = iter(frame["subdirs"])
+        frame["own"] = [len(files), size]
+        frame["total"] = [len(files), size]
+        frame["own_signature"] = own.hexdigest()
+        frame["subtree"] = hashlib.blake2b(own.digest(), digest_size=16)
+        return frame
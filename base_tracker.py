@@ -1,22 +1,194 @@
+import asyncio
 import logging
 import os
+import re
+import secrets
 import signal
+import socket
 import sqlite3
 import subprocess
 import sys
+import tempfile
 import threading
 from abc import ABCMeta, abstractmethod
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timezone
-from time import sleep
+from collections import deque
+from heapq import heappop, heappush
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta, timezone
+from time import monotonic, sleep
+
+from budget import DailyBudget, RateShares
+from change_index import ChangeIndex
+from concurrency import AdaptiveConcurrency
+from crawler import merge
+from event_loop import EventLoopExecutor
+from executors import RcdExecutor, SubprocessExecutor
+from failures import CAP, PERMANENT, backoff, classify, is_throttled
+from history import History
+from metrics import MetricsServer, ProgressMetrics
+from outputs import pack, summarize_failure, unpack
+from tracker_writer import TrackerWriter
 
 
 class BaseTracker(metaclass=ABCMeta):
     _interrupt_requested = False
     _interrupt_lock = threading.Lock()
     __MAX_SLEEP__ = 60 * 60
+    __POLL_SECONDS__ = 1
+    __INSERT_BATCH__ = 1000
+    # How often resume() refreshes the scheduling metrics and the status file
+    __METRICS_SECONDS__ = 5
+    # Backoff before a transient failure is retried: doubles with each attempt, up to the maximum
+    __RETRY_SECONDS__ = 5
+    # How long to wait for another process to finish writing to the tracker
+    __BUSY_SECONDS__ = 60
+    __MAX_RETRY_SECONDS__ = 300
+    # Most rows copied together by one batch, however small they are
+    __MAX_BATCH_ROWS__ = 1000
+    # Columns added to the "sources" table after the original schema.
+    # Trackers written by older versions get them added when they're opened.
+    __SOURCE_COLUMN_UPGRADES__ = [
+        ("max_depth", "integer"),
+        ("claimed", "timestamp"),
+        ("files", "bigint"),
+        ("bytes", "bigint"),
+        ("priority", "bigint"),
+        ("signature", "text"),
+        ("bytes_transferred", "bigint"),
+        ("files_transferred", "bigint"),
+        ("checks", "bigint"),
+        ("elapsed", "real"),
+        ("retries", "integer"),
+        ("attempts", "integer"),
+        ("owner", "text"),
+        ("lease_expiry", "timestamp"),
+        ("batch", "text"),
+        ("slice", "text"),
+    ]
+    # Partial indexes keep the scheduling queries O(log n) however much of the tracker is done.
+    __SOURCE_INDEXES__ = [
+        # Sources nobody is working on yet, in the order claim_sources() hands them out
+        """
+            CREATE INDEX IF NOT EXISTS sources_pending_priority ON sources ( priority DESC, id )
+            WHERE done IS NULL AND claimed IS NULL;
+        """,
+        # Sources claimed but not finished, to release them again
+        """
+            CREATE INDEX IF NOT EXISTS sources_claimed ON sources ( id )
+            WHERE done IS NULL AND claimed IS NOT NULL;
+        """,
+        """
+            CREATE INDEX IF NOT EXISTS sources_failure ON sources ( id )
+            WHERE failure IS NOT NULL;
+        """,
+        # Lets an interrupted crawl be restarted without adding the same path, or slice of it, twice.
+        """
+            CREATE UNIQUE INDEX IF NOT EXISTS sources_path_slice ON sources ( path, coalesce(slice, '') );
+        """,
+        # The rest of a batch, to claim it along with the row that was picked
+        """
+            CREATE INDEX IF NOT EXISTS sources_batch ON sources ( batch )
+            WHERE done IS NULL AND claimed IS NULL AND batch IS NOT NULL;
+        """,
+    ]
+    # Indexes made by older versions that have since been replaced
+    __DROPPED_INDEXES__ = [
+        "sources_pending",
+        "sources_path",
+    ]
+
+    # Recording a result updates the small scheduling columns in sources and replaces the source's
+    # (compressed) output, which is kept apart so it doesn't slow down reading sources.  Results
+    # from a process whose lease was taken over by another are dropped; the other one records its own.
+    __UPDATE_SOURCE__ = [
+        """
+            UPDATE sources
+            SET
+                done = :done,
+                failure = :failure,
+                bytes_transferred = :bytes_transferred,
+                files_transferred = :files_transferred,
+                checks = :checks,
+                elapsed = :elapsed,
+                retries = :retries,
+                attempts = coalesce(attempts, 0) + 1
+            WHERE id = :id
+            AND (:owner IS NULL OR coalesce(owner, :owner) = :owner);
+        """,
+        """
+            DELETE FROM outputs
+            WHERE id = :id
+            AND (:owner IS NULL OR coalesce((SELECT owner FROM sources WHERE id = :id), :owner) = :owner);
+        """,
+        """
+            INSERT INTO outputs
+                ( id, returncode, args, command_line, stdout, stderr)
+                SELECT :id, :returncode, :args, :command_line, :stdout, :stderr
+                WHERE coalesce(:args, :command_line, :stdout, :stderr) IS NOT NULL
+                AND (:owner IS NULL OR coalesce((SELECT owner FROM sources WHERE id = :id), :owner) = :owner);
+        """,
+    ]
+    # Counts of the sources by state, kept up to date by triggers in the same transactions as the
+    # rows, so resume() can start without counting a tracker of millions of rows.
+    __CREATE_SUMMARY__ = [
+        """
+            CREATE TABLE IF NOT EXISTS summary (
+                done                 bigint NOT NULL    ,
+                pending              bigint NOT NULL    ,
+                pending_bytes        bigint NOT NULL
+             );
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS sources_summary_insert AFTER INSERT ON sources
+            BEGIN
+                UPDATE summary
+                SET
+                    done = done + (new.done IS NOT NULL),
+                    pending = pending + (new.done IS NULL),
+                    pending_bytes = pending_bytes + iif(new.done IS NULL, coalesce(new.bytes, 0), 0);
+            END;
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS sources_summary_update AFTER UPDATE OF done, bytes ON sources
+            BEGIN
+                UPDATE summary
+                SET
+                    done = done - (old.done IS NOT NULL) + (new.done IS NOT NULL),
+                    pending = pending - (old.done IS NULL) + (new.done IS NULL),
+                    pending_bytes = pending_bytes - iif(old.done IS NULL, coalesce(old.bytes, 0), 0)
+                                                  + iif(new.done IS NULL, coalesce(new.bytes, 0), 0);
+            END;
+        """,
+        """
+            CREATE TRIGGER IF NOT EXISTS sources_summary_delete AFTER DELETE ON sources
+            BEGIN
+                UPDATE summary
+                SET
+                    done = done - (old.done IS NOT NULL),
+                    pending = pending - (old.done IS NULL),
+                    pending_bytes = pending_bytes - iif(old.done IS NULL, coalesce(old.bytes, 0), 0);
+            END;
+        """,
+    ]
+    __CREATE_OUTPUTS__ = """
+        CREATE TABLE IF NOT EXISTS outputs (
+            id                   integer NOT NULL  PRIMARY KEY  ,
+            returncode           integer     ,
+            args                 blob     ,
+            command_line         blob     ,
+            stdout               blob     ,
+            stderr               blob     
+         );
+    """
 
-    def __init__(self, filename, sources, remote_name, destination, logdir, verbosity=0, retry=False, workers=4, depth=None) -> None:
+    def __init__(self, filename, sources, remote_name, destination, logdir, verbosity=0, retry=False, workers=4, depth=None,
+                 non_overlapping=False, synchronous="NORMAL", commit_batch=100, commit_interval=0.5,
+                 split_bytes=None, min_workers=1, max_workers=16, change_index=None, full=False,
+                 executor="subprocess", crawl_workers=8, metrics_port=None, status_file=None,
+                 max_output_bytes=64 * 1024, history=None, keep_archives=None, history_days=None,
+                 max_attempts=3, tps_limit=None, bw_limit=None, daily_transactions=None, daily_bytes=None,
+                 lease_seconds=300, batch_files=None, batch_bytes=None, engine="threads") -> None:
         self._filename = filename
         self._top_level_sources = sources
         self._remote_name = remote_name
@@ -27,9 +199,49 @@ class BaseTracker(metaclass=ABCMeta):
         self._tracker_lock = threading.Lock()
         self._retry = retry
         self._workers = workers
+        if workers == "auto":
+            self._concurrency = AdaptiveConcurrency(min_workers, max_workers)
+        else:
+            self._concurrency = AdaptiveConcurrency(workers, workers)
         self._depth = depth
+        self._non_overlapping = non_overlapping
+        self._split_bytes = split_bytes
+        self._change_index = ChangeIndex(change_index, self.dest_prefix) if change_index else None
+        self._full = full
+        if executor == "rcd":
+            # A single process makes every copy, so the limits are set once, on it.
+            self._executor = RcdExecutor(verbosity, tps_limit=tps_limit, bw_limit=bw_limit)
+            self._rate_shares = RateShares()
+        else:
+            self._executor = SubprocessExecutor(verbosity, max_output_bytes=max_output_bytes)
+            self._rate_shares = RateShares(tps_limit, bw_limit)
+        self._engine = engine
+        self._budget = DailyBudget(daily_transactions, daily_bytes)
+        self._synchronous = synchronous
+        self._commit_batch = commit_batch
+        self._commit_interval = commit_interval
+        self._writer = None
+        self._crawler = None
+        # Shared by the walks of all the top-level sources
+        self._scan_executor = ThreadPoolExecutor(max_workers=crawl_workers, thread_name_prefix="scanner")
+        self._crawl_error = None
+        self._crawl_progress = threading.Event()
+        self._metrics = ProgressMetrics()
+        self._metrics_port = metrics_port
+        self._max_output_bytes = max_output_bytes
+        self._status_file = status_file
+        self._history = History(history) if history else None
+        self._keep_archives = keep_archives
+        self._history_days = history_days
+        self._max_attempts = max_attempts
+        # Identifies this process's claims, when several share the tracker
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self._lease_seconds = lease_seconds
+        self._batch_files = batch_files
+        self._batch_bytes = batch_bytes
         self._sleep_on_cap_exceeded = None
         self._sleep_lock = threading.Lock()
+        self._paused_until = 0
         self._reset_sleep()
 
         signal.signal(signal.SIGINT, BaseTracker._sigint_handler)
@@ -60,14 +272,69 @@ class BaseTracker(metaclass=ABCMeta):
 
     @abstractmethod
     def populate_source(self, source):
+        """
+        Returns the rows to track for one top-level source, as dicts with:
+          path:      the directory to copy
+          max_depth: passed to rclone as --max-depth, or None to copy the whole subtree
+          files:     approximate number of files the row copies, or None if unknown
+          bytes:     approximate number of bytes the row copies, or None if unknown
+          priority:  rows with a higher priority are claimed first
+          signature: summarises what the row copies, rows whose signature matches the change index
+                     from the last successful backup are left out, or None if unknown
+        """
         raise NotImplementedError
 
+    def _make_row(self, path, own_files_only=False, own_size=None, total_size=None, own_signature=None,
+                  total_signature=None):
+        """
+        Builds a row for populate_source().
+        own_files_only is set for directories whose subdirectories have rows of their own.  When
+        planning non-overlapping transfers those rows only copy their direct files.
+        own_size and total_size are (files, bytes) for the directory's direct files and for its whole
+        subtree, and own_signature and total_signature summarise them, when the crawl knows them.
+        """
+        max_depth = 1 if own_files_only and self._non_overlapping else None
+        files, size = (own_size if max_depth else total_size) or (None, None)
+        signature = own_signature if max_depth else total_signature
+        if self._non_overlapping:
+            # Start the biggest jobs first, so no single worker is left running long after the rest.
+            priority = size or 0
+        else:
+            # Rows copy everything below them, so copy the deepest first and let the parents
+            # find most of their work already done.
+            priority = path.rstrip("/").count("/")
+        return {
+            "path": path,
+            "max_depth": max_depth,
+            "files": files,
+            "bytes": size,
+            "priority": priority,
+            "signature": signature,
+        }
+
+    @property
+    def _splitting(self):
+        """Whether oversized directories past the max depth get rows for their subdirectories too."""
+        return self._non_overlapping and bool(self._split_bytes)
+
+    @property
+    def _sizing(self):
+        """
+        Whether the crawl counts and signs everything below the deepest rows: for the largest-first
+        order and splitting of non-overlapping rows, for batching, and for the change index.
+        Otherwise it stops one level past the max depth, and those rows are left to rclone.
+        """
+        return self._non_overlapping or self._batching or (self._change_index is not None and not self._full)
+
     @staticmethod
     def _sigint_handler(sig, _):
         logging.debug("received signal %s", signal.Signals(sig).name)
         with BaseTracker._interrupt_lock:
             BaseTracker._interrupt_requested = True
 
+    def _pack(self, text):
+        return pack(text, limit=self._max_output_bytes)
+
     @staticmethod
     def _bytes_to_str(message: bytes) -> str:
         if isinstance(message, str):
@@ -103,18 +370,61 @@ class BaseTracker(metaclass=ABCMeta):
         with self._sleep_lock:
             self._sleep_on_cap_exceeded = 300
 
+    def _pause(self, seconds):
+        """Stops all workers from starting rclone for the next few seconds."""
+        with self._sleep_lock:
+            self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    def _pause_remaining(self):
+        with self._sleep_lock:
+            return max(0, self._paused_until - monotonic())
+
+    def _wait_for_pause(self):
+        """Waits out any pause, returning False if interrupted while waiting."""
+        while True:
+            with self._interrupt_lock:
+                if self._interrupt_requested:
+                    return False
+            remaining = self._pause_remaining()
+            if not remaining:
+                return True
+            sleep(min(remaining, self.__POLL_SECONDS__))
+
+    async def _wait_for_pause_async(self):
+        """_wait_for_pause() for the asyncio engine, which waits without holding a thread."""
+        while True:
+            with self._interrupt_lock:
+                if self._interrupt_requested:
+                    return False
+            remaining = self._pause_remaining()
+            if not remaining:
+                return True
+            await asyncio.sleep(min(remaining, self.__POLL_SECONDS__))
+
     def _archive(self):
+        # Fold the write-ahead log back into the database, so the archive is a single file.
+        with self._tracker_lock:
+            self._tracker.execute("PRAGMA journal_mode = DELETE;")
+            self._tracker.close()
         os.makedirs(self._logdir, exist_ok=True)
         completed_db = os.path.join(self._logdir, f"{datetime.now(timezone.utc).isoformat()}-{os.path.basename(self._filename)}")
         os.rename(self._filename, completed_db)
         logging.info("Completed db saved as %s", completed_db)
+        if self._history is not None:
+            try:
+                self._history.merge(completed_db)
+                self._history.apply_retention(self._logdir, self._keep_archives, self._history_days)
+            except (RuntimeError, OSError) as exception:
+                # The copies are done either way; the archive is picked up by the next merge.
+                logging.warning("Unable to update the history: %s", exception)
 
     def _init_tracker(self):
         if os.path.isfile(self._filename):
             logging.debug("%s exists, we'll use that for tracking progress", self._filename)
             self._load_from_disk()
-            # Always reset 'next' to the first unfinished task to ensure robustness on resume
-            self.update_tracker_value("next", self.get_next_source_id(-1) or 0)
+            # Anything claimed by an earlier run that didn't finish (or failed) is up for grabs again,
+            # unless another process is still working on it.
+            self._reclaim_expired(include_failures=True)
         else:
             logging.debug("%s doesn't exist, generating: %s", self._filename, str(self._top_level_sources))
             self._make_fresh_tracker()
@@ -122,7 +432,9 @@ class BaseTracker(metaclass=ABCMeta):
         if self._retry:
             # Clear all failures if retry is requested
             self._clear_failures()
-            self.update_tracker_value("next", self.get_next_source_id(-1) or 0)
+
+        if not self.get_tracker_value("crawled"):
+            self._start_crawl()
 
     def _clear_failures(self):
         """Clears all failure information from the sources table."""
@@ -139,14 +451,143 @@ class BaseTracker(metaclass=ABCMeta):
             logging.exception(exception)
             raise RuntimeError("Unable to clear failures from tracker database")
 
+    def _release_claims(self, include_failures=False):
+        """
+        Makes the sources this process claimed but hasn't finished available to claim_sources()
+        again.  Failed sources stay claimed for the rest of the run, unless include_failures, but
+        without a lease, so other processes don't reclaim them when it would have expired.
+        """
+        try:
+            with self._tracker_lock:
+                with self._tracker:
+                    self._tracker.execute("""
+                        UPDATE sources
+                        SET
+                            claimed = NULL,
+                            owner = NULL,
+                            lease_expiry = NULL
+                        WHERE done IS NULL
+                        AND claimed IS NOT NULL
+                        AND owner = :owner
+                        AND (:include_failures OR failure IS NULL);
+                    """, {"include_failures": include_failures, "owner": self._owner})
+                    self._tracker.execute("""
+                        UPDATE sources
+                        SET lease_expiry = NULL
+                        WHERE done IS NULL
+                        AND claimed IS NOT NULL
+                        AND owner = :owner;
+                    """, {"owner": self._owner})
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to release claimed sources")
+
+    def _reclaim_expired(self, include_failures=False):
+        """
+        Makes sources available to claim_sources() again when the process that claimed them stopped
+        renewing its lease, and with include_failures, those left failed or claimed without a lease
+        by runs that have finished.
+        """
+        try:
+            with self._tracker_lock:
+                with self._tracker:
+                    reclaimed = self._tracker.execute("""
+                        UPDATE sources
+                        SET
+                            claimed = NULL,
+                            owner = NULL,
+                            lease_expiry = NULL
+                        WHERE done IS NULL
+                        AND claimed IS NOT NULL
+                        AND (lease_expiry < :now OR (lease_expiry IS NULL AND :include_failures));
+                    """, {"now": datetime.now(timezone.utc).isoformat(),
+                          "include_failures": include_failures}).rowcount
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to reclaim sources")
+        if reclaimed:
+            logging.info("Reclaimed %d sources", reclaimed)
+
+    def _renew_leases(self):
+        """Extends the leases of the sources this process is working on, or still has to retry."""
+        try:
+            with self._tracker_lock:
+                with self._tracker:
+                    self._tracker.execute("""
+                        UPDATE sources
+                        SET lease_expiry = :lease_expiry
+                        WHERE done IS NULL
+                        AND claimed IS NOT NULL
+                        AND owner = :owner;
+                    """, {"owner": self._owner, "lease_expiry": self._lease_expiry()})
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to renew leases")
+
+    def _lease_expiry(self):
+        return (datetime.now(timezone.utc) + timedelta(seconds=self._lease_seconds)).isoformat()
+
+    def _connect(self):
+        # Other processes working on the same tracker may hold the write lock for a moment.
+        self._tracker = sqlite3.connect(database=self._filename, check_same_thread=False,
+                                        timeout=self.__BUSY_SECONDS__)
+        # WAL lets readers carry on while results are written, and makes commits far cheaper
+        try:
+            self._tracker.execute("PRAGMA journal_mode = WAL;")
+            self._tracker.execute(f"PRAGMA synchronous = {self._synchronous};")
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to configure tracker database")
+
     def _load_from_disk(self):
-        self._tracker = sqlite3.connect(database=self._filename, check_same_thread=False)
+        self._connect()
+        self._upgrade_tracker()
 
-    def _make_fresh_tracker(self):
-        # TODO: do the table creation first, then _populate_sources() can be a separate thread, and resume() can start right away
-        detailed_sources = map(lambda x: x.encode("utf-8", errors="backslashreplace"), self._populate_sources())
+    def _upgrade_tracker(self):
+        """Adds any columns and indexes missing from trackers made by older versions."""
+        try:
+            with self._tracker_lock:
+                with self._tracker:
+                    existing = {column[1] for column in self._tracker.execute("PRAGMA table_info(sources);")}
+                    for name, column_type in self.__SOURCE_COLUMN_UPGRADES__:
+                        if name not in existing:
+                            logging.info("Upgrading tracker: adding sources.%s", name)
+                            self._tracker.execute(f"ALTER TABLE sources ADD COLUMN {name} {column_type};")
+                    self._tracker.execute(self.__CREATE_OUTPUTS__)
+                    if self._tracker.execute("""
+                        SELECT name
+                        FROM sqlite_master
+                        WHERE type = 'table'
+                        AND name = 'summary';
+                    """).fetchone() is None:
+                        # The only time the sources are counted; the triggers keep the counts from then on.
+                        logging.info("Upgrading tracker: counting sources")
+                        for statement in self.__CREATE_SUMMARY__:
+                            self._tracker.execute(statement)
+                        self._tracker.execute("""
+                            INSERT INTO summary
+                                ( done, pending, pending_bytes)
+                                SELECT
+                                    count(done),
+                                    count(*) - count(done),
+                                    coalesce(sum(CASE WHEN done IS NULL THEN bytes END), 0)
+                                FROM sources;
+                        """)
+                    for index in self.__DROPPED_INDEXES__:
+                        self._tracker.execute(f"DROP INDEX IF EXISTS {index};")
+                    for index in self.__SOURCE_INDEXES__:
+                        self._tracker.execute(index)
+                    # Older trackers were always fully populated before they were written.
+                    self._tracker.execute("""
+                        INSERT OR IGNORE INTO tracker
+                            ( key, value) VALUES ( 'crawled', 1 );
+                    """)
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to upgrade tracker database")
 
-        self._tracker = sqlite3.connect(database=self._filename, check_same_thread=False)
+    def _make_fresh_tracker(self):
+        self._connect()
         try:
             with self._tracker:
                 self._tracker.execute("""
@@ -161,74 +602,453 @@ class BaseTracker(metaclass=ABCMeta):
                         id                   bigint NOT NULL  PRIMARY KEY  ,
                         path                 text NOT NULL    ,
                         done                 timestamp     ,
-                        args                 text     ,
-                        command_line         text     ,
-                        returncode           integer     ,
-                        stdout               text     ,
-                        stderr               text     ,
-                        failure              text     
+                        failure              text     ,
+                        max_depth            integer     ,
+                        claimed              timestamp     ,
+                        files                bigint     ,
+                        bytes                bigint     ,
+                        priority             bigint     ,
+                        signature            text     ,
+                        bytes_transferred    bigint     ,
+                        files_transferred    bigint     ,
+                        checks               bigint     ,
+                        elapsed              real     ,
+                        retries              integer     ,
+                        attempts             integer     ,
+                        owner                text     ,
+                        lease_expiry         timestamp     ,
+                        batch                text     ,
+                        slice                text     
                      );
                 """)
 
+                self._tracker.execute(self.__CREATE_OUTPUTS__)
+
+                for statement in self.__CREATE_SUMMARY__:
+                    self._tracker.execute(statement)
                 self._tracker.execute("""
-                    INSERT INTO tracker
-                        ( key, value) VALUES ( ?, ? );
-                """, ("next", 0))
+                    INSERT INTO summary
+                        ( done, pending, pending_bytes) VALUES ( 0, 0, 0 );
+                """)
+
+                for index in self.__SOURCE_INDEXES__:
+                    self._tracker.execute(index)
 
                 self._tracker.executemany("""
-                    INSERT INTO sources
-                        ( id, path) VALUES ( ?, ? );
-                """, enumerate(detailed_sources))
+                    INSERT INTO tracker
+                        ( key, value) VALUES ( ?, ? );
+                """, [("crawled", 0)])
         except sqlite3.Error as exception:
             logging.exception(exception)
             raise RuntimeError("Unable to make fresh tracker database")
 
+    def _start_crawl(self):
+        """
+        Populates the sources table on a background thread, so resume() can start on the sources
+        that have already been found.  The 'crawled' tracker value is only set once every source has
+        been added; until then an interrupted crawl is restarted the next time the tracker is opened.
+        """
+        self._crawler = threading.Thread(target=self._crawl, name="crawler", daemon=True)
+        self._crawler.start()
+
+    def _crawl(self):
+        try:
+            batch = []
+            # Closing the rows stops the crawler threads before the scanners are shut down.
+            with closing(self._populate_sources()) as rows:
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= self.__INSERT_BATCH__:
+                        self._insert_sources(batch)
+                        batch = []
+                        with self._interrupt_lock:
+                            if self._interrupt_requested:
+                                logging.info("Interrupt requested, stopping the crawl")
+                                return
+            self._insert_sources(batch)
+            self.update_tracker_value("crawled", 1)
+            logging.info("Finished crawling %s", str(self._top_level_sources))
+        except Exception as exception:
+            logging.exception("Crawl failed")
+            self._crawl_error = exception
+        finally:
+            self._scan_executor.shutdown(cancel_futures=True)
+            self._crawl_progress.set()
+
+    def wait_for_crawl(self):
+        """Blocks until the crawl started when the tracker was opened has finished."""
+        if self._crawler is not None:
+            self._crawler.join()
+        if self._crawl_error is not None:
+            raise RuntimeError(f"Unable to crawl {self._top_level_sources}") from self._crawl_error
+
+    def close(self):
+        with self._tracker_lock:
+            self._tracker.close()
+
+    def _crawling(self):
+        return self._crawler is not None and self._crawler.is_alive()
+
+    def _insert_sources(self, rows):
+        try:
+            with self._tracker_lock:
+                with self._tracker:
+                    # Taking the write lock first keeps the ids apart from another process crawling too.
+                    self._tracker.execute("BEGIN IMMEDIATE;")
+                    next_id = self._tracker.execute("""
+                        SELECT coalesce(max(id), -1) + 1
+                        FROM sources;
+                    """).fetchone()[0]
+                    inserted = self._tracker.executemany("""
+                        INSERT OR IGNORE INTO sources
+                            ( id, path, max_depth, files, bytes, priority, signature, batch, slice)
+                            VALUES ( :id, :path, :max_depth, :files, :bytes, :priority, :signature, :batch, :slice );
+                    """, ({**row,
+                           "id": source_id,
+                           "path": row["path"].encode("utf-8", errors="backslashreplace"),
+                           "batch": row["batch"].encode("utf-8", errors="backslashreplace")
+                           if row.get("batch") else None,
+                           "slice": row.get("slice"),
+                           } for source_id, row in enumerate(rows, start=next_id))).rowcount
+                # Paths that were already there aren't counted, but their bytes are, so it's approximate
+                # after an interrupted crawl.
+                self._metrics.add_pending(inserted, sum(row["bytes"] or 0 for row in rows))
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to add sources to tracker database")
+        self._crawl_progress.set()
+
     def _populate_sources(self):
-        detailed_sources = []
-        for source in self._top_level_sources:
-            detailed_sources.extend(self.populate_source(source))
-        return detailed_sources
+        # The top-level sources are independent, so they're all crawled at the same time.
+        unchanged = 0
+        for row in merge(self._coalesce(self.populate_source(source)) for source in self._top_level_sources):
+            if not self._full and self._change_index is not None \
+                    and self._change_index.unchanged(row["path"], row["signature"]):
+                unchanged += 1
+                continue
+            yield row
+        if unchanged:
+            logging.info("Left out %d unchanged directories", unchanged)
+
+    @property
+    def _batching(self):
+        """Whether small rows next to each other are copied together."""
+        return bool(self._batch_files or self._batch_bytes)
+
+    def _coalesce(self, rows):
+        """
+        Gives runs of small rows that are next to each other in the walk, siblings and then their
+        parent, the same batch, up to batch_files files and batch_bytes bytes between them.  A batch
+        is claimed and copied by one rclone, and its results are recorded together.  Rows whose size
+        isn't known, or that are too big, are left on their own.
+        """
+        if not self._batching:
+            yield from rows
+            return
+        max_files = self._batch_files or float("inf")
+        max_bytes = self._batch_bytes or float("inf")
+        group = []
+        parent = None
+        files = size = 0
+        for row in rows:
+            path = row["path"].rstrip("/")
+            # Even an empty directory costs a row
+            row_files = max(1, row["files"] or 0)
+            small = row["files"] is not None and row["bytes"] is not None and "\n" not in path \
+                and not row.get("slice") and row_files <= max_files and row["bytes"] <= max_bytes
+            fits = small and (os.path.dirname(path) == parent or path == parent) \
+                and files + row_files <= max_files and size + row["bytes"] <= max_bytes \
+                and len(group) < self.__MAX_BATCH_ROWS__
+            if group and not fits:
+                yield from self._batch(group)
+                group = []
+            if not small:
+                yield row
+                continue
+            if not group:
+                parent = os.path.dirname(path)
+                files = size = 0
+            group.append(row)
+            files += row_files
+            size += row["bytes"]
+            if path == parent:
+                # A directory comes after everything below it, so nothing else can join.
+                yield from self._batch(group)
+                group = []
+        yield from self._batch(group)
+
+    @staticmethod
+    def _batch(group):
+        if len(group) == 1:
+            yield from group
+            return
+        for row in group:
+            yield {**row, "batch": group[0]["path"]}
+
+    @staticmethod
+    def _batch_filter(members):
+        """
+        rclone filter rules that pick out what the rows of a batch copy, given as (path relative to the
+        directory the batch is copied from, max_depth, slice).
+        """
+        rules = []
+        for path, max_depth, _ in members:
+            escaped = re.sub(r"([\\*?\[\]{}])", r"\\\1", path)
+            directory = f"/{escaped}/" if escaped else "/"
+            rules.append(f"+ {directory}{'*' if max_depth == 1 else '**'}")
+        rules.append("- **")
+        return "\n".join(rules) + "\n"
+
+    def _record_changes(self):
+        """
+        Updates the change index with the signatures of the sources that are done, once every slice
+        of them is.
+        """
+        if self._change_index is None:
+            return
+        with self._tracker_lock:
+            self._change_index.record(self._tracker.execute("""
+                SELECT DISTINCT path, signature
+                FROM sources
+                WHERE done IS NOT NULL
+                AND signature IS NOT NULL
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM sources AS other
+                    WHERE other.path = sources.path
+                    AND other.done IS NULL
+                );
+            """))
+        self._change_index.close()
+
+    def get_summary(self):
+        """Returns (done, pending, pending bytes) for the whole tracker, without counting the sources."""
+        with self._tracker_lock:
+            return self._tracker.execute("""
+                SELECT done, pending, pending_bytes
+                FROM summary;
+            """).fetchone()
+
+    def _reset_metrics(self):
+        """Starts the progress metrics from the tracker's counts."""
+        try:
+            # The crawler counts what it adds while holding the lock, so nothing is counted twice.
+            with self._tracker_lock:
+                done, pending, pending_bytes = self._tracker.execute("""
+                    SELECT done, pending, pending_bytes
+                    FROM summary;
+                """).fetchone()
+                self._metrics.reset(done, pending, pending_bytes)
+            logging.info("%d sources done, %d pending (%d bytes)", done, pending, pending_bytes)
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to count sources")
+
+    def _load_budget(self):
+        """Carries on from what today's earlier runs, and the other processes, on this tracker spent."""
+        if not self._budget.limited:
+            return
+        try:
+            with self._tracker_lock:
+                values = dict(self._tracker.execute("""
+                    SELECT key, value
+                    FROM tracker
+                    WHERE key IN ('budget_day', 'budget_transactions', 'budget_bytes');
+                """))
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to read the budget from tracker database")
+        self._budget.load(values.get("budget_day"), values.get("budget_transactions"), values.get("budget_bytes"))
+
+    def _save_budget(self):
+        """
+        Adds what this process spent since it last saved to today's spending in the tracker, and
+        loads the total back, with what other processes sharing the tracker spent.
+        """
+        if not self._budget.limited:
+            return
+        day, transactions, size = self._budget.take_unsaved()
+        try:
+            with self._tracker_lock:
+                with self._tracker:
+                    # A new day starts from nothing.
+                    self._tracker.execute("""
+                        UPDATE tracker
+                        SET value = 0
+                        WHERE key IN ('budget_transactions', 'budget_bytes')
+                        AND (SELECT value FROM tracker WHERE key = 'budget_day') IS NOT :day;
+                    """, {"day": day})
+                    self._tracker.execute("""
+                        INSERT INTO tracker
+                            ( key, value) VALUES ( 'budget_day', :day )
+                        ON CONFLICT ( key ) DO UPDATE SET
+                            value = excluded.value;
+                    """, {"day": day})
+                    self._tracker.executemany("""
+                        INSERT INTO tracker
+                            ( key, value) VALUES ( ?, ? )
+                        ON CONFLICT ( key ) DO UPDATE SET
+                            value = value + excluded.value;
+                    """, [("budget_transactions", transactions), ("budget_bytes", size)])
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to save the budget to tracker database")
+        self._load_budget()
+
+    def _update_metrics(self):
+        """Refreshes the scheduling metrics, and the status file if there is one."""
+        with self._sleep_lock:
+            backoff = self._sleep_on_cap_exceeded
+        self._metrics.set_scheduling(self._concurrency.limit, self._pause_remaining(), backoff)
+        if self._status_file is not None:
+            self._metrics.write_status(self._status_file)
 
     def resume(self):
         """
-        Resumes the backup/restore process using a thread pool to process sources in parallel.
+        Resumes the backup/restore process using a thread pool, or with the asyncio engine an event
+        loop, to process sources in parallel.
         It is safe to resume an existing backup run. The tracker database maintains the state
         of which sources are completed.
         """
-        # We use a ThreadPoolExecutor to run multiple rclone instances in parallel.
+        # We use a ThreadPoolExecutor (or an EventLoopExecutor) to run multiple rclone instances in parallel.
         # This is safe to run on an existing backup database.
-        with ThreadPoolExecutor(max_workers=self._workers) as executor:
-            while True:
-                with self._interrupt_lock:
-                    if self._interrupt_requested:
-                        logging.info("Interrupt requested, waiting for active workers to finish...")
+        # At most limit sources run at once, and about as many again are claimed ahead of time, so
+        # memory use and the time it takes to stop after an interrupt don't grow with the size of the
+        # tracker.  The limit follows the throughput when the number of workers is "auto".
+        # (source id, source, attempt)
+        queued = deque()
+        # future: (source id, source, attempt, rate shares)
+        in_flight = {}
+        # Sources to try again after a transient failure, as (when, source id, source, attempt)
+        deferred = []
+        started = monotonic()
+        self._reset_metrics()
+        metrics_server = None
+        if self._metrics_port is not None:
+            metrics_server = MetricsServer(self._metrics, self._metrics_port)
+            metrics_server.start()
+        metrics_updated = 0
+        self._load_budget()
+        budget_exhausted = False
+        leases_renewed = monotonic()
+        self._executor.start()
+        self._writer = TrackerWriter(self._tracker, self._tracker_lock, self.__UPDATE_SOURCE__,
+                                     batch_size=self._commit_batch, interval=self._commit_interval, key="id")
+        if self._engine == "asyncio":
+            # The copies are coroutines on one event loop, and an interrupt stops those running.
+            pool = EventLoopExecutor()
+            process_source = self._process_source_async
+        else:
+            pool = ThreadPoolExecutor(max_workers=self._concurrency.maximum)
+            process_source = self._process_source
+        try:
+            with pool as executor:
+                while True:
+                    with self._interrupt_lock:
+                        interrupted = self._interrupt_requested
+                    if interrupted:
+                        if self._engine == "asyncio":
+                            logging.info("Interrupt requested, stopping active workers...")
+                        else:
+                            logging.info("Interrupt requested, waiting for active workers to finish...")
+                        # Get what's finished so far onto disk, in case we're killed while waiting.
+                        self._writer.flush()
                         break
 
-                # Get the next available source that hasn't been completed yet.
-                # We do this one by one to avoid over-fetching if an interrupt occurs.
-                source_id = self.get_tracker_value("next")
-                source = self.get_source_path(source_id)
+                    # Claim the next batch once the workers have drained half of what's claimed.
+                    # Check on the crawler first, so nothing it adds after the claim can be missed.
+                    self._concurrency.update()
+                    limit = self._concurrency.limit
+                    if monotonic() - metrics_updated >= self.__METRICS_SECONDS__:
+                        self._update_metrics()
+                        self._save_budget()
+                        metrics_updated = monotonic()
+                    # Keep hold of what's claimed, and pick up what other processes let go of.
+                    if monotonic() - leases_renewed >= self._lease_seconds / 3:
+                        self._renew_leases()
+                        self._reclaim_expired()
+                        leases_renewed = monotonic()
+                    if self._budget.exhausted():
+                        if not budget_exhausted:
+                            logging.warning("Today's budget is used up, finishing the copies already running")
+                        budget_exhausted = True
+                    crawling = self._crawling()
+                    self._crawl_progress.clear()
+                    # Retries are still claimed, so they go ahead of anything new.
+                    while deferred and deferred[0][0] <= monotonic():
+                        _, source_id, source, attempt = heappop(deferred)
+                        queued.appendleft((source_id, source, attempt))
+                    if len(queued) + len(in_flight) <= limit and not budget_exhausted:
+                        queued.extend((source_id, source, 1) for source_id, *source in
+                                      self.claim_sources(limit * 2 - len(queued) - len(in_flight)))
 
-                if not source:
-                    break
+                    # Nothing new starts while a cap error has everybody paused, or once the budget's
+                    # used up.  Each copy gets its share of the rate limits, sized for the most workers
+                    # there can be, so the first copies don't take it all and keep --workers auto from
+                    # growing while they run.
+                    if not self._pause_remaining() and not budget_exhausted:
+                        while queued and len(in_flight) < limit:
+                            shares = self._rate_shares.acquire(self._concurrency.maximum)
+                            if shares is None:
+                                break
+                            source_id, source, attempt = queued.popleft()
+                            future = executor.submit(process_source, source_id, source, attempt, shares)
+                            in_flight[future] = (source_id, source, attempt, shares)
 
-                # Update 'next' immediately so other workers (if we were fetching in a loop)
-                # or future calls don't pick up the same ID.
-                next_source_id = self.get_next_source_id(source_id)
-                if next_source_id is not None:
-                    self.update_tracker_value("next", next_source_id)
-                else:
-                    # No more sources to process
-                    self.update_tracker_value("next", source_id + 1)
+                    # Wake up for the next retry, and periodically to notice interrupts.
+                    timeout = self.__POLL_SECONDS__
+                    if deferred:
+                        timeout = max(0, min(timeout, deferred[0][0] - monotonic()))
+                    if not in_flight:
+                        if budget_exhausted or (not queued and not crawling and not deferred):
+                            break
+                        # Wait for the crawler to find more sources, or for the pause or a retry to end.
+                        self._crawl_progress.wait(timeout=timeout)
+                        continue
+
+                    finished, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        source_id, source, attempt, shares = in_flight.pop(future)
+                        self._rate_shares.release(shares)
+                        retry_in = future.result()
+                        if retry_in is not None:
+                            heappush(deferred, (monotonic() + retry_in, source_id, source, attempt + 1))
+
+                # Anything that hasn't started yet is dropped, and so are the retries.  They're
+                # recorded as failed, and picked up again by the next run.  With the asyncio engine,
+                # the copies already running are stopped too, and left pending.
+                for future in in_flight:
+                    future.cancel()
+        finally:
+            self._executor.stop()
+            self._update_metrics()
+            self._save_budget()
+            if metrics_server is not None:
+                metrics_server.stop()
+            # Even when a worker failed unexpectedly, what's finished is written, and sources that
+            # were claimed but never processed are handed back, so they're still counted as pending.
+            writer, self._writer = self._writer, None
+            writer.close()
+            self._release_claims()
 
-                # Submit the task to the pool
-                executor.submit(self._process_source, source_id, source)
+        elapsed = monotonic() - started
+        logging.info("Recorded %d results in %.1f seconds (%.1f rows/sec)",
+                     writer.written, elapsed, writer.written / elapsed if elapsed else 0)
+
+        if self._crawler is not None:
+            self._crawler.join()
+        self._record_changes()
+        if self._crawl_error is not None:
+            raise RuntimeError(f"Unable to crawl {self._top_level_sources}") from self._crawl_error
 
         # After the pool shuts down, check for overall status
         failure_count = self.get_failure_count()
-        next_val = self.get_tracker_value("next")
-        has_more = self.get_source_path(next_val) is not None
-        
+        has_more = self.has_pending_sources() or not self.get_tracker_value("crawled")
+        if not has_more and self.has_leased_sources():
+            # The last process to finish archives the tracker.
+            logging.info("Other processes are still working on %s", self._filename)
+            return
+
         if failure_count == 0:
             if not has_more:
                 logging.info("Done rcloning %s", str(self._top_level_sources))
@@ -246,25 +1066,64 @@ class BaseTracker(metaclass=ABCMeta):
             else:
                 logging.info("Interrupted. Some sources failed and some are still pending.")
 
-    def _process_source(self, source_id, source):
-        """Processes a single source directory/file."""
-        with self._interrupt_lock:
-            if self._interrupt_requested:
-                return
+    def _process_source(self, source_id, source, attempt=1, shares=None):
+        """
+        Processes a single source directory/file, within its shares of the rate limits.  Returns
+        the seconds to wait before trying it again, when it failed in a way another attempt might
+        fix, or None.
+        """
+        if not self._wait_for_pause():
+            return None
+        job = self._start_job(source_id, source, shares)
+        try:
+            self._copied(job, self._copy(*job["copy"]))
+        except subprocess.CalledProcessError as exception:
+            self._copy_failed(job, exception, attempt)
+        except ValueError as exception:
+            self._copy_rejected(job, exception)
+        finally:
+            self._finish_job(job)
+        return job["retry_in"]
+
+    async def _process_source_async(self, source_id, source, attempt=1, shares=None):
+        """
+        _process_source() for the asyncio engine.  Waiting out a pause or on rclone doesn't hold a
+        thread, and when it's cancelled, rclone is stopped and nothing is recorded, so the source is
+        released as pending at the end of the run.
+        """
+        if not await self._wait_for_pause_async():
+            return None
+        job = self._start_job(source_id, source, shares)
+        try:
+            self._copied(job, await self._copy_async(*job["copy"]))
+        except subprocess.CalledProcessError as exception:
+            self._copy_failed(job, exception, attempt)
+        except ValueError as exception:
+            self._copy_rejected(job, exception)
+        except asyncio.CancelledError:
+            job["cancelled"] = True
+            raise
+        finally:
+            self._finish_job(job)
+        return job["retry_in"]
+
+    def _start_job(self, source_id, source, shares):
+        """Returns what the processing of a source keeps track of, from the start of its copy."""
+        self._metrics.started()
 
         source_path = source[0].decode("utf-8", errors="backslashreplace")
-        logging.info(f"Processing: {source_path}")
-        
-        rclone_command = [
-            'rclone',
-            'copy',
-            f'{self.source_prefix}{source_path}',
-            f'{self.dest_prefix}{source_path}',
-        ]
-        if self._verbosity >= 1:
-            rclone_command.append(f"-{'v' * self._verbosity}")
+        # A batch records the same result for each of its rows
+        members = source[3] if len(source) > 3 else None
+        if members:
+            logging.info(f"Processing: {source_path} ({len(members)} sources)")
+        else:
+            logging.info(f"Processing: {source_path}")
         
-        logging.debug(" ".join(rclone_command))
+        options = {}
+        max_depth = source[1]
+        if max_depth is not None:
+            options["max-depth"] = max_depth
+        options.update(RateShares.options(shares or {}))
         
         result = {
             "id": source_id,
@@ -275,50 +1134,282 @@ class BaseTracker(metaclass=ABCMeta):
             "stdout": None,
             "stderr": None,
             "failure": None,
+            "bytes_transferred": None,
+            "files_transferred": None,
+            "checks": None,
+            "elapsed": None,
+            "retries": None,
+            "owner": self._owner,
         }
-        
-        try:
-            rclone = subprocess.run(rclone_command, capture_output=True, check=True)
-            logging.debug("stdout:\n" + self._bytes_to_str(rclone.stdout))
-            logging.debug("stderr:\n" + self._bytes_to_str(rclone.stderr))
-            result["done"] = datetime.now(timezone.utc).isoformat()
-            if self._verbosity >= 2:
-                result["args"] = str(rclone.args)
-                result["command_line"] = " ".join(["'" + arg + "'" for arg in rclone.args])
-                result["returncode"] = rclone.returncode
-                result["stdout"] = self._bytes_to_str(rclone.stdout)
-                result["stderr"] = self._bytes_to_str(rclone.stderr)
-        except subprocess.CalledProcessError as exception:
-            runnable_cmd = " ".join([f'"{x}"' for x in exception.cmd])
+        return {
+            "path": source_path,
+            "size": source[2],
+            "members": members,
+            # The arguments of _copy()
+            "copy": (source_path, options, [member[1:] for member in members] if members else None),
+            "result": result,
+            "started": monotonic(),
+            "retry_in": None,
+            "cancelled": False,
+        }
+
+    def _copied(self, job, rclone):
+        result = job["result"]
+        logging.debug("stdout:\n" + self._bytes_to_str(rclone.stdout))
+        logging.debug("stderr:\n" + self._bytes_to_str(rclone.stderr))
+        result["done"] = datetime.now(timezone.utc).isoformat()
+        result.update(self._executor.stats(rclone))
+        # What rclone moved, rather than the size the crawl found, over how long the copy took
+        self._concurrency.record_transfer(result["bytes_transferred"] or 0, monotonic() - job["started"])
+        if self._verbosity >= 2:
+            result["args"] = self._pack(str(rclone.args))
+            result["command_line"] = self._pack(" ".join(["'" + arg + "'" for arg in rclone.args]))
+            result["returncode"] = rclone.returncode
+            result["stdout"] = self._pack(self._bytes_to_str(rclone.stdout))
+            result["stderr"] = self._pack(self._bytes_to_str(rclone.stderr))
+
+    def _copy_failed(self, job, exception, attempt):
+        """Classifies a failed copy, pausing or backing off when another attempt might succeed."""
+        result = job["result"]
+        source_path = job["path"]
+        runnable_cmd = " ".join([f'"{x}"' for x in exception.cmd])
+        error_message = f"\n" \
+                        f"{exception.returncode=}\n" \
+                        f"{exception.cmd=}\n" \
+                        f"{runnable_cmd=}\n" \
+                        f"{exception.output=}\n" \
+                        f"{exception.stdout=}\n" \
+                        f"{exception.stderr=}\n"
+        logging.exception(error_message)
+        retry_in = None
+        kind = classify(exception.returncode, exception.stderr)
+        if kind == CAP:
+            # Pause every worker, rather than letting the others run into the same cap, and
+            # try again once the pause is over.
+            sleep_seconds = self.sleep_on_cap_exceeded
             error_message = f"\n" \
-                            f"{exception.returncode=}\n" \
-                            f"{exception.cmd=}\n" \
-                            f"{runnable_cmd=}\n" \
-                            f"{exception.output=}\n" \
-                            f"{exception.stdout=}\n" \
-                            f"{exception.stderr=}\n"
+                            f"Cap Exceeded. " \
+                            f"Pausing all workers for {sleep_seconds} seconds.\n"
             logging.exception(error_message)
-            cap_error_strings = [
-                b'storage_cap_exceeded',
-                b"transaction_cap_exceeded",
-            ]
-            if any(error_string in exception.stderr for error_string in cap_error_strings):
-                sleep_seconds = self.sleep_on_cap_exceeded
-                error_message = f"\n" \
-                                f"Cap Exceeded. " \
-                                f"Sleeping {sleep_seconds} seconds.\n"
-                logging.exception(error_message)
-                sleep(sleep_seconds)
-            else:
-                self._reset_sleep()
-            result["failure"] = self._bytes_to_str(exception.stderr)
-        finally:
+            self._pause(sleep_seconds)
+            self._concurrency.record_throttle()
+            retry_in = sleep_seconds
+        else:
+            self._reset_sleep()
+            if is_throttled(exception.stderr):
+                self._concurrency.record_throttle()
+            if kind != PERMANENT:
+                retry_in = backoff(attempt, self.__RETRY_SECONDS__, self.__MAX_RETRY_SECONDS__)
+        if attempt >= self._max_attempts:
+            retry_in = None
+        if retry_in is not None:
+            logging.warning("%s failed (%s), trying again in %.0f seconds, attempt %d of %d",
+                            source_path, kind, retry_in, attempt + 1, self._max_attempts)
+        else:
+            logging.error("%s failed (%s) after %d attempts", source_path, kind, attempt)
+        job["retry_in"] = retry_in
+        # Only a summary goes in sources, the whole of stderr is kept with the outputs.
+        stderr = self._bytes_to_str(exception.stderr)
+        result["failure"] = summarize_failure(stderr)
+        result["returncode"] = exception.returncode
+        result["stderr"] = self._pack(stderr)
+        result.update(self._executor.stats(exception))
+
+    def _copy_rejected(self, job, exception):
+        """Fails a source that can't be copied at all, e.g. a slice, without trying it again."""
+        logging.error("%s failed (%s): %s", job["path"], PERMANENT, exception)
+        job["retry_in"] = None
+        job["result"]["failure"] = summarize_failure(str(exception))
+
+    def _finish_job(self, job):
+        """Counts and records the result of a copy, whether it succeeded or not."""
+        result = job["result"]
+        members = job["members"]
+        if job["cancelled"]:
+            self._metrics.requeued()
+            return
+        if result["elapsed"] is None:
+            result["elapsed"] = monotonic() - job["started"]
+        # Every copy lists at least once, besides what it checked and transferred.
+        self._budget.spend(1 + (result["files_transferred"] or 0) + (result["checks"] or 0),
+                           result["bytes_transferred"] or 0)
+        if job["retry_in"] is not None:
+            self._metrics.requeued()
+        else:
+            self._metrics.finished(job["size"], result["bytes_transferred"], failed=result["done"] is None,
+                                   count=len(members) if members else 1)
+        # A failure is recorded even when it's going to be retried, so it isn't lost if the run
+        # stops first.
+        if members:
+            self.update_sources([{**result, "id": member[0]} for member in members])
+        else:
             self.update_source(result)
 
+    def _copy(self, source_path, options, members=None):
+        """
+        Copies one source with the executor, or with members, the (path, max_depth, slice) of the
+        rows of a batch below source_path, just what they cover.  Returns a CompletedProcess, or
+        raises CalledProcessError if the copy failed.
+        """
+        with self._copy_options(source_path, options, members) as copy_options:
+            if copy_options is None:
+                return self._nothing_to_copy(source_path)
+            return self._executor.copy(f'{self.source_prefix}{source_path}',
+                                       f'{self.dest_prefix}{source_path}', copy_options)
+
+    async def _copy_async(self, source_path, options, members=None):
+        """
+        _copy() for the asyncio engine.  Working out what to copy can mean listing and hashing
+        files, so that's done in a thread, to keep the event loop free for the other copies.
+        """
+        manager = self._copy_options(source_path, options, members)
+        copy_options = await asyncio.to_thread(manager.__enter__)
+        try:
+            if copy_options is None:
+                completed = self._nothing_to_copy(source_path)
+            else:
+                completed = await self._executor.copy_async(f'{self.source_prefix}{source_path}',
+                                                            f'{self.dest_prefix}{source_path}', copy_options)
+        except BaseException:
+            manager.__exit__(*sys.exc_info())
+            raise
+        await asyncio.to_thread(manager.__exit__, None, None, None)
+        return completed
+
+    @contextmanager
+    def _copy_options(self, source_path, options, members=None):
+        """
+        Yields the rclone options that copy one source, or just what members cover, the same way as
+        _copy(), or None when there's nothing to copy.  Subclasses can narrow down what's copied.
+        What they do after the yield only happens if the copy succeeded.
+        Only backups list the files of a directory, which slices of it are picked from, so rows with a
+        slice, e.g. from a backup's tracker, are rejected.
+        """
+        if members is None:
+            yield options
+            return
+        if any(slice for _, _, slice in members):
+            raise ValueError(f"Slices of {source_path} can't be copied by a {type(self).__name__}; "
+                             f"only backups are sliced")
+        with tempfile.NamedTemporaryFile(prefix="filter-from-", suffix=".txt") as filter_from:
+            filter_from.write(self._batch_filter(members).encode("utf-8"))
+            filter_from.flush()
+            yield {**options, "filter-from": filter_from.name}
+
+    @staticmethod
+    def _nothing_to_copy(source_path):
+        return subprocess.CompletedProcess(["rclone", "copy", source_path], 0, stdout=b"", stderr=b"")
+
+    def claim_sources(self, count):
+        """
+        Atomically marks up to count unfinished, unclaimed sources as claimed and returns them as
+        (id, path, max_depth, bytes), highest priority first, so they aren't handed out twice, even
+        to other processes working on the same tracker.  The claims are leased to this process
+        until it stops renewing them.
+        The rest of a batch is claimed along with any row of it, and the batch is returned as one
+        (id, path, None, bytes, members) to copy from the directory the rows have in common, with
+        members as (id, path relative to it, max_depth, slice).  A slice of a directory is returned
+        the same way, as the only member.
+        """
+        if count <= 0:
+            return []
+        values = {"claimed": datetime.now(timezone.utc).isoformat(), "count": count, "owner": self._owner,
+                  "lease_expiry": self._lease_expiry()}
+        try:
+            with self._tracker_lock:
+                with self._tracker:
+                    claimed = self._tracker.execute("""
+                        UPDATE sources
+                        SET
+                            claimed = :claimed,
+                            owner = :owner,
+                            lease_expiry = :lease_expiry
+                        WHERE id IN (
+                            SELECT id
+                            FROM sources
+                            WHERE done IS NULL
+                            AND claimed IS NULL
+                            ORDER BY priority DESC, id
+                            LIMIT :count
+                        )
+                        RETURNING id, path, max_depth, bytes, priority, batch, slice;
+                    """, values).fetchall()
+                    for batch in {row[5] for row in claimed if row[5] is not None}:
+                        claimed.extend(self._tracker.execute("""
+                            UPDATE sources
+                            SET
+                                claimed = :claimed,
+                                owner = :owner,
+                                lease_expiry = :lease_expiry
+                            WHERE batch = :batch
+                            AND done IS NULL
+                            AND claimed IS NULL
+                            RETURNING id, path, max_depth, bytes, priority, batch, slice;
+                        """, {**values, "batch": batch}).fetchall())
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to claim sources")
+        jobs = {}
+        for row in claimed:
+            jobs.setdefault(row[5] if row[5] is not None else row[0], []).append(row)
+        jobs = sorted(jobs.values(), key=lambda rows: (-max(row[4] or 0 for row in rows), min(row[0] for row in rows)))
+        return [self._single_job(rows[0]) if len(rows) == 1 else self._batch_job(rows) for rows in jobs]
+
+    @staticmethod
+    def _single_job(row):
+        source_id, path, max_depth, size, _, _, slice = row
+        if slice is None:
+            return source_id, path, max_depth, size
+        return source_id, path, max_depth, size, ((source_id, "", max_depth, slice),)
+
+    def _batch_job(self, rows):
+        rows = sorted(rows)
+        paths = [self._bytes_to_str(row[1]).rstrip("/") for row in rows]
+        directory = os.path.commonpath(paths)
+        members = tuple((row[0], path[len(directory):].lstrip("/"), row[2], row[6]) for row, path in zip(rows, paths))
+        return (rows[0][0], directory.encode("utf-8", errors="backslashreplace"), None,
+                sum(row[3] or 0 for row in rows), members)
+
+    def has_pending_sources(self):
+        with self._tracker_lock:
+            return self._tracker.execute("""
+                SELECT id
+                FROM sources
+                WHERE done IS NULL
+                AND claimed IS NULL
+                LIMIT 1;
+            """).fetchone() is not None
+
+    def has_leased_sources(self):
+        """Whether other processes are still working on sources of this tracker."""
+        with self._tracker_lock:
+            return self._tracker.execute("""
+                SELECT id
+                FROM sources
+                WHERE done IS NULL
+                AND claimed IS NOT NULL
+                AND lease_expiry >= :now
+                AND owner != :owner
+                LIMIT 1;
+            """, {"now": datetime.now(timezone.utc).isoformat(), "owner": self._owner}).fetchone() is not None
+
+    def get_sizes(self):
+        """Returns (path, max_depth, files, bytes) for every source, with the path as a str."""
+        try:
+            with self._tracker_lock:
+                rows = self._tracker.execute("""
+                    SELECT path, max_depth, files, bytes
+                    FROM sources;
+                """).fetchall()
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError("Unable to read sources")
+        return [(self._bytes_to_str(path), *sizes) for path, *sizes in rows]
+
     def get_source_path(self, id):
         with self._tracker_lock:
             return self._tracker.execute("""
-                SELECT path
+                SELECT path, max_depth
                 FROM sources
                 WHERE id = :id;
             """, {"id": id}).fetchone()
@@ -353,25 +1444,48 @@ class BaseTracker(metaclass=ABCMeta):
             raise RuntimeError(f"Unable to update '{key_name}'")
 
     def update_source(self, values):
+        """Records the result of processing a source.  During resume() results are committed in groups."""
+        if self._writer is not None:
+            self._writer.put(values)
+            return
         try:
             with self._tracker_lock:
                 with self._tracker:
-                    self._tracker.execute("""
-                        UPDATE sources
-                        SET
-                            done = :done, 
-                            args = :args, 
-                            command_line = :command_line, 
-                            returncode = :returncode, 
-                            stdout = :stdout, 
-                            stderr = :stderr, 
-                            failure = :failure
-                        WHERE id = :id;
-                    """, values)
+                    for statement in self.__UPDATE_SOURCE__:
+                        self._tracker.execute(statement, values)
         except sqlite3.Error as exception:
             logging.exception(exception)
             raise RuntimeError(f"Unable to update source with id={values['id']}")
 
+    def update_sources(self, results):
+        """Records the results of several sources in one transaction."""
+        if self._writer is not None:
+            self._writer.put(results)
+            return
+        try:
+            with self._tracker_lock:
+                with self._tracker:
+                    for values in results:
+                        for statement in self.__UPDATE_SOURCE__:
+                            self._tracker.execute(statement, values)
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to update sources with ids={[values['id'] for values in results]}")
+
+    def get_output(self, source_id):
+        """Returns what rclone printed for a source, or None if nothing was kept."""
+        with self._tracker_lock:
+            record = self._tracker.execute("""
+                SELECT returncode, args, command_line, stdout, stderr
+                FROM outputs
+                WHERE id = :id;
+            """, {"id": source_id}).fetchone()
+        if record is None:
+            return None
+        returncode, *texts = record
+        return {"returncode": returncode,
+                **dict(zip(("args", "command_line", "stdout", "stderr"), (unpack(text) for text in texts)))}
+
     def get_failures(self):
         with self._tracker_lock:
             return self._tracker.execute("""
@@ -380,15 +1494,6 @@ class BaseTracker(metaclass=ABCMeta):
                 WHERE failure IS NOT NULL;
             """).fetchall()
 
-    def get_next_source_id(self, id):
-        with self._tracker_lock:
-            return self._tracker.execute("""
-                SELECT min(id)
-                FROM sources
-                WHERE id > :id
-                AND done IS NULL;
-            """, {"id": id}).fetchone()[0]
-
     def get_failure_count(self):
         with self._tracker_lock:
             return self._tracker.execute("""
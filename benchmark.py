@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from time import monotonic
+
+from backup import workers_count
+from backup_tracker import BackupTracker
+from base_tracker import BaseTracker
+from restore_tracker import RestoreTracker
+
+REMOTE_NAME = "benchmark"
+
+# Stands in for rclone: waits for BENCHMARK_LATENCY seconds, then pretends to copy, or lists a
+# local directory the way lsjson would.
+FAKE_RCLONE = """\
+import json
+import os
+import sys
+import time
+
+time.sleep(float(os.environ.get("BENCHMARK_LATENCY", "0")))
+args = sys.argv[1:]
+if args[0] == "lsjson":
+    root = args[1].partition(":")[2]
+    max_depth = int(args[args.index("--max-depth") + 1]) if "--max-depth" in args else None
+    if "--recursive" not in args:
+        max_depth = 1
+    entries = []
+    for directory, dirs, files in os.walk(root):
+        relative = os.path.relpath(directory, root)
+        level = 0 if relative == "." else relative.count(os.sep) + 1
+        if max_depth is not None and level >= max_depth:
+            dirs[:] = []
+            continue
+        prefix = "" if relative == "." else relative + "/"
+        entries.extend({"Path": prefix + name, "IsDir": True, "Size": -1} for name in dirs)
+        entries.extend({"Path": prefix + name, "IsDir": False, "Size": os.path.getsize(os.path.join(directory, name))}
+                       for name in files)
+    json.dump(entries, sys.stdout)
+"""
+
+
+class Instrumented:
+    """Mixed into a tracker to time the crawl, the tracker inserts and the rclone calls."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.timings = {
+            "crawl_seconds": None,
+            "rows": 0,
+            "insert_seconds": 0.0,
+            "tasks": 0,
+            "rclone_seconds": 0.0,
+        }
+        self._timings_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+        self._executor = TimedExecutor(self._executor, self)
+
+    def _crawl(self):
+        started = monotonic()
+        super()._crawl()
+        self.timings["crawl_seconds"] = monotonic() - started
+
+    def _insert_sources(self, rows):
+        started = monotonic()
+        super()._insert_sources(rows)
+        self.timings["rows"] += len(rows)
+        self.timings["insert_seconds"] += monotonic() - started
+
+    def record_task(self, seconds):
+        with self._timings_lock:
+            self.timings["tasks"] += 1
+            self.timings["rclone_seconds"] += seconds
+
+
+class TimedExecutor:
+    def __init__(self, executor, tracker) -> None:
+        self._executor = executor
+        self._tracker = tracker
+
+    def start(self):
+        self._executor.start()
+
+    def stop(self):
+        self._executor.stop()
+
+    def copy(self, source, destination, options):
+        started = monotonic()
+        try:
+            return self._executor.copy(source, destination, options)
+        finally:
+            self._tracker.record_task(monotonic() - started)
+
+    def stats(self, completed):
+        return self._executor.stats(completed)
+
+
+class FirstLaunch:
+    """Stands in for the executor when timing startup: notes when the first copy starts, and stops resume()."""
+
+    def __init__(self) -> None:
+        self.launched = None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def copy(self, source, destination, options):
+        if self.launched is None:
+            self.launched = monotonic()
+        with BaseTracker._interrupt_lock:
+            BaseTracker._interrupt_requested = True
+        return subprocess.CompletedProcess(["rclone", "copy", source, destination], 0, stdout=b"", stderr=b"")
+
+    @staticmethod
+    def stats(completed):
+        return {}
+
+
+class InstrumentedBackupTracker(Instrumented, BackupTracker):
+    pass
+
+
+class InstrumentedRestoreTracker(Instrumented, RestoreTracker):
+    pass
+
+
+def make_tree(root, levels, fanout, files_per_dir, min_size, max_size, seed=0):
+    """
+    Creates a directory tree levels deep, where every directory has fanout subdirectories and
+    files_per_dir files.  File sizes are spread evenly on a log scale between min_size and max_size.
+    The files are sparse, so even big trees are quick to make.  Returns (directories, files, bytes).
+    """
+    generator = random.Random(seed)
+    directories = files = total = 0
+    pending = [(root, 0)]
+    while pending:
+        path, level = pending.pop()
+        os.makedirs(path, exist_ok=True)
+        directories += 1
+        for index in range(files_per_dir):
+            size = round(min_size * (max_size / min_size) ** generator.random()) if min_size else \
+                generator.randint(0, max_size)
+            with open(os.path.join(path, f"file{index}.bin"), "wb") as f:
+                f.truncate(size)
+            files += 1
+            total += size
+        if level < levels:
+            pending.extend((os.path.join(path, f"dir{index}"), level + 1) for index in range(fanout))
+    return directories, files, total
+
+
+def install_fake_rclone(directory):
+    """Writes the stand-in rclone to directory, which should go first on the PATH."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "rclone")
+    with open(path, "w") as f:
+        f.write(f"#!{sys.executable}\n" + FAKE_RCLONE)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def run_setting(mode, tree, workdir, depth, workers, options):
+    """
+    Backs up or restores the tree once, with a new tracker, and returns the measurements.
+    Meant to be run in a process of its own, so the peak RSS belongs to this setting alone.
+    """
+    name = f"{mode}-depth{depth}-workers{workers}"
+    tracker_dir = os.path.join(workdir, name)
+    os.makedirs(tracker_dir)
+    os.environ["BENCHMARK_LATENCY"] = str(options["latency"])
+    if options["rclone"] == "fake":
+        os.environ["PATH"] = os.path.join(workdir, "bin") + os.pathsep + os.environ["PATH"]
+    else:
+        # A local remote, configured through the environment
+        os.environ[f"RCLONE_CONFIG_{REMOTE_NAME.upper()}_TYPE"] = "local"
+
+    started = monotonic()
+    if mode == "backup":
+        tracker_class = InstrumentedBackupTracker
+        destination = os.path.join(tracker_dir, "remote") + "/"
+    else:
+        tracker_class = InstrumentedRestoreTracker
+        destination = os.path.join(tracker_dir, "restored")
+    tracker = tracker_class(filename=os.path.join(tracker_dir, "tracker.sqlite3"),
+                            sources=[tree],
+                            remote_name=REMOTE_NAME,
+                            destination=destination,
+                            logdir=os.path.join(tracker_dir, "logs"),
+                            workers=workers,
+                            depth=depth,
+                            non_overlapping=options["non_overlapping"],
+                            executor=options["executor"],
+                            )
+    resume_started = monotonic()
+    tracker.resume()
+    finished = monotonic()
+
+    timings = tracker.timings
+    resume_seconds = finished - resume_started
+    # Worker time that wasn't spent waiting on rclone: claiming, committing and idling.
+    worker_slots = tracker._concurrency.maximum
+    overhead = max(0.0, worker_slots * resume_seconds - timings["rclone_seconds"])
+    return {
+        "mode": mode,
+        "depth": depth,
+        "workers": workers,
+        "rows": timings["rows"],
+        "tasks": timings["tasks"],
+        "crawl_seconds": timings["crawl_seconds"],
+        "insert_rows_per_second": timings["rows"] / timings["insert_seconds"] if timings["insert_seconds"] else None,
+        "scheduling_overhead_per_task": overhead / timings["tasks"] if timings["tasks"] else None,
+        "wall_seconds": finished - started,
+        # Kilobytes on Linux, bytes on macOS
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def make_large_tracker(workdir, rows):
+    """
+    Makes a crawled backup tracker with rows sources besides the crawled one, every other one of
+    them done, as if a big backup had been interrupted half way.  Returns its filename.
+    """
+    empty = os.path.join(workdir, "empty")
+    os.makedirs(empty, exist_ok=True)
+    filename = os.path.join(workdir, "large.sqlite3")
+    tracker = BackupTracker(filename=filename, sources=[empty], remote_name=REMOTE_NAME, destination="",
+                            logdir=os.path.join(workdir, "logs"))
+    tracker._crawler.join()
+    done = datetime.now(timezone.utc).isoformat()
+    with tracker._tracker:
+        tracker._tracker.executemany("""
+            INSERT INTO sources
+                ( id, path, done, bytes, priority) VALUES ( ?, ?, ?, ?, 0 );
+        """, ((source_id, f"/large/dir{source_id}".encode(), None if source_id % 2 else done, 1024)
+              for source_id in range(1, rows + 1)))
+    tracker._tracker.close()
+    return filename
+
+
+def run_startup(filename, logdir):
+    """
+    Times opening an existing tracker and resuming it, up to the first copy.  Like run_setting(),
+    meant to be run in a process of its own.
+    """
+    started = monotonic()
+    tracker = BackupTracker(filename=filename, sources=["/large"], remote_name=REMOTE_NAME, destination="",
+                            logdir=logdir)
+    opened = monotonic()
+    executor = tracker._executor = FirstLaunch()
+    try:
+        tracker.resume()
+    finally:
+        with BaseTracker._interrupt_lock:
+            BaseTracker._interrupt_requested = False
+    done, pending, _ = tracker.get_summary()
+    tracker._tracker.close()
+    return {
+        "rows": done + pending,
+        "open_seconds": opened - started,
+        "startup_seconds": executor.launched - started if executor.launched is not None else None,
+    }
+
+
+def run(args):
+    """Runs every combination of mode, depth and workers, and returns the results document."""
+    started = datetime.now(timezone.utc).isoformat()
+    workdir = tempfile.mkdtemp(prefix="rclone_backups_benchmark_")
+    try:
+        tree = os.path.join(workdir, "tree")
+        directories, files, total = make_tree(tree, args.levels, args.fanout, args.files_per_dir,
+                                              args.min_size, args.max_size, seed=args.seed)
+        logging.info("Made %d directories with %d files, %d bytes", directories, files, total)
+        if args.rclone == "fake":
+            install_fake_rclone(os.path.join(workdir, "bin"))
+
+        options = {
+            "latency": args.latency,
+            "rclone": args.rclone,
+            "non_overlapping": args.non_overlapping,
+            "executor": args.executor,
+        }
+        modes = ["backup", "restore"] if args.mode == "both" else [args.mode]
+        results = []
+        # A fresh process for each setting, so none of them inherits another's memory or threads.
+        context = multiprocessing.get_context("spawn")
+        for mode in modes:
+            for depth in args.depths:
+                for workers in args.workers:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                        result = pool.submit(run_setting, mode, tree, workdir, depth, workers, options).result()
+                    logging.info(format_result(result))
+                    results.append(result)
+
+        startup = None
+        if args.startup_rows:
+            filename = make_large_tracker(workdir, args.startup_rows)
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                startup = pool.submit(run_startup, filename, os.path.join(workdir, "logs")).result()
+            logging.info(format_startup(startup))
+    finally:
+        if args.keep:
+            logging.info("Kept %s", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "started": started,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tree": {
+            "levels": args.levels,
+            "fanout": args.fanout,
+            "files_per_dir": args.files_per_dir,
+            "min_size": args.min_size,
+            "max_size": args.max_size,
+            "seed": args.seed,
+            "directories": directories,
+            "files": files,
+            "bytes": total,
+        },
+        "options": options,
+        "results": results,
+        "startup": startup,
+    }
+
+
+def format_result(result):
+    def number(value, digits=3):
+        return "-" if value is None else f"{value:.{digits}f}"
+
+    return (f"{result['mode']:7} depth={result['depth']} workers={result['workers']}: "
+            f"{result['rows']} rows, crawl {number(result['crawl_seconds'])}s, "
+            f"insert {number(result['insert_rows_per_second'], 0)} rows/s, "
+            f"overhead {number(result['scheduling_overhead_per_task'], 4)}s/task, "
+            f"wall {number(result['wall_seconds'])}s, peak RSS {result['peak_rss']}")
+
+
+def format_startup(startup):
+    return (f"startup: {startup['rows']} rows, opened in {startup['open_seconds']:.3f}s, "
+            f"first copy after {startup['startup_seconds']:.3f}s")
+
+
+def compare(previous, current):
+    """Returns a line for each setting in both runs, with the change in wall time and peak RSS."""
+    def key(result):
+        return result["mode"], result["depth"], str(result["workers"])
+
+    before = {key(result): result for result in previous["results"]}
+    lines = []
+    for result in current["results"]:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        changes = []
+        for field in ("crawl_seconds", "wall_seconds", "peak_rss"):
+            if old[field] and result[field] is not None:
+                changes.append(f"{field} {(result[field] - old[field]) / old[field]:+.1%}")
+        lines.append(f"{result['mode']:7} depth={result['depth']} workers={result['workers']}: " + ", ".join(changes))
+    old, new = previous.get("startup"), current.get("startup")
+    if old and new and old["startup_seconds"] and new["startup_seconds"] is not None:
+        lines.append(f"startup: {old['rows']} -> {new['rows']} rows, "
+                     f"startup_seconds {(new['startup_seconds'] - old['startup_seconds']) / old['startup_seconds']:+.1%}")
+    return lines
+
+
+def integer_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def workers_list(value):
+    return [workers_count(item) for item in value.split(",")]
+
+
+def command_line():
+    parser = argparse.ArgumentParser(
+        description="Times backups and restores of a synthetic directory tree, against a stand-in for rclone "
+                    "or a local rclone remote.")
+    parser.add_argument("-v", "--verbose", help="Log more", action="store_true")
+    parser.add_argument("--levels", help="Levels of subdirectories in the tree", type=int, default=3)
+    parser.add_argument("--fanout", help="Subdirectories in each directory", type=int, default=4)
+    parser.add_argument("--files-per-dir", help="Files in each directory", type=int, default=10)
+    parser.add_argument("--min-size", help="Smallest file, in bytes", type=int, default=1)
+    parser.add_argument("--max-size", help="Biggest file, in bytes", type=int, default=2 ** 20)
+    parser.add_argument("--seed", help="Seed for the file sizes", type=int, default=0)
+    parser.add_argument("--mode", choices=["backup", "restore", "both"], default="backup")
+    parser.add_argument("--depths", help="Comma separated --depth values to run", type=integer_list,
+                        default=[0, 1, 2])
+    parser.add_argument("--workers", help="Comma separated --workers values to run", type=workers_list,
+                        default=[4])
+    parser.add_argument("--non-overlapping", action="store_true")
+    parser.add_argument("--rclone", help="Use a stand-in for rclone (fake), or rclone with a local remote (real)",
+                        choices=["fake", "real"], default="fake")
+    parser.add_argument("--executor", help="Passed on to the tracker; the stand-in only supports subprocess",
+                        choices=["subprocess", "rcd"], default="subprocess")
+    parser.add_argument("--latency", help="Seconds the stand-in for rclone takes for each call", type=float,
+                        default=0.05)
+    parser.add_argument("--startup-rows", help="Rows in the tracker used to time how long a resume takes to start "
+                                               "its first copy, or 0 to skip it", type=int, default=5_000_000)
+    parser.add_argument("--output", help="Where to write the results, as JSON")
+    parser.add_argument("--compare", help="Results of an earlier run to compare with")
+    parser.add_argument("--keep", help="Keep the tree and trackers afterwards", action="store_true")
+    args = parser.parse_args()
+    if args.rclone == "fake" and args.executor != "subprocess":
+        parser.error("the stand-in for rclone only supports --executor subprocess")
+    return args
+
+
+def main():
+    args = command_line()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    results = run(args)
+    for result in results["results"]:
+        print(format_result(result))
+    if results["startup"]:
+        print(format_startup(results["startup"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print(f"\nCompared with {args.compare}:")
+        for line in compare(previous, results):
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
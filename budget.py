@@ -0,0 +1,121 @@
+import threading
+from datetime import datetime, timezone
+
+
+class RateShares:
+    """
+    Divides a transactions/sec and a bytes/sec limit between the copies running at once, as the
+    --tpslimit and --bwlimit of each.  rclone enforces each share with a token bucket of its own;
+    what's shared here is the capacity, which is handed out as copies start and returned as they
+    finish, so the shares never add up to more than the limits.
+    """
+
+    def __init__(self, tps_limit=None, bw_limit=None) -> None:
+        self._limits = {"tpslimit": tps_limit, "bwlimit": bw_limit}
+        self._allocated = {name: 0 for name in self._limits}
+        self._lock = threading.Lock()
+
+    @property
+    def limited(self):
+        return any(self._limits.values())
+
+    def acquire(self, slots):
+        """
+        Returns the shares for a copy about to start, as {"tpslimit": ..., "bwlimit": ...}, given
+        that up to slots copies may run at once.  Returns None if what's left is too little to
+        start another, until release() gives some back.
+        """
+        with self._lock:
+            shares = {}
+            for name, limit in self._limits.items():
+                if not limit:
+                    continue
+                share = min(limit / max(1, slots), limit - self._allocated[name])
+                # Much less than a fair share would only make a slow copy; wait for a bigger one.
+                if share < limit / max(1, slots) / 2:
+                    return None
+                shares[name] = share
+            for name, share in shares.items():
+                self._allocated[name] += share
+            return shares
+
+    def release(self, shares):
+        with self._lock:
+            for name, share in shares.items():
+                self._allocated[name] = max(0, self._allocated[name] - share)
+
+    @staticmethod
+    def options(shares):
+        """The rclone flags for the shares: a bare --bwlimit is KiB/s, so it's given in bytes."""
+        options = {}
+        if "tpslimit" in shares:
+            options["tpslimit"] = f"{shares['tpslimit']:.3f}"
+        if "bwlimit" in shares:
+            options["bwlimit"] = f"{int(shares['bwlimit'])}B"
+        return options
+
+
+class DailyBudget:
+    """
+    Counts the transactions and bytes spent today (UTC, when B2's daily caps reset) against a
+    budget.  The tracker keeps what's been spent, so a resumed run carries on from there.  Every
+    process sharing the tracker adds what it spent to it, and loads what they all spent back.
+    """
+
+    def __init__(self, transactions=None, size=None, today=None) -> None:
+        self._limits = (transactions, size)
+        self._today = today or (lambda: datetime.now(timezone.utc).date().toordinal())
+        self._lock = threading.Lock()
+        self._day = self._today()
+        self._spent = [0, 0]
+        # Spent since it was last taken to be saved
+        self._unsaved = [0, 0]
+
+    @property
+    def limited(self):
+        return any(self._limits)
+
+    def load(self, day, transactions, size):
+        """
+        Carries on from what was spent, if it was spent today, along with what this process has
+        spent since it was last taken.
+        """
+        with self._lock:
+            self._roll()
+            if day == self._day:
+                self._spent = [(transactions or 0) + self._unsaved[0], (size or 0) + self._unsaved[1]]
+            else:
+                self._spent = list(self._unsaved)
+
+    def state(self):
+        """Returns (day, transactions, bytes) spent so far."""
+        with self._lock:
+            self._roll()
+            return self._day, *self._spent
+
+    def take_unsaved(self):
+        """Returns (day, transactions, bytes) spent since the last call, to add to the tracker."""
+        with self._lock:
+            self._roll()
+            unsaved, self._unsaved = self._unsaved, [0, 0]
+            return self._day, *unsaved
+
+    def spend(self, transactions, size):
+        with self._lock:
+            self._roll()
+            self._spent[0] += transactions
+            self._spent[1] += size
+            self._unsaved[0] += transactions
+            self._unsaved[1] += size
+
+    def exhausted(self):
+        with self._lock:
+            self._roll()
+            return any(limit is not None and spent >= limit for limit, spent in zip(self._limits, self._spent))
+
+    def _roll(self):
+        today = self._today()
+        if today != self._day:
+            self._day = today
+            self._spent = [0, 0]
+            self._unsaved = [0, 0]
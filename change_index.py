@@ -0,0 +1,94 @@
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class ChangeIndex:
+    """
+    Remembers a signature for each directory that was backed up successfully, so the next run can
+    leave out the ones that haven't changed since.  It lives in its own database because trackers
+    are archived at the end of every run.  Signatures are kept for each target, the remote and
+    destination a directory was backed up to, so a new target still gets everything.
+    """
+
+    def __init__(self, filename, target) -> None:
+        self._filename = filename
+        self._target = target
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._index is None:
+            self._index = sqlite3.connect(database=self._filename, check_same_thread=False)
+            try:
+                with self._index:
+                    columns = [column[1] for column in
+                               self._index.execute("PRAGMA table_info(directories);").fetchall()]
+                    if columns and "target" not in columns:
+                        # Nothing says which target those were backed up to, so everything is copied once more.
+                        logging.info("Dropping the signatures in %s, which aren't kept per target",
+                                     self._filename)
+                        self._index.execute("DROP TABLE directories;")
+                    self._index.execute("""
+                        CREATE TABLE IF NOT EXISTS directories (
+                            target               text NOT NULL    ,
+                            path                 text NOT NULL    ,
+                            signature            text NOT NULL    ,
+                            updated              timestamp        ,
+                            PRIMARY KEY ( target, path )
+                         );
+                    """)
+            except sqlite3.Error as exception:
+                logging.exception(exception)
+                raise RuntimeError(f"Unable to open change index {self._filename}")
+        return self._index
+
+    @staticmethod
+    def _key(path):
+        if isinstance(path, str):
+            return path.encode("utf-8", errors="backslashreplace")
+        return path
+
+    def unchanged(self, path, signature):
+        """Whether path had this signature when it was last backed up successfully."""
+        if signature is None:
+            return False
+        try:
+            with self._lock:
+                record = self._connect().execute("""
+                    SELECT signature
+                    FROM directories
+                    WHERE target = :target
+                    AND path = :path;
+                """, {"target": self._target, "path": self._key(path)}).fetchone()
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to read change index {self._filename}")
+        return record is not None and record[0] == signature
+
+    def record(self, directories):
+        """Stores the signatures of directories that were backed up, as (path, signature)."""
+        updated = datetime.now(timezone.utc).isoformat()
+        try:
+            with self._lock:
+                index = self._connect()
+                with index:
+                    index.executemany("""
+                        INSERT INTO directories
+                            ( target, path, signature, updated) VALUES ( :target, :path, :signature, :updated )
+                        ON CONFLICT ( target, path ) DO UPDATE SET
+                            signature = excluded.signature,
+                            updated = excluded.updated;
+                    """, ({"target": self._target, "path": self._key(path), "signature": signature,
+                           "updated": updated}
+                          for path, signature in directories))
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to update change index {self._filename}")
+
+    def close(self):
+        with self._lock:
+            if self._index is not None:
+                self._index.close()
+                self._index = None
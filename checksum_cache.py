@@ -0,0 +1,157 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+def list_files(directory, recursive=True):
+    """Yields (name relative to directory, path, stat) for the regular files rclone would copy."""
+    pending = [directory]
+    while pending:
+        listing = pending.pop()
+        try:
+            with os.scandir(listing) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            pending.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield os.path.relpath(entry.path, directory), entry.path, entry.stat(follow_symlinks=False)
+        except OSError as exception:
+            # rclone reports what it can't read
+            logging.debug("Unable to list %s: %s", listing, exception)
+
+
+class ChecksumCache:
+    """
+    Remembers the (inode, size, mtime) and SHA-1 of every file that was backed up successfully, so
+    a file whose stat hasn't changed is never read again, and one that was only touched isn't copied
+    again.  Like the change index, it lives in its own database because trackers are archived at the
+    end of every run, and files are remembered for each target they were backed up to.
+    """
+
+    __BUSY_SECONDS__ = 60
+    __CHUNK_BYTES__ = 1024 * 1024
+
+    def __init__(self, filename, target) -> None:
+        self._filename = filename
+        self._target = target
+        self._cache = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._cache is None:
+            self._cache = sqlite3.connect(database=self._filename, timeout=self.__BUSY_SECONDS__,
+                                          check_same_thread=False)
+            try:
+                with self._cache:
+                    columns = [column[1] for column in self._cache.execute("PRAGMA table_info(files);").fetchall()]
+                    if columns and "target" not in columns:
+                        # Nothing says which target those were backed up to, so they're all hashed again.
+                        logging.info("Dropping the files in %s, which aren't kept per target", self._filename)
+                        self._cache.execute("DROP TABLE files;")
+                    self._cache.execute("""
+                        CREATE TABLE IF NOT EXISTS files (
+                            target               text NOT NULL  ,
+                            path                 blob NOT NULL  ,
+                            inode                integer  ,
+                            size                 bigint   ,
+                            mtime_ns             bigint   ,
+                            hash                 text     ,
+                            updated              timestamp,
+                            PRIMARY KEY ( target, path )
+                         );
+                    """)
+            except sqlite3.Error as exception:
+                logging.exception(exception)
+                raise RuntimeError(f"Unable to open checksum cache {self._filename}")
+        return self._cache
+
+    def _known(self, directory):
+        """Returns {path: (inode, size, mtime_ns, hash)} for the files recorded below directory."""
+        prefix = os.fsencode(directory.rstrip("/") + "/")
+        try:
+            with self._lock:
+                rows = self._connect().execute("""
+                    SELECT path, inode, size, mtime_ns, hash
+                    FROM files
+                    WHERE target = :target
+                    AND path >= :lower
+                    AND path < :upper;
+                """, {"target": self._target, "lower": prefix, "upper": prefix[:-1] + b"0"}).fetchall()
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to read checksum cache {self._filename}")
+        return {path: tuple(record) for path, *record in rows}
+
+    @classmethod
+    def file_hash(cls, path):
+        """Returns the SHA-1 of a file, the hash B2 keeps, or None if it can't be read."""
+        digest = hashlib.sha1()
+        try:
+            with open(path, "rb") as f:
+                while chunk := f.read(cls.__CHUNK_BYTES__):
+                    digest.update(chunk)
+        except OSError as exception:
+            logging.debug("Unable to hash %s: %s", path, exception)
+            return None
+        return digest.hexdigest()
+
+    def changed(self, directory, recursive=True, select=None):
+        """
+        Returns (names, records): the files below directory, relative to it, that are new or whose
+        contents changed since they were recorded, and what to record() once they're copied.  Only
+        files whose stat changed are hashed, and with select, only the names it accepts are looked
+        at.  Returns None if a name can't be given to rclone in a --files-from-raw list.
+        """
+        known = self._known(directory)
+        names = []
+        records = []
+        for name, path, stat in list_files(directory, recursive):
+            if select is not None and not select(name):
+                continue
+            key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            record = known.get(os.fsencode(path))
+            if record is not None and record[:3] == key:
+                continue
+            digest = self.file_hash(path)
+            if digest is None or record is None or record[3] != digest:
+                if "\n" in name:
+                    return None
+                names.append(name)
+            if digest is not None:
+                records.append((path, *key, digest))
+        return names, records
+
+    def record(self, records):
+        """Stores (path, inode, size, mtime_ns, hash) for files that were backed up."""
+        updated = datetime.now(timezone.utc).isoformat()
+        try:
+            with self._lock:
+                cache = self._connect()
+                with cache:
+                    cache.executemany("""
+                        INSERT INTO files
+                            ( target, path, inode, size, mtime_ns, hash, updated)
+                        VALUES
+                            ( :target, :path, :inode, :size, :mtime_ns, :hash, :updated )
+                        ON CONFLICT ( target, path ) DO UPDATE SET
+                            inode = excluded.inode,
+                            size = excluded.size,
+                            mtime_ns = excluded.mtime_ns,
+                            hash = excluded.hash,
+                            updated = excluded.updated;
+                    """, ({"target": self._target, "path": os.fsencode(path), "inode": inode, "size": size, "mtime_ns": mtime_ns,
+                           "hash": digest, "updated": updated}
+                          for path, inode, size, mtime_ns, digest in records))
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to update checksum cache {self._filename}")
+
+    def close(self):
+        with self._lock:
+            if self._cache is not None:
+                self._cache.close()
+                self._cache = None
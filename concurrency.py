@@ -0,0 +1,91 @@
+import logging
+import threading
+from time import monotonic
+
+
+class AdaptiveConcurrency:
+    """
+    Decides how many rclone jobs should run at once.
+
+    Every interval seconds the aggregate throughput is compared with the previous interval: while it
+    keeps rising another worker is added, and when it drops one is taken away.  The throughput is
+    what each worker moved while copying, from the jobs that finished in the interval, times the
+    number of workers, so it doesn't depend on when the big copies happen to finish.  After measuring a
+    baseline one extra worker is always tried, to find out whether more would help.  Throttling (cap
+    or rate limit errors) halves the number of workers straight away.  With minimum == maximum the
+    limit never changes.
+    """
+
+    __TOLERANCE__ = 0.05
+
+    def __init__(self, minimum, maximum, interval=30, clock=monotonic) -> None:
+        if minimum < 1 or maximum < minimum:
+            raise ValueError(f"Invalid worker bounds: {minimum=} {maximum=}")
+        self._minimum = minimum
+        self._maximum = maximum
+        self._interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._limit = minimum
+        self._window_start = clock()
+        self._window_bytes = 0
+        self._window_seconds = 0
+        self._last_rate = None
+
+    @property
+    def adaptive(self):
+        return self._minimum != self._maximum
+
+    @property
+    def maximum(self):
+        return self._maximum
+
+    @property
+    def limit(self):
+        with self._lock:
+            return self._limit
+
+    def record_transfer(self, size, seconds):
+        """Counts the bytes a finished job transferred, and how long it took, towards the current interval."""
+        with self._lock:
+            self._window_bytes += size
+            self._window_seconds += seconds
+
+    def record_throttle(self):
+        """Halves the number of workers after a cap or rate limit error."""
+        with self._lock:
+            if not self.adaptive:
+                return
+            limit = max(self._minimum, self._limit // 2)
+            if limit != self._limit:
+                logging.info("Throttled, reducing workers from %d to %d", self._limit, limit)
+                self._limit = limit
+            # Measure a fresh baseline before growing again
+            self._start_window(rate=None)
+
+    def update(self):
+        """Adjusts the limit once per interval, based on how the throughput changed."""
+        with self._lock:
+            elapsed = self._clock() - self._window_start
+            if elapsed < self._interval:
+                return
+            if not self._window_seconds:
+                # Nothing has finished, which says nothing about the throughput, so keep measuring.
+                return
+            rate = self._window_bytes / self._window_seconds * self._limit
+            last_rate = self._last_rate
+            self._start_window(rate=rate)
+            if not self.adaptive:
+                return
+            if (last_rate is None or rate > last_rate * (1 + self.__TOLERANCE__)) and self._limit < self._maximum:
+                self._limit += 1
+                logging.info("Throughput at %.0f bytes/sec, increasing workers to %d", rate, self._limit)
+            elif last_rate is not None and rate < last_rate * (1 - self.__TOLERANCE__) and self._limit > self._minimum:
+                self._limit -= 1
+                logging.info("Throughput fell to %.0f bytes/sec, reducing workers to %d", rate, self._limit)
+
+    def _start_window(self, rate):
+        self._window_start = self._clock()
+        self._window_bytes = 0
+        self._window_seconds = 0
+        self._last_rate = rate
@@ -0,0 +1,95 @@
+import logging
+import queue
+import threading
+
+
+class Prefetcher:
+    """
+    Runs function(*key) on an executor ahead of when the results are needed, so a walk that has to
+    visit directories in a fixed order can still list many of them at once.  At most lookahead
+    results are submitted or waiting to be collected at any time; past that, get() just runs the
+    function itself.
+    """
+
+    def __init__(self, executor, function, lookahead=1024) -> None:
+        self._executor = executor
+        self._function = function
+        self._lookahead = lookahead
+        self._futures = {}
+
+    def prefetch(self, keys):
+        for key in keys:
+            if len(self._futures) >= self._lookahead:
+                return
+            if key not in self._futures:
+                self._futures[key] = self._executor.submit(self._function, *key)
+
+    def get(self, key):
+        future = self._futures.pop(key, None)
+        if future is None or future.cancelled():
+            return self._function(*key)
+        return future.result()
+
+    def cancel(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+
+
+def merge(iterables, buffer_size=1000):
+    """
+    Yields the items of several iterables as they're produced, iterating each one on a thread of its
+    own.  The items of any one iterable keep their order.  Closing the generator stops the threads.
+    """
+    iterables = list(iterables)
+    if len(iterables) == 1:
+        yield from iterables[0]
+        return
+
+    items = queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
+    finished = object()
+
+    def produce(iterable):
+        try:
+            for item in iterable:
+                if not _put(items, (None, item), stopped):
+                    return
+        except Exception as exception:
+            _put(items, (exception, None), stopped)
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+            _put(items, (None, finished), stopped)
+
+    threads = [threading.Thread(target=produce, args=(iterable,), name=f"crawler-{index}", daemon=True)
+               for index, iterable in enumerate(iterables)]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = len(threads)
+        while remaining:
+            exception, item = items.get()
+            if exception is not None:
+                raise exception
+            if item is finished:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+        logging.debug("Stopped %d crawler threads", len(threads))
+
+
+def _put(items, item, stopped):
+    """Puts item on the queue unless the consumer has gone away; returns whether it did."""
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
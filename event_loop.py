@@ -0,0 +1,42 @@
+import asyncio
+import threading
+
+
+class EventLoopExecutor:
+    """
+    Runs coroutine functions on an event loop in a thread of its own.  submit() hands back a
+    concurrent.futures.Future, like a ThreadPoolExecutor's, so resume() schedules copies the same way
+    with either, but a copy that's waiting on rclone or out a pause doesn't hold a thread, and
+    cancelling its future stops it, even once it's started.  Leaving the with block cancels whatever
+    is still running and waits for it to clean up.
+    """
+
+    def __init__(self) -> None:
+        self._loop = None
+        self._thread = None
+
+    def __enter__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="event-loop", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self._cancel_all(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.run_until_complete(self._loop.shutdown_default_executor())
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+        return False
+
+    def submit(self, function, *args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(function(*args, **kwargs), self._loop)
+
+    @staticmethod
+    async def _cancel_all():
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,347 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import secrets
+import socket
+import subprocess
+import urllib.error
+import urllib.request
+from time import monotonic, sleep
+
+
+# rclone logs this each time it starts a copy over
+RETRY_PATTERN = re.compile(r"Attempt \d+/\d+ failed")
+
+
+def stats_columns(stats, retries):
+    """Picks the tracker's transfer columns out of rclone's stats."""
+    if stats is None:
+        return {}
+    return {
+        "bytes_transferred": stats.get("bytes"),
+        "files_transferred": stats.get("transfers"),
+        "checks": stats.get("checks"),
+        "elapsed": stats.get("elapsedTime"),
+        "retries": retries,
+    }
+
+
+class StatsReader:
+    """Follows the stats and the retries in rclone's JSON log, one line at a time."""
+
+    def __init__(self) -> None:
+        self.stats = None
+        self.retries = 0
+
+    def feed(self, line):
+        if not line.startswith(b"{"):
+            return
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return
+        if "stats" in record:
+            self.stats = record["stats"]
+        if RETRY_PATTERN.search(record.get("msg", "")):
+            self.retries += 1
+
+    @property
+    def columns(self):
+        return stats_columns(self.stats, self.retries)
+
+
+class SubprocessExecutor:
+    """Runs each rclone copy in a process of its own."""
+
+    # Log as JSON, with the stats at the default log level, so the final stats can be read from stderr
+    __STATS_FLAGS__ = ["--use-json-log", "--stats-log-level", "NOTICE", "--stats-one-line"]
+    __CHUNK_BYTES__ = 64 * 1024
+    # How long a cancelled rclone gets to exit before it's killed
+    __TERMINATE_SECONDS__ = 5
+
+    def __init__(self, verbosity=0, max_output_bytes=64 * 1024) -> None:
+        self._verbosity = verbosity
+        self._max_output_bytes = max_output_bytes
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def copy(self, source, destination, options):
+        """
+        Copies source to destination, passing options as rclone flags, e.g. {"max-depth": 1}, with True
+        for flags that take no value.
+        Returns a CompletedProcess, or raises CalledProcessError if the copy failed.
+        """
+        return subprocess.run(self._command(source, destination, options), capture_output=True, check=True)
+
+    async def copy_async(self, source, destination, options):
+        """
+        copy() for the asyncio engine.  The output is read as it comes, and only the stats and the
+        last max_output_bytes of it are kept, however much rclone logs.  If the copy is cancelled,
+        rclone is terminated, and killed if it doesn't exit.
+        """
+        rclone_command = self._command(source, destination, options)
+        # In a session of its own, so a Ctrl-C doesn't reach rclone and fail the copy: it's cancelled instead.
+        process = await asyncio.create_subprocess_exec(*rclone_command, stdin=subprocess.DEVNULL,
+                                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                       start_new_session=True)
+        reader = StatsReader()
+        stdout = bytearray()
+        stderr = bytearray()
+        try:
+            await asyncio.gather(self._follow(process.stdout, stdout),
+                                 self._follow(process.stderr, stderr, reader))
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                logging.debug("Stopping rclone %d", process.pid)
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), self.__TERMINATE_SECONDS__)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+            raise
+        if returncode:
+            completed = subprocess.CalledProcessError(returncode, rclone_command, output=bytes(stdout),
+                                                      stderr=bytes(stderr))
+        else:
+            completed = subprocess.CompletedProcess(rclone_command, returncode, stdout=bytes(stdout),
+                                                    stderr=bytes(stderr))
+        # The stats may not be in what's left of stderr.
+        completed.columns = reader.columns
+        if returncode:
+            raise completed
+        return completed
+
+    async def _follow(self, stream, tail, reader=None):
+        """Reads a stream to the end, keeping its last max_output_bytes in tail, and feeding reader lines."""
+        partial = b""
+        while chunk := await stream.read(self.__CHUNK_BYTES__):
+            tail.extend(chunk)
+            if len(tail) > self._max_output_bytes:
+                del tail[:len(tail) - self._max_output_bytes]
+            if reader is None:
+                continue
+            *lines, partial = (partial + chunk).split(b"\n")
+            for line in lines:
+                reader.feed(line)
+            if len(partial) > self._max_output_bytes:
+                # Too long to be a stats record
+                partial = b""
+        if reader is not None and partial:
+            reader.feed(partial)
+
+    def _command(self, source, destination, options):
+        rclone_command = [
+            'rclone',
+            'copy',
+            source,
+            destination,
+        ]
+        for name, value in options.items():
+            if value is True:
+                rclone_command.append(f"--{name}")
+            else:
+                rclone_command.extend([f"--{name}", str(value)])
+        rclone_command.extend(self.__STATS_FLAGS__)
+        if self._verbosity >= 1:
+            rclone_command.append(f"-{'v' * self._verbosity}")
+
+        logging.debug(" ".join(rclone_command))
+        return rclone_command
+
+    @staticmethod
+    def stats(completed):
+        """
+        Returns the transfer columns from the last stats rclone logged, given what copy() or
+        copy_async() returned or raised, or {} if there weren't any.
+        """
+        columns = getattr(completed, "columns", None)
+        if isinstance(columns, dict):
+            # Read as it was streamed
+            return columns
+        reader = StatsReader()
+        for line in (completed.stderr or b"").splitlines():
+            reader.feed(line)
+        return reader.columns
+
+
+class RcdExecutor:
+    """
+    Sends every copy to one long-lived `rclone rcd`, through its remote control API, so the config
+    is loaded, the remotes are authenticated and the connections are warmed up only once.
+    Jobs are started with _async and then polled until they finish.
+    """
+
+    __STARTUP_SECONDS__ = 30
+    __POLL_SECONDS__ = 0.5
+    # How long a call waits for the rcd, so a stalled one fails the copy rather than hanging its worker
+    __CALL_SECONDS__ = 30
+    # What `rclone copy` exits with for an error not otherwise categorised, so failures are sorted by their message
+    __RETURNCODE__ = 1
+    # rclone flags and the rc parameters that set them for a single job
+    __OPTIONS__ = {
+        "max-depth": ("_config", "MaxDepth"),
+        "no-traverse": ("_config", "NoTraverse"),
+        "files-from-raw": ("_filter", "FilesFromRaw"),
+        "filter-from": ("_filter", "FilterFrom"),
+    }
+    # Filter options that are lists in rc, though the flag is given once
+    __LIST_OPTIONS__ = {"files-from-raw", "filter-from"}
+
+    def __init__(self, verbosity=0, url=None, user=None, password=None, tps_limit=None, bw_limit=None) -> None:
+        self._verbosity = verbosity
+        # Every job runs in the one process, so it's given the whole of the limits
+        self._tps_limit = tps_limit
+        self._bw_limit = bw_limit
+        self._url = url
+        self._user = user
+        self._password = password
+        self._rcd = None
+
+    def start(self):
+        if self._url is not None:
+            return
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        self._url = f"http://127.0.0.1:{port}/"
+        self._user = "rclone_backups"
+        self._password = secrets.token_urlsafe(16)
+        rcd_command = [
+            "rclone",
+            "rcd",
+            f"--rc-addr=127.0.0.1:{port}",
+        ]
+        if self._tps_limit:
+            rcd_command.extend(["--tpslimit", str(self._tps_limit)])
+        if self._bw_limit:
+            # A bare --bwlimit is KiB/s
+            rcd_command.extend(["--bwlimit", f"{int(self._bw_limit)}B"])
+        if self._verbosity >= 1:
+            rcd_command.append(f"-{'v' * self._verbosity}")
+        logging.debug(" ".join(rcd_command))
+        # The credentials go in the environment, so they don't show up in the process list.
+        self._rcd = subprocess.Popen(rcd_command, env={**os.environ,
+                                                       "RCLONE_RC_USER": self._user,
+                                                       "RCLONE_RC_PASS": self._password})
+
+        deadline = monotonic() + self.__STARTUP_SECONDS__
+        while True:
+            try:
+                self._call("rc/noop", {})
+                return
+            except OSError as exception:
+                if self._rcd.poll() is not None or monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("Unable to start rclone rcd") from exception
+                sleep(self.__POLL_SECONDS__)
+
+    def stop(self):
+        if self._rcd is None:
+            return
+        try:
+            self._call("core/quit", {})
+            self._rcd.wait(timeout=self.__STARTUP_SECONDS__)
+        except (OSError, subprocess.TimeoutExpired):
+            self._rcd.terminate()
+            self._rcd.wait()
+        self._rcd = None
+
+    def copy(self, source, destination, options):
+        """
+        Copies source to destination with the sync/copy call, and waits for it to finish.
+        Returns a CompletedProcess, or raises CalledProcessError if the copy failed.
+        """
+        params, args = self._job(source, destination, options)
+        try:
+            job_id = self._call("sync/copy", params)["jobid"]
+            while True:
+                status = self._call("job/status", {"jobid": job_id})
+                if status.get("finished"):
+                    break
+                sleep(self.__POLL_SECONDS__)
+            # Every job gets a stats group of its own
+            stats = self._call("core/stats", {"group": f"job/{job_id}"})
+        except (OSError, ValueError, KeyError) as exception:
+            raise subprocess.CalledProcessError(self.__RETURNCODE__, args, output=b"",
+                                                stderr=str(exception).encode()) from exception
+        return self._completed(args, status, stats)
+
+    async def copy_async(self, source, destination, options):
+        """
+        copy() for the asyncio engine.  The calls block, so they're made from threads, but the job is
+        waited on without holding one.  If the copy is cancelled, the job is stopped.
+        """
+        params, args = self._job(source, destination, options)
+        try:
+            job_id = (await asyncio.to_thread(self._call, "sync/copy", params))["jobid"]
+            try:
+                while True:
+                    status = await asyncio.to_thread(self._call, "job/status", {"jobid": job_id})
+                    if status.get("finished"):
+                        break
+                    await asyncio.sleep(self.__POLL_SECONDS__)
+            except asyncio.CancelledError:
+                logging.debug("Stopping job %d", job_id)
+                await asyncio.to_thread(self._call, "job/stop", {"jobid": job_id})
+                raise
+            stats = await asyncio.to_thread(self._call, "core/stats", {"group": f"job/{job_id}"})
+        except (OSError, ValueError, KeyError) as exception:
+            raise subprocess.CalledProcessError(self.__RETURNCODE__, args, output=b"",
+                                                stderr=str(exception).encode()) from exception
+        return self._completed(args, status, stats)
+
+    def _job(self, source, destination, options):
+        """Returns the sync/copy parameters for a copy, and the args it's recorded with."""
+        params = {"srcFs": source, "dstFs": destination, "_async": True}
+        for name, value in options.items():
+            if name not in self.__OPTIONS__:
+                raise ValueError(f"rclone rcd doesn't support --{name} per job")
+            group, key = self.__OPTIONS__[name]
+            params.setdefault(group, {})[key] = [value] if name in self.__LIST_OPTIONS__ else value
+        args = ["rc", "sync/copy", json.dumps(params)]
+        logging.debug(" ".join(args))
+        return params, args
+
+    def _completed(self, args, status, stats):
+        output = json.dumps({"status": status, "stats": stats}).encode()
+        if not status.get("success"):
+            raise subprocess.CalledProcessError(self.__RETURNCODE__, args, output=output,
+                                                stderr=(status.get("error") or "unknown error").encode())
+        return subprocess.CompletedProcess(args, 0, stdout=output, stderr=b"")
+
+    @staticmethod
+    def stats(completed):
+        """Returns the transfer columns, given what copy() returned or raised."""
+        try:
+            stats = json.loads(completed.stdout or b"{}").get("stats")
+        except ValueError:
+            stats = None
+        # Jobs aren't retried as a whole the way `rclone copy` is
+        return stats_columns(stats, retries=0)
+
+    def _call(self, method, params):
+        request = urllib.request.Request(self._url + method, data=json.dumps(params).encode(),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        if self._user is not None:
+            credentials = base64.b64encode(f"{self._user}:{self._password}".encode()).decode()
+            request.add_header("Authorization", f"Basic {credentials}")
+        try:
+            # A timeout is an OSError, so the copy fails the way it does when the rcd can't be reached.
+            with urllib.request.urlopen(request, timeout=self.__CALL_SECONDS__) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as exception:
+            # rc reports errors as JSON too
+            try:
+                error = json.load(exception).get("error")
+            except ValueError:
+                error = None
+            raise ValueError(f"{method} failed: {error or exception}") from exception
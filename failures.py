@@ -0,0 +1,71 @@
+import random
+
+# How a failed copy is handled
+TRANSIENT = "transient"  # retried in the same run, after a backoff
+CAP = "cap"              # every worker pauses, then it's retried
+PERMANENT = "permanent"  # left failed; retrying won't help
+
+CAP_ERRORS = [
+    b"storage_cap_exceeded",
+    b"transaction_cap_exceeded",
+]
+THROTTLE_ERRORS = [
+    b"(429)",
+    b"Too Many Requests",
+    b"too_many_requests",
+]
+PERMANENT_ERRORS = [
+    b"directory not found",
+    b"permission denied",
+    b"didn't find section in config file",
+    b"bad_auth_token",
+    b"unauthorized",
+    b"access_denied",
+]
+
+# rclone's exit codes, see https://rclone.org/docs/#exit-code
+__EXIT_CODES__ = {
+    # 1, an error not otherwise categorised, goes by what rclone printed
+    2: PERMANENT,   # syntax or usage error
+    3: PERMANENT,   # directory not found
+    4: PERMANENT,   # file not found
+    5: TRANSIENT,   # temporary error, more retries might fix it
+    6: PERMANENT,   # less serious errors, like 461 errors from dropbox
+    7: PERMANENT,   # fatal error, like account suspended
+    8: PERMANENT,   # --max-transfer reached, a limit set on purpose rather than the provider's cap
+    9: PERMANENT,   # no files transferred
+    10: TRANSIENT,  # duration limit exceeded
+}
+
+
+def classify(returncode, stderr):
+    """
+    Sorts a failed copy into TRANSIENT, CAP or PERMANENT, from what rclone printed and its exit code.
+    Cap errors are matched first, as B2 reports them with a fatal exit code.  Throttling is
+    transient, however it's reported.  Anything unrecognised is treated as transient, and so gets a
+    bounded number of retries.
+    """
+    stderr = (stderr or b"").lower()
+    if any(error.lower() in stderr for error in CAP_ERRORS):
+        return CAP
+    if returncode in __EXIT_CODES__:
+        return __EXIT_CODES__[returncode]
+    if is_throttled(stderr):
+        return TRANSIENT
+    if any(error.lower() in stderr for error in PERMANENT_ERRORS):
+        return PERMANENT
+    return TRANSIENT
+
+
+def is_throttled(stderr):
+    """Whether the remote asked for fewer requests."""
+    stderr = (stderr or b"").lower()
+    return any(error.lower() in stderr for error in THROTTLE_ERRORS)
+
+
+def backoff(attempt, base=5, maximum=300, generator=random):
+    """
+    Seconds to wait before the next attempt, after attempt attempts have failed: exponential, with
+    full jitter so sources that failed together don't all come back together.
+    """
+    return generator.uniform(0, min(maximum, base * 2 ** (attempt - 1)))
@@ -0,0 +1,211 @@
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+
+from report import find_trackers
+
+
+class History:
+    """
+    Keeps a summary of every finished run, and when each tracked directory was last copied
+    successfully, in one database, so neither question needs the archived trackers.  Archives are
+    merged in as they're made, and the oldest can then be deleted.
+    """
+
+    def __init__(self, filename) -> None:
+        self._filename = filename
+
+    def _connect(self):
+        try:
+            history = sqlite3.connect(database=self._filename)
+            with history:
+                history.execute("""
+                    CREATE TABLE IF NOT EXISTS runs (
+                        id                   integer NOT NULL  PRIMARY KEY  ,
+                        archive              text NOT NULL  UNIQUE  ,
+                        started              timestamp     ,
+                        finished             timestamp     ,
+                        duration             real     ,
+                        rows                 bigint     ,
+                        done                 bigint     ,
+                        failures             bigint     ,
+                        bytes                bigint
+                     );
+                """)
+                history.execute("""
+                    CREATE TABLE IF NOT EXISTS paths (
+                        path                 text NOT NULL  PRIMARY KEY  ,
+                        max_depth            integer     ,
+                        last_success         timestamp NOT NULL    ,
+                        run                  integer
+                     );
+                """)
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to open history {self._filename}")
+        return history
+
+    def merge(self, archive):
+        """Adds an archived tracker to the history, unless it's already there.  Returns whether it was added."""
+        name = os.path.basename(archive)
+        try:
+            with closing(sqlite3.connect(f"file:{archive}?mode=ro", uri=True)) as tracker:
+                columns = {row[1] for row in tracker.execute("PRAGMA table_info(sources);")}
+                claimed = "claimed" if "claimed" in columns else "NULL"
+                transferred = "bytes_transferred" if "bytes_transferred" in columns else "NULL"
+                max_depth = "max_depth" if "max_depth" in columns else "NULL"
+                failure = "failure" if "failure" in columns else "NULL"
+                summary = tracker.execute(f"""
+                    SELECT
+                        coalesce(min({claimed}), min(done)),
+                        max(done),
+                        count(*),
+                        count(done),
+                        count({failure}),
+                        sum({transferred})
+                    FROM sources;
+                """).fetchone()
+                # A directory copied in slices only counts once all of them are done.
+                successes = tracker.execute(f"""
+                    SELECT path, max({max_depth}), max(done)
+                    FROM sources
+                    GROUP BY path
+                    HAVING count(done) = count(*);
+                """).fetchall()
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to read archived tracker {archive}")
+
+        started, finished, rows, done, failures, size = summary
+        duration = None
+        if started and finished:
+            duration = (datetime.fromisoformat(finished) - datetime.fromisoformat(started)).total_seconds()
+        try:
+            with closing(self._connect()) as history:
+                with history:
+                    run = history.execute("""
+                        INSERT OR IGNORE INTO runs
+                            ( archive, started, finished, duration, rows, done, failures, bytes)
+                            VALUES ( :archive, :started, :finished, :duration, :rows, :done, :failures, :bytes );
+                    """, {"archive": name, "started": started, "finished": finished, "duration": duration,
+                          "rows": rows, "done": done, "failures": failures, "bytes": size})
+                    if not run.rowcount:
+                        return False
+                    history.executemany("""
+                        INSERT INTO paths
+                            ( path, max_depth, last_success, run) VALUES ( :path, :max_depth, :done, :run )
+                        ON CONFLICT ( path ) DO UPDATE SET
+                            max_depth = excluded.max_depth,
+                            last_success = excluded.last_success,
+                            run = excluded.run
+                        WHERE excluded.last_success > paths.last_success;
+                    """, ({"path": path.decode("utf-8", errors="backslashreplace") if isinstance(path, bytes) else path,
+                           "max_depth": source_max_depth, "done": source_done, "run": run.lastrowid}
+                          for path, source_max_depth, source_done in successes))
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to add {archive} to history {self._filename}")
+        logging.info("Added %s to the history: %d sources, %d failures", name, rows, failures)
+        return True
+
+    def merge_all(self, logdir):
+        """Merges every archived tracker in logdir that isn't in the history yet."""
+        return sum(self.merge(archive) for archive in find_trackers(logdir, required_column=None))
+
+    def apply_retention(self, logdir, keep_archives=None, keep_days=None):
+        """
+        Deletes all but the newest keep_archives archived trackers from logdir, once they're in the
+        history, and forgets runs that finished more than keep_days ago.  None keeps everything.
+        """
+        try:
+            with closing(self._connect()) as history:
+                merged = {row[0] for row in history.execute("SELECT archive FROM runs;")}
+                if keep_days is not None:
+                    oldest = (datetime.now(timezone.utc) - timedelta(days=keep_days)).isoformat()
+                    with history:
+                        history.execute("""
+                            DELETE FROM runs
+                            WHERE finished < :oldest;
+                        """, {"oldest": oldest})
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to apply retention to history {self._filename}")
+
+        if keep_archives is None:
+            return
+        # Archives are named after the time they were made, so they sort oldest first.
+        archives = find_trackers(logdir, required_column=None)
+        for archive in archives[:max(0, len(archives) - keep_archives)]:
+            if os.path.basename(archive) in merged:
+                logging.info("Deleting %s, it's in the history", archive)
+                os.remove(archive)
+
+    def last_success(self, path):
+        """
+        Returns (when, path that was copied) for the last successful copy that included path, or None.
+        A directory is included by its own row, or by the row of an ancestor that copied everything
+        below it.
+        """
+        path = path.rstrip("/") or "/"
+        ancestors = []
+        candidate = path
+        while (parent := os.path.dirname(candidate)) != candidate:
+            ancestors.append(parent)
+            candidate = parent
+        keys = {"path": path, "path_slash": path + "/"}
+        for index, ancestor in enumerate(ancestors):
+            keys[f"a{index}"] = ancestor
+            keys[f"a{index}_slash"] = ancestor + "/"
+        covering = ", ".join(f":a{index}, :a{index}_slash" for index in range(len(ancestors))) or "NULL"
+        try:
+            with closing(self._connect()) as history:
+                # Rows of ancestors that only copied their own files don't cover what's below them.
+                return history.execute(f"""
+                    SELECT last_success, path
+                    FROM paths
+                    WHERE path IN ( :path, :path_slash )
+                    OR ( max_depth IS NULL AND path IN ( {covering} ) )
+                    ORDER BY last_success DESC
+                    LIMIT 1;
+                """, keys).fetchone()
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to read history {self._filename}")
+
+    def runs(self, limit=20):
+        """Returns the most recent runs, newest first, as dicts."""
+        try:
+            with closing(self._connect()) as history:
+                history.row_factory = sqlite3.Row
+                return [dict(row) for row in history.execute("""
+                    SELECT archive, started, finished, duration, rows, done, failures, bytes
+                    FROM runs
+                    ORDER BY finished DESC
+                    LIMIT :limit;
+                """, {"limit": limit})]
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to read history {self._filename}")
+
+
+def history_report(history, logdir, paths, limit=20):
+    """Returns the lines answering --history: when each path was last copied, or the latest runs."""
+    history.merge_all(logdir)
+    lines = []
+    if paths:
+        for path in paths:
+            success = history.last_success(path)
+            if success is None:
+                lines.append(f"{path}: never copied successfully")
+            else:
+                when, copied = success
+                lines.append(f"{path}: {when}" + (f" (with {copied})" if copied.rstrip("/") != path.rstrip("/") else ""))
+        return lines
+
+    lines.append(f"{'finished':32} {'seconds':>10} {'rows':>10} {'failures':>8} {'bytes':>16}  archive")
+    for run in history.runs(limit):
+        lines.append(f"{run['finished'] or '-':32} {run['duration'] or 0:>10.0f} {run['rows']:>10,} "
+                     f"{run['failures']:>8,} {run['bytes'] or 0:>16,}  {run['archive']}")
+    return lines
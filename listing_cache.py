@@ -0,0 +1,73 @@
+import json
+import logging
+import sqlite3
+from contextlib import closing
+from time import time
+
+
+class ListingCache:
+    """
+    Keeps the directories found by listing a remote, keyed by remote, path and depth, for ttl
+    seconds.  Restores that are repeated within that time don't have to list the remote again.
+    """
+
+    # Stands in for an unlimited depth, as NULLs never match in a primary key
+    __UNLIMITED__ = -1
+
+    def __init__(self, filename, ttl=3600) -> None:
+        self._filename = filename
+        self._ttl = ttl
+
+    def _connect(self):
+        connection = sqlite3.connect(database=self._filename)
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS listings (
+                    remote               text NOT NULL    ,
+                    path                 text NOT NULL    ,
+                    depth                integer NOT NULL    ,
+                    listed               real NOT NULL    ,
+                    directories          text NOT NULL    ,
+                    PRIMARY KEY ( remote, path, depth )
+                 );
+            """)
+        return connection
+
+    def _key(self, remote, path, depth):
+        return {"remote": remote, "path": path, "depth": self.__UNLIMITED__ if depth is None else depth}
+
+    def get(self, remote, path, depth):
+        """Returns what was stored for this listing, unless it's missing or older than the ttl."""
+        try:
+            with closing(self._connect()) as connection:
+                record = connection.execute("""
+                    SELECT directories
+                    FROM listings
+                    WHERE remote = :remote
+                    AND path = :path
+                    AND depth = :depth
+                    AND listed >= :oldest;
+                """, {**self._key(remote, path, depth), "oldest": time() - self._ttl}).fetchone()
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to read listing cache {self._filename}")
+        return json.loads(record[0]) if record is not None else None
+
+    def put(self, remote, path, depth, directories):
+        """Stores directories (anything that can be turned into JSON) for this listing."""
+        try:
+            with closing(self._connect()) as connection:
+                with connection:
+                    connection.execute("""
+                        DELETE FROM listings
+                        WHERE listed < :oldest;
+                    """, {"oldest": time() - self._ttl})
+                    connection.execute("""
+                        INSERT OR REPLACE INTO listings
+                            ( remote, path, depth, listed, directories)
+                            VALUES ( :remote, :path, :depth, :listed, :directories );
+                    """, {**self._key(remote, path, depth), "listed": time(),
+                          "directories": json.dumps(directories)})
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            raise RuntimeError(f"Unable to update listing cache {self._filename}")
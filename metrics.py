@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+
+class ProgressMetrics:
+    """
+    Counts what resume() has done so far, in memory, so progress can be reported as often as anyone
+    likes without touching the tracker database.  The tracker counts are read once when resume()
+    starts, and kept up to date from then on by the crawler and the workers.
+    """
+
+    def __init__(self, clock=monotonic) -> None:
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._started = clock()
+        self._done = 0
+        self._pending = 0
+        self._pending_bytes = 0
+        self._failed = 0
+        self._active = 0
+        self._bytes = 0
+        self._finished = 0
+        self._worker_limit = 0
+        self._paused_seconds = 0
+        self._backoff_seconds = 0
+
+    def reset(self, done, pending, pending_bytes):
+        """Starts counting from the tracker's totals."""
+        with self._lock:
+            self._started = self._clock()
+            self._done = done
+            self._pending = pending
+            self._pending_bytes = pending_bytes
+            self._failed = 0
+            self._bytes = 0
+            self._finished = 0
+
+    def add_pending(self, count, size):
+        with self._lock:
+            self._pending += count
+            self._pending_bytes += size
+
+    def started(self):
+        with self._lock:
+            self._active += 1
+
+    def finished(self, size, transferred=None, failed=False, count=1):
+        """
+        Counts a source that's no longer pending, or the count sources of a batch.  size is what the
+        crawl expected; transferred is what rclone reported, when it did.
+        """
+        with self._lock:
+            self._active -= 1
+            self._pending = max(0, self._pending - count)
+            self._pending_bytes = max(0, self._pending_bytes - (size or 0))
+            self._finished += count
+            if failed:
+                self._failed += count
+            else:
+                self._done += count
+            self._bytes += transferred if transferred is not None else (size or 0)
+
+    def requeued(self):
+        """A source failed, but it's still pending, as it'll be tried again."""
+        with self._lock:
+            self._active -= 1
+
+    def set_scheduling(self, worker_limit, paused_seconds, backoff_seconds):
+        with self._lock:
+            self._worker_limit = worker_limit
+            self._paused_seconds = paused_seconds
+            self._backoff_seconds = backoff_seconds
+
+    def snapshot(self):
+        """Returns the current values, with the throughput and ETA worked out from them."""
+        with self._lock:
+            elapsed = self._clock() - self._started
+            bytes_per_second = self._bytes / elapsed if elapsed > 0 else 0.0
+            sources_per_second = self._finished / elapsed if elapsed > 0 else 0.0
+            if self._pending == 0:
+                eta = 0.0
+            elif self._pending_bytes and bytes_per_second:
+                eta = self._pending_bytes / bytes_per_second
+            elif sources_per_second:
+                eta = self._pending / sources_per_second
+            else:
+                eta = None
+            return {
+                "done": self._done,
+                "pending": self._pending,
+                "failed": self._failed,
+                "active_workers": self._active,
+                "worker_limit": self._worker_limit,
+                "paused_seconds": self._paused_seconds,
+                "backoff_seconds": self._backoff_seconds,
+                "bytes": self._bytes,
+                "pending_bytes": self._pending_bytes,
+                "bytes_per_second": bytes_per_second,
+                "elapsed_seconds": elapsed,
+                "eta_seconds": eta,
+            }
+
+    def prometheus(self):
+        """Returns the snapshot in the Prometheus text exposition format."""
+        values = self.snapshot()
+
+        def number(value):
+            return "NaN" if value is None else repr(float(value))
+
+        lines = [
+            "# HELP rclone_backups_sources Sources in the tracker, by state (failed counts this run only)",
+            "# TYPE rclone_backups_sources gauge",
+        ]
+        for state in ("done", "pending", "failed"):
+            lines.append(f'rclone_backups_sources{{state="{state}"}} {values[state]}')
+        for name, kind, description in (
+                ("active_workers", "gauge", "Sources being copied right now"),
+                ("worker_limit", "gauge", "Sources allowed to be copied at once"),
+                ("paused_seconds", "gauge", "Seconds until workers resume after a cap error"),
+                ("backoff_seconds", "gauge", "Seconds the next cap error will pause the workers for"),
+                ("bytes", "counter", "Bytes copied this run"),
+                ("pending_bytes", "gauge", "Bytes the crawl found in the pending sources"),
+                ("bytes_per_second", "gauge", "Average throughput this run"),
+                ("eta_seconds", "gauge", "Estimated seconds until every pending source is done"),
+        ):
+            lines.append(f"# HELP rclone_backups_{name} {description}")
+            lines.append(f"# TYPE rclone_backups_{name} {kind}")
+            lines.append(f"rclone_backups_{name} {number(values[name])}")
+        return "\n".join(lines) + "\n"
+
+    def write_status(self, filename):
+        """Writes the snapshot to filename as JSON, replacing it in one go so readers never see half of it."""
+        temporary = f"{filename}.tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump(self.snapshot(), f, indent=2)
+            os.replace(temporary, filename)
+        except OSError as exception:
+            logging.warning("Unable to write status file %s: %s", filename, exception)
+
+
+class MetricsServer:
+    """Serves /metrics (Prometheus) and /status (JSON) on localhost, from a thread of its own."""
+
+    def __init__(self, metrics, port, host="127.0.0.1") -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.prometheus().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/status":
+                    body = json.dumps(metrics.snapshot()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("metrics: " + format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        logging.info("Serving metrics on http://127.0.0.1:%d/metrics", self.port)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,43 @@
+import json
+import zlib
+
+
+def pack(text, limit=64 * 1024):
+    """
+    Compresses rclone's output for the outputs table.  Past limit bytes only the start and the end
+    are kept, as that's where rclone says what it was doing and what went wrong.
+    """
+    if text is None:
+        return None
+    data = text.encode("utf-8", errors="backslashreplace")
+    if limit is not None and len(data) > limit:
+        marker = f"\n[... {len(data) - limit} bytes truncated ...]\n".encode()
+        data = data[:limit // 2] + marker + data[len(data) - limit // 2:]
+    return zlib.compress(data)
+
+
+def unpack(blob):
+    if blob is None:
+        return None
+    return zlib.decompress(blob).decode("utf-8", errors="backslashreplace")
+
+
+def summarize_failure(text, limit=200):
+    """Returns the last error in rclone's output, short enough to keep with the sources."""
+    lines = [line for line in (text or "").splitlines() if line.strip()]
+    summary = None
+    for line in lines:
+        if line.startswith("{"):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if isinstance(record, dict) and record.get("level") in ("error", "critical"):
+                summary = record.get("msg", line)
+                continue
+        if "ERROR" in line or "CRITICAL" in line:
+            summary = line
+    if summary is None:
+        summary = lines[-1] if lines else "rclone failed without any output"
+    summary = summary.strip()
+    return summary if len(summary) <= limit else summary[:limit - 3] + "..."
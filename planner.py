@@ -0,0 +1,233 @@
+import hashlib
+import heapq
+import logging
+import os
+from collections import namedtuple
+from time import time
+
+from report import find_trackers, load_sources
+
+# B2 charges for listing (class C) transactions, per transaction; uploads (class A) are free.
+CLASS_C_PRICE = 0.004 / 1000
+
+# Seconds a row takes: overhead + (files + checks) * seconds_per_file + bytes / bytes_per_second
+Model = namedtuple("Model", ["overhead", "seconds_per_file", "bytes_per_second", "samples"])
+# What's assumed when --logdir doesn't have enough finished sources to measure it
+DEFAULT_MODEL = Model(overhead=2.0, seconds_per_file=0.02, bytes_per_second=20e6, samples=0)
+
+# files and bytes the row copies, files it only checks because deeper rows copied them first, and
+# directories it lists
+Row = namedtuple("Row", ["files", "checks", "bytes", "listings"])
+
+
+def crawl(tracker_class, sources, plandir, ttl=3600, **options):
+    """
+    Crawls the sources with tracker_class, without copying anything, and returns the planning
+    tracker's get_sizes().  The crawl has no depth limit and tracks only the direct files of each
+    directory, so every --depth can be worked out from it.  It's kept in plandir, and used again
+    for ttl seconds.
+    """
+    os.makedirs(plandir, exist_ok=True)
+    key = hashlib.sha1("\0".join([tracker_class.__name__, *sources]).encode()).hexdigest()[:16]
+    filename = os.path.join(plandir, f"plan-{key}.sqlite3")
+    # Opening a tracker touches it, so the time of the crawl is kept apart.
+    crawled = f"{filename}.crawled"
+    if not os.path.exists(crawled) or time() - os.path.getmtime(crawled) > ttl:
+        for stale in (filename, f"{filename}-wal", f"{filename}-shm", crawled):
+            if os.path.exists(stale):
+                os.remove(stale)
+    else:
+        logging.info("Using the crawl of %s from %s", sources, filename)
+
+    tracker = tracker_class(filename=filename, sources=sources, logdir=plandir, depth=None, non_overlapping=True,
+                            **options)
+    try:
+        tracker.wait_for_crawl()
+        sizes = tracker.get_sizes()
+    finally:
+        tracker.close()
+    if not os.path.exists(crawled):
+        open(crawled, "w").close()
+    return sizes
+
+
+def summarize_directories(sizes):
+    """
+    Turns the (path, max_depth, files, bytes) of a planning crawl into a dict for each directory,
+    with its depth below its top-level source and the files, bytes and directories of its subtree.
+    """
+    directories = {}
+    for path, _, files, size in sizes:
+        # A sliced directory has a row for each slice.
+        directory = directories.setdefault(path.rstrip("/") or "/", {"own_files": 0, "own_bytes": 0})
+        directory["own_files"] += files or 0
+        directory["own_bytes"] += size or 0
+
+    def parent(path):
+        head = path.rpartition("/")[0]
+        return head or ("/" if path.startswith("/") and path != "/" else None)
+
+    # Parents come before their subdirectories, as they have fewer slashes.
+    by_depth = sorted(directories, key=lambda path: (path != "/", path.count("/")))
+    for path in by_depth:
+        directory = directories[path]
+        above = directories.get(parent(path))
+        directory["depth"] = above["depth"] + 1 if above is not None else 0
+        directory["total_files"] = directory["own_files"]
+        directory["total_bytes"] = directory["own_bytes"]
+        directory["total_dirs"] = 1
+    for path in reversed(by_depth):
+        above = directories.get(parent(path))
+        if above is not None:
+            directory = directories[path]
+            above["total_files"] += directory["total_files"]
+            above["total_bytes"] += directory["total_bytes"]
+            above["total_dirs"] += directory["total_dirs"]
+    return directories
+
+
+def rows_for_depth(directories, depth, non_overlapping=False):
+    """
+    Returns the Rows a backup or restore with this --depth would track.  Directories down to the
+    depth get rows of their own, and those one level below copy their whole subtree.  Without
+    non_overlapping the rows above copy their subtree too, so they list it and check its files.
+    """
+    rows = []
+    for directory in directories.values():
+        whole = Row(directory["total_files"], 0, directory["total_bytes"], directory["total_dirs"])
+        if depth < 0:
+            if directory["depth"] == 0:
+                rows.append(whole)
+        elif directory["depth"] <= depth:
+            if non_overlapping:
+                rows.append(Row(directory["own_files"], 0, directory["own_bytes"], 1))
+            else:
+                rows.append(Row(directory["own_files"], directory["total_files"] - directory["own_files"],
+                                directory["own_bytes"], directory["total_dirs"]))
+        elif directory["depth"] == depth + 1:
+            rows.append(whole)
+    return rows
+
+
+def estimate_seconds(row, model):
+    return model.overhead + (row.files + row.checks) * model.seconds_per_file + row.bytes / model.bytes_per_second
+
+
+def makespan(durations, workers, total_bytes=0, bandwidth=None):
+    """
+    Seconds until the last row is done when the longest rows are started first, each on the
+    worker that becomes free first, as they are claimed.  With bandwidth (bytes/sec) it's never
+    less than the time it takes to send all the bytes.
+    """
+    loads = [0.0] * max(1, min(workers, len(durations)))
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(loads, loads[0] + duration)
+    span = max(loads)
+    if bandwidth:
+        span = max(span, total_bytes / bandwidth)
+    return span
+
+
+def _least_squares(features, targets):
+    """Solves the normal equations by Gaussian elimination, or returns None if they're singular."""
+    size = len(features[0])
+    matrix = [[sum(row[i] * row[j] for row in features) for j in range(size)] +
+              [sum(row[i] * target for row, target in zip(features, targets))] for i in range(size)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(matrix[row][column]))
+        if abs(matrix[pivot][column]) < 1e-9:
+            return None
+        matrix[column], matrix[pivot] = matrix[pivot], matrix[column]
+        for row in range(size):
+            if row != column:
+                factor = matrix[row][column] / matrix[column][column]
+                matrix[row] = [a - factor * b for a, b in zip(matrix[row], matrix[column])]
+    return [matrix[row][size] / matrix[row][row] for row in range(size)]
+
+
+def fit_model(samples, minimum_samples=20):
+    """
+    Fits the Model to (elapsed, files, bytes) of finished sources, where files counts both the
+    transferred and the checked ones.  Falls back on DEFAULT_MODEL for what can't be measured.
+    """
+    if len(samples) < minimum_samples:
+        return DEFAULT_MODEL
+    # Megabytes keep the equations well conditioned.
+    solution = _least_squares([(1.0, files, size / 1e6) for _, files, size in samples],
+                              [elapsed for elapsed, _, _ in samples])
+    if solution is None:
+        return DEFAULT_MODEL._replace(samples=len(samples))
+    overhead, seconds_per_file, seconds_per_megabyte = solution
+    return Model(overhead=max(0.0, overhead),
+                 seconds_per_file=max(0.0, seconds_per_file),
+                 bytes_per_second=1e6 / seconds_per_megabyte if seconds_per_megabyte > 0
+                 else DEFAULT_MODEL.bytes_per_second,
+                 samples=len(samples))
+
+
+def measured_model(logdir):
+    """Fits the Model to the finished sources of the archived trackers in logdir."""
+    samples = [(source["elapsed"], (source["files_transferred"] or 0) + (source["checks"] or 0),
+                source["bytes_transferred"] or 0)
+               for filename in find_trackers(logdir) for source in load_sources(filename)
+               if source["elapsed"] is not None]
+    return fit_model(samples)
+
+
+def plan(directories, model, workers, non_overlapping=False, bandwidth=None, class_c_price=CLASS_C_PRICE):
+    """Returns the estimates for every --depth that makes a difference, as a dict for each."""
+    deepest = max((directory["depth"] for directory in directories.values()), default=0)
+    estimates = []
+    # Past deepest - 1 every directory has a row of its own, and nothing changes.
+    for depth in range(-1, deepest):
+        rows = rows_for_depth(directories, depth, non_overlapping)
+        durations = [estimate_seconds(row, model) for row in rows]
+        total_bytes = sum(row.bytes for row in rows)
+        files = sum(row.files for row in rows)
+        listings = sum(row.listings for row in rows)
+        estimates.append({
+            "depth": depth,
+            "rows": len(rows),
+            "files_per_row": files / len(rows) if rows else 0,
+            "bytes_per_row": total_bytes / len(rows) if rows else 0,
+            "largest_row_bytes": max((row.bytes for row in rows), default=0),
+            # Every file uploaded, and every directory listed
+            "transactions": files + listings,
+            "cost": listings * class_c_price,
+            "wall_seconds": {count: makespan(durations, count, total_bytes, bandwidth) for count in workers},
+        })
+    return estimates
+
+
+def suggest(estimates, tolerance=0.05):
+    """
+    Returns (depth, workers, wall seconds) of the quickest plan, preferring fewer workers and then
+    fewer transactions among those within tolerance of it.
+    """
+    options = [(seconds, count, estimate) for estimate in estimates
+               for count, seconds in estimate["wall_seconds"].items()]
+    quickest = min(seconds for seconds, _, _ in options)
+    seconds, count, estimate = min((option for option in options if option[0] <= quickest * (1 + tolerance)),
+                                   key=lambda option: (option[1], option[2]["transactions"], option[0]))
+    return estimate["depth"], count, seconds
+
+
+def format_plan(estimates, model, suggestion):
+    lines = []
+    if model.samples:
+        lines.append(f"Measured on {model.samples} sources: {model.overhead:.2f}s per row, "
+                     f"{model.seconds_per_file * 1000:.1f}ms per file, {model.bytes_per_second:,.0f} bytes/sec")
+    else:
+        lines.append(f"Not enough finished runs in --logdir, assuming {model.overhead:.2f}s per row, "
+                     f"{model.seconds_per_file * 1000:.1f}ms per file, {model.bytes_per_second:,.0f} bytes/sec")
+    workers = list(estimates[0]["wall_seconds"]) if estimates else []
+    lines.append(f"{'depth':>5} {'rows':>9} {'files/row':>10} {'bytes/row':>14} {'largest row':>14} "
+                 f"{'transactions':>13} {'cost':>9}  " + " ".join(f"{f'{count}w secs':>10}" for count in workers))
+    for estimate in estimates:
+        lines.append(f"{estimate['depth']:>5} {estimate['rows']:>9,} {estimate['files_per_row']:>10,.1f} "
+                     f"{estimate['bytes_per_row']:>14,.0f} {estimate['largest_row_bytes']:>14,} "
+                     f"{estimate['transactions']:>13,} {estimate['cost']:>9.4f}  " +
+                     " ".join(f"{seconds:>10,.0f}" for seconds in estimate["wall_seconds"].values()))
+    depth, count, seconds = suggestion
+    lines.append(f"Suggested: --depth {depth} --workers {count}, about {seconds:,.0f} seconds")
+    return lines
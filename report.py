@@ -0,0 +1,96 @@
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+
+def find_trackers(logdir, required_column="bytes_transferred"):
+    """Returns the archived trackers in logdir that have required_column (transfer stats by default), oldest first."""
+    trackers = []
+    for name in sorted(os.listdir(logdir)):
+        path = os.path.join(logdir, name)
+        try:
+            with open(path, "rb") as f:
+                if f.read(16) != b"SQLite format 3\0":
+                    continue
+            with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as tracker:
+                columns = {row[1] for row in tracker.execute("PRAGMA table_info(sources);")}
+        except (OSError, sqlite3.Error):
+            continue
+        if columns and (required_column is None or required_column in columns):
+            trackers.append(path)
+        elif columns:
+            logging.debug("%s has no %s column", path, required_column)
+    return trackers
+
+
+def load_sources(filename):
+    """Returns the finished sources of a tracker, as dicts."""
+    try:
+        with closing(sqlite3.connect(f"file:{filename}?mode=ro", uri=True)) as tracker:
+            tracker.row_factory = sqlite3.Row
+            rows = tracker.execute("""
+                SELECT path, claimed, done, elapsed, bytes_transferred, files_transferred, checks, retries
+                FROM sources
+                WHERE done IS NOT NULL;
+            """).fetchall()
+    except sqlite3.Error as exception:
+        logging.exception(exception)
+        raise RuntimeError(f"Unable to read tracker {filename}")
+    return [{**row, "path": row["path"].decode("utf-8", errors="backslashreplace")
+             if isinstance(row["path"], bytes) else row["path"]} for row in rows]
+
+
+def _rate(size, seconds):
+    return size / seconds if seconds else None
+
+
+def _span(sources):
+    """Seconds from the first claim to the last result, or None if the timestamps weren't recorded."""
+    claimed = [datetime.fromisoformat(source["claimed"]) for source in sources if source["claimed"]]
+    done = [datetime.fromisoformat(source["done"]) for source in sources if source["done"]]
+    if not claimed or not done:
+        return None
+    return (max(done) - min(claimed)).total_seconds()
+
+
+def _format_rate(rate):
+    return "-" if rate is None else f"{rate:,.0f}"
+
+
+def report(logdir, limit=20):
+    """Returns the lines of a report on the archived trackers in logdir."""
+    trackers = find_trackers(logdir)
+    if not trackers:
+        return [f"No archived trackers with transfer stats in {logdir}"]
+
+    lines = []
+    everything = []
+    for filename in trackers:
+        sources = load_sources(filename)
+        size = sum(source["bytes_transferred"] or 0 for source in sources)
+        files = sum(source["files_transferred"] or 0 for source in sources)
+        span = _span(sources)
+        lines.append(f"{os.path.basename(filename)}: {len(sources)} sources, {size:,} bytes in {files:,} files, "
+                     f"{_format_rate(_rate(size, span))} bytes/sec overall")
+        everything.extend(dict(source, tracker=os.path.basename(filename)) for source in sources)
+
+    size = sum(source["bytes_transferred"] or 0 for source in everything)
+    busy = sum(source["elapsed"] or 0 for source in everything)
+    lines.append(f"All: {len(everything)} sources, {size:,} bytes, "
+                 f"{_format_rate(_rate(size, busy))} bytes/sec per source on average")
+
+    slowest = sorted(everything, key=lambda source: source["elapsed"] or 0, reverse=True)[:limit]
+    lines.append("")
+    lines.append(f"Slowest {len(slowest)} sources:")
+    lines.append(f"{'seconds':>10} {'bytes/sec':>14} {'bytes':>16} {'files':>8} {'checks':>8} {'retries':>7}  path")
+    for source in slowest:
+        lines.append(f"{source['elapsed'] or 0:>10.1f} "
+                     f"{_format_rate(_rate(source['bytes_transferred'] or 0, source['elapsed'])):>14} "
+                     f"{source['bytes_transferred'] or 0:>16,} "
+                     f"{source['files_transferred'] or 0:>8,} "
+                     f"{source['checks'] or 0:>8,} "
+                     f"{source['retries'] or 0:>7}  "
+                     f"{source['path']}")
+    return lines
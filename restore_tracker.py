@@ -1,8 +1,34 @@
 import json
 import logging
 import subprocess
+import tempfile
 
 from base_tracker import BaseTracker
+from listing_cache import ListingCache
+
+
+def iter_json_array(stream, chunk_size=1 << 16):
+    """Yields the objects of a JSON array as they're read from a text stream, one at a time."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    while True:
+        # Skip the brackets, commas and whitespace between objects.
+        while position < len(buffer) and buffer[position] in "[],\r\n\t ":
+            position += 1
+        try:
+            record, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Probably cut off at the end of the buffer
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                if buffer[position:].strip():
+                    raise
+                return
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield record
 
 
 class RestoreTracker(BaseTracker):
@@ -15,59 +41,116 @@ class RestoreTracker(BaseTracker):
     def source_prefix(self):
         return f"{self.remote_name}:"
 
+    def __init__(self, *args, listing_cache=None, listing_ttl=3600, **kwargs) -> None:
+        # Set before the crawl is started
+        self._listing_cache = ListingCache(listing_cache, ttl=listing_ttl) if listing_cache else None
+        super().__init__(*args, **kwargs)
+
     def populate_source(self, source):
+        """Yields a row for the source and each remote directory below it, deepest first."""
         if not source[-1] == "/":
             source += "/"
         
         # If depth is 0, we just want to rclone the top-level directory itself.
         if self._depth is not None and self._depth < 0:
-            return [source]
+            yield self._make_row(source)
+            return
+
+        rows = None
+        if self._listing_cache is not None:
+            rows = self._listing_cache.get(self.remote_name, source, self._depth)
+            if rows is not None and self._sizing and rows[""][1] is None:
+                # Listed without sizes, by a restore that didn't need them
+                rows = None
+            if rows is not None:
+                logging.info("Using the cached listing of %s", source)
+        if rows is None:
+            rows = self._list_remote(source)
+            if self._listing_cache is not None:
+                self._listing_cache.put(self.remote_name, source, self._depth, rows)
+
+        remote_sources = [self._make_row(source + rel_path if rel_path else source,
+                                         own_files_only=own_files_only,
+                                         own_size=tuple(own_size) if own_size is not None else None,
+                                         total_size=tuple(total_size) if total_size is not None else None)
+                          for rel_path, (own_files_only, own_size, total_size) in rows.items()]
+        remote_sources.sort(reverse=True, key=lambda x: x["path"].count("/"))
+        yield from remote_sources
 
+    def _list_remote(self, source):
+        """
+        Lists the remote down to the max depth, returning a row for each directory that needs one, as
+        [own_files_only, own (files, bytes), total (files, bytes)] keyed by path relative to source.
+        rclone's output is parsed one entry at a time, so only the directories with rows are kept in
+        memory.  Files are only listed when the rows need sizes; otherwise those are None.
+        """
         get_remote_contents = [
             "rclone",
             "lsjson",
-            "--dirs-only",
             f"{self.remote_name}:{source}",
         ]
         if self._depth is None or self._depth > 0:
-             get_remote_contents.append("--recursive")
-        
-        # Note: rclone lsjson doesn't have a built-in max-depth like find,
-        # but we can filter it if we needed to be precise.
-        # For now, we'll just toggle between recursive and non-recursive.
+            get_remote_contents.append("--recursive")
+            if self._depth is not None:
+                # Nothing deeper gets a row, but the files directly in the deepest rows are one level
+                # further down.  The totals of those rows only count their own files, rather than
+                # everything below, and the directories at that level are ignored.
+                max_depth = self._depth + 1 if self._sizing else self._depth
+                get_remote_contents.extend(["--max-depth", str(max_depth)])
+        if not self._sizing:
+            get_remote_contents.append("--dirs-only")
 
-        try:
-            logging.debug(" ".join(get_remote_contents))
-            rclone_proc = subprocess.run(get_remote_contents, capture_output=True, check=True, encoding="ascii")
-            remote_content = json.loads(rclone_proc.stdout)
-            logging.debug(remote_content)
-            
-            remote_sources = []
-            for entry in remote_content:
-                if entry["IsDir"]:
-                    path = source + entry["Path"]
-                    # If we have a depth, filter out items that are too deep
-                    if self._depth is not None:
-                        # Count slashes relative to the source
-                        rel_path = entry["Path"]
-                        depth = rel_path.strip("/").count("/") if rel_path.strip("/") else 0
-                        if depth < self._depth:
-                            remote_sources.append(path)
-                    else:
-                        remote_sources.append(path)
-
-            if remote_sources:
-                remote_sources.append(source)
-            else:
-                remote_sources = [source]
-            remote_sources.sort(reverse=True, key=lambda x: x.count("/"))
-            return remote_sources
-        except subprocess.CalledProcessError as exception:
-            error_message = f"\n" \
-                            f"{exception.returncode=}\n" \
-                            f"{exception.cmd=}\n" \
-                            f"{exception.output=}\n" \
-                            f"{exception.stdout=}\n" \
-                            f"{exception.stderr=}\n"
-            logging.error(error_message)
-            raise exception
+        logging.debug(" ".join(get_remote_contents))
+        # [own (files, bytes), total (files, bytes)] for each directory that gets a row
+        sizes = {"": [[0, 0], [0, 0]]}
+        with tempfile.TemporaryFile() as errors:
+            with subprocess.Popen(get_remote_contents, stdout=subprocess.PIPE, stderr=errors,
+                                  encoding="utf-8") as rclone_proc:
+                for entry in iter_json_array(rclone_proc.stdout):
+                    rel_path = entry["Path"].strip("/")
+                    if entry["IsDir"]:
+                        if self._has_row(rel_path):
+                            sizes.setdefault(rel_path, [[0, 0], [0, 0]])
+                        continue
+
+                    # Add the file to its directory and the directories above it.  Entries come in
+                    # no particular order, so this may be the first we hear of them.
+                    size = max(entry.get("Size", 0), 0)
+                    parent = rel_path.rpartition("/")[0]
+                    if self._has_row(parent):
+                        own = sizes.setdefault(parent, [[0, 0], [0, 0]])[0]
+                        own[0] += 1
+                        own[1] += size
+                    while True:
+                        if self._has_row(parent):
+                            total = sizes.setdefault(parent, [[0, 0], [0, 0]])[1]
+                            total[0] += 1
+                            total[1] += size
+                        if not parent:
+                            break
+                        parent = parent.rpartition("/")[0]
+            if rclone_proc.returncode != 0:
+                errors.seek(0)
+                exception = subprocess.CalledProcessError(rclone_proc.returncode, get_remote_contents,
+                                                          stderr=errors.read())
+                error_message = f"\n" \
+                                f"{exception.returncode=}\n" \
+                                f"{exception.cmd=}\n" \
+                                f"{exception.output=}\n" \
+                                f"{exception.stdout=}\n" \
+                                f"{exception.stderr=}\n"
+                logging.error(error_message)
+                raise exception
+
+        # Directories shallower than the last listed level have rows for all of their
+        # subdirectories, so they only need to copy their own files.
+        if not self._sizing:
+            sizes = {rel_path: [None, None] for rel_path in sizes}
+        rows = {rel_path: [self._depth is None or rel_path.count("/") < self._depth - 1, own, total]
+                for rel_path, (own, total) in sizes.items() if rel_path}
+        rows[""] = [bool(rows), *sizes[""]]
+        return rows
+
+    def _has_row(self, rel_path):
+        """Whether a directory, by its path relative to the source, is shallow enough to get a row."""
+        return not rel_path or self._depth is None or rel_path.count("/") < self._depth
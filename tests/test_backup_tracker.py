@@ -1,6 +1,9 @@
 import unittest
+import asyncio
 from unittest.mock import patch, MagicMock
 import os
+import subprocess
+import tempfile
 from backup_tracker import BackupTracker
 
 class TestBackupTracker(unittest.TestCase):
@@ -15,6 +18,21 @@ class TestBackupTracker(unittest.TestCase):
                 logdir="logs",
                 depth=1
             )
+        # /src
+        # ├── dir1
+        # │   └── sub1
+        # │       └── deeper
+        # └── dir2
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        os.makedirs(os.path.join(self.src, "dir1", "sub1", "deeper"))
+        os.makedirs(os.path.join(self.src, "dir2"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def relative(self, sources):
+        return [os.path.relpath(source["path"], self.tmpdir.name) for source in sources]
 
     @patch('socket.gethostname')
     def test_dest_prefix(self, mock_hostname):
@@ -24,46 +42,306 @@ class TestBackupTracker(unittest.TestCase):
     def test_source_prefix(self):
         self.assertEqual(self.tracker.source_prefix, "")
 
-    @patch('os.walk')
-    def test_populate_source_depth_1(self, mock_walk):
-        # Mock os.walk(source, topdown=True, followlinks=False)
-        # depth 0: ('/src', ['dir1', 'dir2'], [])
-        # depth 1: ('/src/dir1', ['sub1'], []), ('/src/dir2', [], [])
-        
-        mock_walk.return_value = [
-            ('/src', ['dir1', 'dir2'], []),
-            ('/src/dir1', ['sub1'], []),
-            ('/src/dir2', [], [])
-        ]
-        
-        sources = self.tracker.populate_source("/src")
-        
+    def test_populate_source_depth_1(self):
+        sources = list(self.tracker.populate_source(self.src))
+
         # With depth 1:
-        # /src (depth 0) -> adds dirs: /src/dir1, /src/dir2. continues to /src/dir1
-        # /src/dir1 (depth 1) -> adds subdir: /src/dir1/sub1. STOPS (del dirs[:])
-        # /src/dir2 (depth 1) -> adds subdir: (none). STOPS
-        # Final append: /src
-        
-        expected = sorted(["/src/dir1", "/src/dir2", "/src/dir1/sub1", "/src"], reverse=True, key=lambda x: x.count(os.path.sep))
-        self.assertEqual(sorted(sources), sorted(expected))
-
-    @patch('os.walk')
-    def test_populate_source_depth_0(self, mock_walk):
+        # src (depth 0) -> adds dirs: src/dir1, src/dir2. continues to src/dir1
+        # src/dir1 (depth 1) -> adds subdir: src/dir1/sub1. STOPS
+        # src/dir2 (depth 1) -> adds subdir: (none). STOPS
+        # Subdirectories always come before their parent.
+        self.assertEqual(self.relative(sources), ["src/dir1/sub1", "src/dir1", "src/dir2", "src"])
+        self.assertTrue(all(source["max_depth"] is None for source in sources))
+
+    def test_populate_source_depth_0(self):
         self.tracker._depth = 0
-        mock_walk.return_value = [
-            ('/src', ['dir1', 'dir2'], [])
-        ]
-        sources = self.tracker.populate_source("/src")
+        sources = list(self.tracker.populate_source(self.src))
         # Depth 0:
-        # /src (depth 0) -> adds /src/dir1, /src/dir2. STOPS.
-        # Final append: /src
-        expected = ["/src/dir1", "/src/dir2", "/src"]
-        self.assertEqual(sorted(sources), sorted(expected))
+        # src (depth 0) -> adds src/dir1, src/dir2. STOPS.
+        self.assertEqual(self.relative(sources), ["src/dir1", "src/dir2", "src"])
+
+    def test_populate_source_no_depth(self):
+        self.tracker._depth = None
+        sources = list(self.tracker.populate_source(self.src))
+        self.assertEqual(self.relative(sources), ["src/dir1/sub1/deeper", "src/dir1/sub1", "src/dir1", "src/dir2", "src"])
+
+    def test_populate_source_non_overlapping(self):
+        self.tracker._non_overlapping = True
+        sources = list(self.tracker.populate_source(self.src))
+        # Directories that were walked have rows for their subdirectories, so they only copy their own files.
+        # src/dir1/sub1 is past the max depth and is copied recursively.
+        max_depths = dict(zip(self.relative(sources), (source["max_depth"] for source in sources)))
+        self.assertEqual(max_depths, {
+            "src": 1,
+            "src/dir1": 1,
+            "src/dir2": 1,
+            "src/dir1/sub1": None,
+        })
+
+    def test_populate_source_non_overlapping_symlink(self):
+        # Symlinked directories are tracked but not followed, so they must stay recursive
+        self.tracker._non_overlapping = True
+        os.symlink(os.path.join(self.src, "dir1"), os.path.join(self.src, "link"))
+        sources = list(self.tracker.populate_source(self.src))
+        max_depths = dict(zip(self.relative(sources), (source["max_depth"] for source in sources)))
+        self.assertIsNone(max_depths["src/link"])
+        self.assertNotIn("src/link/sub1", max_depths)
+
+    def test_populate_source_unreadable(self):
+        self.tracker._non_overlapping = True
+        missing = os.path.join(self.tmpdir.name, "missing")
+        sources = list(self.tracker.populate_source(missing))
+        self.assertEqual([(source["path"], source["max_depth"], source["bytes"]) for source in sources], [(missing, None, None)])
 
     def test_populate_source_negative_depth(self):
         self.tracker._depth = -1
-        sources = self.tracker.populate_source("/src")
-        self.assertEqual(sources, ["/src"])
+        sources = list(self.tracker.populate_source("/src"))
+        self.assertEqual([(source["path"], source["max_depth"]) for source in sources], [("/src", None)])
+
+    def write(self, path, size):
+        os.makedirs(os.path.dirname(os.path.join(self.src, path)), exist_ok=True)
+        with open(os.path.join(self.src, path), "wb") as f:
+            f.write(b"x" * size)
+
+    def test_populate_source_sizes(self):
+        self.write("top.txt", 1)
+        self.write("dir1/a.txt", 10)
+        self.write("dir1/sub1/b.txt", 100)
+        self.write("dir1/sub1/deeper/c.txt", 1000)
+        self.write("dir1/sub1/deeper/d.txt", 1000)
+
+        # The change index needs the deepest rows' subtrees walked
+        self.tracker._change_index = MagicMock()
+        sizes = {path: (source["files"], source["bytes"])
+                 for path, source in zip(self.relative(list(self.tracker.populate_source(self.src))),
+                                         self.tracker.populate_source(self.src))}
+        # Overlapping rows copy everything below them
+        self.assertEqual(sizes, {
+            "src": (5, 2111),
+            "src/dir1": (4, 2110),
+            "src/dir1/sub1": (3, 2100),
+            "src/dir2": (0, 0),
+        })
+
+        self.tracker._non_overlapping = True
+        sources = list(self.tracker.populate_source(self.src))
+        sizes = {path: (source["files"], source["bytes"], source["priority"])
+                 for path, source in zip(self.relative(sources), sources)}
+        # Non-overlapping rows only count what they copy, and the biggest go first
+        self.assertEqual(sizes, {
+            "src": (1, 1, 1),
+            "src/dir1": (1, 10, 10),
+            "src/dir1/sub1": (3, 2100, 2100),
+            "src/dir2": (0, 0, 0),
+        })
+
+    def test_populate_source_bounded(self):
+        self.write("dir1/a.txt", 10)
+        self.write("dir1/sub1/deeper/c.txt", 1000)
+        scanned = []
+        scan = BackupTracker._scan
+        with patch.object(BackupTracker, '_scan',
+                          side_effect=lambda path, depth: scanned.append(depth) or scan(path, depth)):
+            sources = list(self.tracker.populate_source(self.src))
+        # Nothing needs sizes, so the walk stops at the max depth and the rest is left to rclone
+        self.assertEqual(max(scanned), 1)
+        sizes = {path: (source["files"], source["bytes"]) for path, source in zip(self.relative(sources), sources)}
+        self.assertEqual(sizes, {
+            "src": (None, None),
+            "src/dir1": (None, None),
+            "src/dir1/sub1": (None, None),
+            "src/dir2": (0, 0),
+        })
+
+    def test_populate_source_split(self):
+        self.write("dir1/sub1/b.txt", 100)
+        self.write("dir1/sub1/deeper/c.txt", 1000)
+        self.tracker._non_overlapping = True
+        self.tracker._depth = 0
+        self.tracker._split_bytes = 500
+
+        sources = list(self.tracker.populate_source(self.src))
+        rows = {path: (source["max_depth"], source["bytes"]) for path, source in zip(self.relative(sources), sources)}
+        # dir1 and sub1 hold more than 500 bytes, so they're split down to deeper
+        self.assertEqual(rows, {
+            "src": (1, 0),
+            "src/dir1": (1, 0),
+            "src/dir1/sub1": (1, 100),
+            "src/dir1/sub1/deeper": (None, 1000),
+            "src/dir2": (None, 0),
+        })
+        self.assertEqual(self.relative(sources)[0], "src/dir1/sub1/deeper")
+
+        # Without splitting, everything past the max depth is copied with its parent
+        self.tracker._split_bytes = None
+        sources = list(self.tracker.populate_source(self.src))
+        self.assertEqual(self.relative(sources), ["src/dir1", "src/dir2", "src"])
+
+    def test_populate_source_slices(self):
+        for i in range(10):
+            self.write(f"dir2/file{i}.txt", 10)
+        self.write("dir1/a.txt", 10)
+        self.write("dir1/b.txt", 10)
+        self.tracker._slice_files = 4
+        self.tracker._non_overlapping = True
+        self.tracker._depth = 0
+
+        sources = list(self.tracker.populate_source(self.src))
+        rows = [(path, source["max_depth"], source["files"], source.get("slice"))
+                for path, source in zip(self.relative(sources), sources)]
+        # dir2 has no subdirectories, so its files are split three ways; dir1's two files aren't.
+        self.assertEqual(rows, [
+            ("src/dir1", None, 2, None),
+            ("src/dir2", 1, 3, "0/3"),
+            ("src/dir2", 1, 3, "1/3"),
+            ("src/dir2", 1, 3, "2/3"),
+            ("src", 1, 0, None),
+        ])
+        names = [f"file{i}.txt" for i in range(10)]
+        selected = [[name for name in names if BackupTracker._slice_selector(f"{index}/3")(name)] for index in range(3)]
+        self.assertEqual(sorted(sum(selected, [])), names)
+
+    def test_copy_slice(self):
+        for i in range(10):
+            self.write(f"dir2/file{i}.txt", 10)
+        self.write("dir2/sub/deeper.txt", 10)
+        listed = []
+
+        def copy(source, destination, options):
+            with open(options["files-from-raw"], "rb") as f:
+                listed.extend(f.read().decode().splitlines())
+            return subprocess.CompletedProcess([], 0, stdout=b"", stderr=b"")
+
+        self.tracker._executor.copy = MagicMock(side_effect=copy)
+        directory = os.path.join(self.src, "dir2")
+        for index in range(3):
+            self.tracker._copy(directory, {"max-depth": 1}, [("", 1, f"{index}/3")])
+        self.assertEqual(sorted(listed), [f"file{i}.txt" for i in range(10)])
+
+    def signatures(self):
+        sources = list(self.tracker.populate_source(self.src))
+        return dict(zip(self.relative(sources), (source["signature"] for source in sources)))
+
+    def test_populate_source_signatures(self):
+        self.tracker._non_overlapping = True
+        self.write("dir1/a.txt", 10)
+        self.write("dir1/sub1/deeper/c.txt", 1000)
+        before = self.signatures()
+        self.assertTrue(all(before.values()))
+        self.assertEqual(self.signatures(), before)
+
+        # Changing a file deep inside sub1 changes the recursive row, but not the flat rows above it
+        self.write("dir1/sub1/deeper/c.txt", 1001)
+        after = self.signatures()
+        self.assertNotEqual(after["src/dir1/sub1"], before["src/dir1/sub1"])
+        self.assertEqual(after["src/dir1"], before["src/dir1"])
+        self.assertEqual(after["src"], before["src"])
+
+        # Adding a file changes the directory it's in
+        self.write("dir2/new.txt", 1)
+        self.assertNotEqual(self.signatures()["src/dir2"], after["src/dir2"])
+
+    def test_populate_source_signatures_symlink(self):
+        os.symlink(os.path.join(self.src, "dir1"), os.path.join(self.src, "link"))
+        before = self.signatures()
+        # What's behind the link isn't walked, so it's always copied
+        self.assertIsNone(before["src/link"])
+        self.write("dir1/sub1/deeper/c.txt", 1000)
+        self.assertEqual(self.signatures()["src/dir2"], before["src/dir2"])
+
+    def test_populate_source_signatures_overlapping(self):
+        self.tracker._change_index = MagicMock()
+        before = self.signatures()
+        self.write("dir1/sub1/deeper/c.txt", 1000)
+        after = self.signatures()
+        # Overlapping rows cover everything below them
+        self.assertNotEqual(after["src"], before["src"])
+        self.assertNotEqual(after["src/dir1"], before["src/dir1"])
+        self.assertEqual(after["src/dir2"], before["src/dir2"])
+
+    def test_populate_source_parallel(self):
+        for i in range(20):
+            self.write(f"dir2/wide{i}/sub/file.txt", i)
+        self.tracker._non_overlapping = True
+        self.tracker._depth = None
+        parallel = list(self.tracker.populate_source(self.src))
+
+        # Listing one directory at a time gives the same rows, in the same order
+        with patch('base_tracker.BaseTracker._init_tracker'):
+            serial_tracker = BackupTracker(filename="test.db", sources=[self.src], remote_name="remote",
+                                           destination="dest/", logdir="logs", non_overlapping=True,
+                                           crawl_workers=1)
+        with patch('backup_tracker.Prefetcher.prefetch'):
+            serial = list(serial_tracker.populate_source(self.src))
+        self.assertEqual(parallel, serial)
+        self.assertEqual(len(parallel), 45)
+
+    def test_copy_changed_files(self):
+        self.write("top.txt", 1)
+        self.write("dir1/one.txt", 2)
+        with patch('base_tracker.BaseTracker._init_tracker'):
+            tracker = BackupTracker(filename="test.db", sources=[self.src], remote_name="remote", destination="dest/",
+                                    logdir="logs", checksum_cache=os.path.join(self.tmpdir.name, "checksums.db"))
+        listed = []
+
+        def copy(source, destination, options):
+            with open(options["files-from-raw"], "rb") as f:
+                listed.append(sorted(f.read().splitlines()))
+            self.assertTrue(options["no-traverse"])
+            return subprocess.CompletedProcess([], 0, stdout=b"", stderr=b"")
+
+        tracker._executor.copy = MagicMock(side_effect=copy)
+        tracker._copy(self.src, {})
+        self.assertEqual(listed, [[b"dir1/one.txt", b"top.txt"]])
+        # Nothing changed, so rclone isn't started
+        tracker._copy(self.src, {})
+        self.assertEqual(tracker._executor.copy.call_count, 1)
+        # A touched file isn't copied again, a changed one is, and only direct files for --max-depth 1.
+        os.utime(os.path.join(self.src, "top.txt"), (0, 0))
+        self.write("dir1/one.txt", 3)
+        self.write("two.txt", 1)
+        tracker._copy(self.src, {"max-depth": 1})
+        self.assertEqual(listed[-1], [b"two.txt"])
+        tracker._copy(self.src, {})
+        self.assertEqual(listed[-1], [b"dir1/one.txt"])
+
+        # A failed copy records nothing
+        tracker._executor.copy.side_effect = subprocess.CalledProcessError(5, [])
+        self.write("three.txt", 1)
+        with self.assertRaises(subprocess.CalledProcessError):
+            tracker._copy(self.src, {})
+        tracker._executor.copy.side_effect = copy
+        tracker._copy(self.src, {})
+        self.assertEqual(listed[-1], [b"three.txt"])
+
+        # --full copies everything
+        tracker._full = True
+        tracker._executor.copy.side_effect = None
+        tracker._copy(self.src, {})
+        self.assertEqual(tracker._executor.copy.call_args[0][2], {})
+
+    def test_copy_async_changed_files(self):
+        self.write("top.txt", 1)
+        with patch('base_tracker.BaseTracker._init_tracker'):
+            tracker = BackupTracker(filename="test.db", sources=[self.src], remote_name="remote", destination="dest/",
+                                    logdir="logs", checksum_cache=os.path.join(self.tmpdir.name, "checksums.db"))
+        listed = []
+
+        async def copy_async(source, destination, options):
+            with open(options["files-from-raw"], "rb") as f:
+                listed.append(sorted(f.read().splitlines()))
+            if len(listed) == 1:
+                raise subprocess.CalledProcessError(5, [])
+            return subprocess.CompletedProcess([], 0, stdout=b"", stderr=b"")
+
+        tracker._executor.copy_async = MagicMock(side_effect=copy_async)
+        # A failed copy records nothing, so the file is listed again
+        with self.assertRaises(subprocess.CalledProcessError):
+            asyncio.run(tracker._copy_async(self.src, {}))
+        asyncio.run(tracker._copy_async(self.src, {}))
+        self.assertEqual(listed, [[b"top.txt"], [b"top.txt"]])
+        asyncio.run(tracker._copy_async(self.src, {}))
+        self.assertEqual(tracker._executor.copy_async.call_count, 2)
 
 if __name__ == '__main__':
     unittest.main()
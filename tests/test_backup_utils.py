@@ -1,5 +1,6 @@
+import argparse
 import unittest
-from backup import verbosity_to_log_level
+from backup import verbosity_to_log_level, workers_count
 import logging
 
 class TestBackupUtils(unittest.TestCase):
@@ -12,5 +13,13 @@ class TestBackupUtils(unittest.TestCase):
         self.assertEqual(verbosity_to_log_level(5), logging.DEBUG)
         self.assertEqual(verbosity_to_log_level(-1), logging.CRITICAL)
 
+    def test_workers_count(self):
+        self.assertEqual(workers_count("4"), 4)
+        self.assertEqual(workers_count("auto"), "auto")
+        with self.assertRaises(argparse.ArgumentTypeError):
+            workers_count("lots")
+        with self.assertRaises(argparse.ArgumentTypeError):
+            workers_count("0")
+
 if __name__ == '__main__':
     unittest.main()
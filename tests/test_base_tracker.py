@@ -1,8 +1,16 @@
 import unittest
+import asyncio
+import json
 from unittest.mock import patch, MagicMock
 import sqlite3
+import subprocess
 import os
+import signal
+import tempfile
+import time
+from contextlib import closing
 from base_tracker import BaseTracker
+from report import find_trackers, load_sources
 
 class MockTracker(BaseTracker):
     @property
@@ -14,7 +22,19 @@ class MockTracker(BaseTracker):
         return "source_prefix"
     
     def populate_source(self, source):
-        return [source]
+        return [self._make_row(source)]
+
+class SlicedTracker(MockTracker):
+    def populate_source(self, source):
+        for index in range(2):
+            yield {**self._make_row(source), "signature": "same", "slice": f"{index}/2"}
+
+def result(source_id, done=None, failure=None, **columns):
+    """The values update_source() takes, for a source that's done or failed."""
+    return {"id": source_id, "done": done, "args": None, "command_line": None, "returncode": None,
+            "stdout": None, "stderr": None, "failure": failure, "bytes_transferred": None,
+            "files_transferred": None, "checks": None, "elapsed": None, "retries": None, "owner": None,
+            **columns}
 
 class TestBaseTracker(unittest.TestCase):
     def setUp(self):
@@ -59,5 +79,633 @@ class TestBaseTracker(unittest.TestCase):
             fourth_sleep = tracker.sleep_on_cap_exceeded
             self.assertEqual(fourth_sleep, 3600)
 
+    @patch('signal.signal')
+    def test_upgrade_old_tracker(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "old.db")
+            old = sqlite3.connect(filename)
+            with old:
+                old.execute("CREATE TABLE tracker ( key text NOT NULL PRIMARY KEY, value bigint );")
+                old.execute("CREATE TABLE sources ( id bigint NOT NULL PRIMARY KEY, path text NOT NULL, done timestamp, "
+                            "args text, command_line text, returncode integer, stdout text, stderr text, failure text );")
+                old.execute("INSERT INTO tracker (key, value) VALUES ('next', 0);")
+                old.execute("INSERT INTO sources (id, path) VALUES (0, ?);", (b"/src1",))
+                old.execute("CREATE INDEX sources_pending ON sources ( id ) WHERE done IS NULL;")
+            old.close()
+
+            tracker = MockTracker(filename, self.sources, self.remote_name, self.destination, self.logdir)
+            self.assertEqual(tracker.get_source_path(0), (b"/src1", None))
+            indexes = {row[0] for row in tracker._tracker.execute("SELECT name FROM sqlite_master WHERE type = 'index';")}
+            self.assertTrue({"sources_pending_priority", "sources_claimed", "sources_failure"} <= indexes)
+            self.assertNotIn("sources_pending", indexes)
+            self.assertIn("sources_path_slice", indexes)
+            self.assertEqual([row[0] for row in tracker.claim_sources(5)], [0])
+            # Counted once, when it's upgraded
+            self.assertEqual(tracker.get_summary(), (0, 1, 0))
+            tracker._tracker.close()
+
+    @patch('subprocess.run')
+    @patch('base_tracker.BaseTracker.update_source')
+    def test_process_source_max_depth(self, mock_update, mock_run):
+        with patch('base_tracker.BaseTracker._init_tracker'):
+            tracker = MockTracker(self.filename, self.sources, self.remote_name, self.destination, self.logdir)
+        mock_run.return_value = MagicMock(stdout=b"", stderr=b"", returncode=0)
+
+        tracker._process_source(0, (b"/src1", 1, 100))
+        command = mock_run.call_args[0][0]
+        self.assertEqual(command[command.index("--max-depth"):][:2], ["--max-depth", "1"])
+
+        tracker._process_source(1, (b"/src2", None, None))
+        self.assertNotIn("--max-depth", mock_run.call_args[0][0])
+        self.assertIsNotNone(mock_update.call_args[0][0]["done"])
+
+    @patch('subprocess.run')
+    @patch('base_tracker.BaseTracker.update_source')
+    def test_process_source_stats(self, mock_update, mock_run):
+        with patch('base_tracker.BaseTracker._init_tracker'):
+            tracker = MockTracker(self.filename, self.sources, self.remote_name, self.destination, self.logdir)
+        mock_run.return_value = MagicMock(stdout=b"", returncode=0, stderr=(
+            b'{"level":"notice","msg":"done","stats":{"bytes":10,"checks":2,"elapsedTime":0.5,"transfers":1}}\n'))
+
+        tracker._process_source(0, (b"/src1", None, 10))
+        values = mock_update.call_args[0][0]
+        self.assertEqual((values["bytes_transferred"], values["files_transferred"], values["checks"],
+                          values["elapsed"], values["retries"]), (10, 1, 2, 0.5, 0))
+
+        # Without stats, the time it took is still recorded
+        mock_run.return_value = MagicMock(stdout=b"", stderr=b"", returncode=0)
+        tracker._process_source(1, (b"/src2", None, 10))
+        values = mock_update.call_args[0][0]
+        self.assertIsNone(values["bytes_transferred"])
+        self.assertIsNotNone(values["elapsed"])
+
+    @patch('signal.signal')
+    def test_claim_sources(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sources = [f"/src{i}" for i in range(5)]
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), sources, self.remote_name, self.destination, self.logdir)
+            tracker._crawler.join()
+            tracker.update_source(result(1, done="now"))
+
+            self.assertEqual([row[0] for row in tracker.claim_sources(3)], [0, 2, 3])
+            self.assertTrue(tracker.has_pending_sources())
+            self.assertEqual([row[0] for row in tracker.claim_sources(3)], [4])
+            self.assertEqual(tracker.claim_sources(3), [])
+            self.assertEqual(tracker.claim_sources(0), [])
+            self.assertFalse(tracker.has_pending_sources())
+
+            # Failed sources stay claimed for the rest of the run
+            tracker.update_source(result(0, failure="boom"))
+            tracker._release_claims()
+            self.assertEqual([row[0] for row in tracker.claim_sources(5)], [2, 3, 4])
+            tracker._release_claims(include_failures=True)
+            self.assertEqual([row[0] for row in tracker.claim_sources(5)], [0, 2, 3, 4])
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_summary(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "t.db")
+            tracker = MockTracker(filename, [f"/src{i}" for i in range(5)], self.remote_name, self.destination,
+                                  self.logdir)
+            tracker._crawler.join()
+            with tracker._tracker:
+                tracker._tracker.execute("UPDATE sources SET bytes = 10;")
+            self.assertEqual(tracker.get_summary(), (0, 5, 50))
+
+            tracker.update_source(result(1, done="now"))
+            tracker.update_source(result(2, failure="boom"))
+            self.assertEqual(tracker.get_summary(), (1, 4, 40))
+            # Done again, e.g. by a retry, isn't counted twice
+            tracker.update_source(result(1, done="later"))
+            self.assertEqual(tracker.get_summary(), (1, 4, 40))
+            tracker._tracker.close()
+
+            # Read from the summary when the tracker is opened again, and the same as counting
+            tracker = MockTracker(filename, self.sources, self.remote_name, self.destination, self.logdir)
+            self.assertEqual(tracker.get_summary(), tracker._tracker.execute("""
+                SELECT count(done), count(*) - count(done), sum(iif(done IS NULL, bytes, 0)) FROM sources;
+            """).fetchone())
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_wal_mode(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), self.sources, self.remote_name, self.destination,
+                                  self.logdir, synchronous="FULL")
+            tracker._crawler.join()
+            self.assertEqual(tracker._tracker.execute("PRAGMA journal_mode;").fetchone()[0], "wal")
+            self.assertEqual(tracker._tracker.execute("PRAGMA synchronous;").fetchone()[0], 2)
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_scheduling_queries_use_indexes(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), self.sources, self.remote_name, self.destination, self.logdir)
+            tracker._crawler.join()
+
+            def plan(query):
+                return " ".join(row[-1] for row in tracker._tracker.execute("EXPLAIN QUERY PLAN " + query))
+
+            self.assertIn("sources_pending_priority",
+                          plan("SELECT id FROM sources WHERE done IS NULL AND claimed IS NULL ORDER BY priority DESC, id LIMIT 5"))
+            self.assertIn("sources_failure", plan("SELECT count(id) FROM sources WHERE failure IS NOT NULL"))
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_resume_bounded(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sources = [f"/src{i}" for i in range(50)]
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), sources, self.remote_name, self.destination,
+                                  os.path.join(tmpdir, "logs"), workers=3)
+            requested = []
+            claim_sources = tracker.claim_sources
+
+            def claim(count):
+                requested.append(count)
+                return claim_sources(count)
+
+            def process(source_id, source, attempt=1, shares=None):
+                tracker.update_source(result(source_id, done="now"))
+
+            with patch.object(tracker, "claim_sources", side_effect=claim), \
+                    patch.object(tracker, "_process_source", side_effect=process):
+                tracker.resume()
+
+            self.assertTrue(all(count <= 6 for count in requested))
+            # The write-ahead log is folded back in, so the archive is a single file
+            self.assertEqual(len(os.listdir(os.path.join(tmpdir, "logs"))), 1)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, "t.db")))
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    @patch('subprocess.run')
+    def test_resume_metrics(self, mock_run, mock_signal):
+        mock_run.return_value = MagicMock(stdout=b"", stderr=b"", returncode=0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            status_file = os.path.join(tmpdir, "status.json")
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), [f"/src{i}" for i in range(5)], self.remote_name,
+                                  self.destination, os.path.join(tmpdir, "logs"), status_file=status_file)
+            tracker.resume()
+            with open(status_file) as f:
+                status = json.load(f)
+            self.assertEqual((status["done"], status["pending"], status["failed"], status["active_workers"]),
+                             (5, 0, 0, 0))
+            self.assertEqual(status["worker_limit"], 4)
+            self.assertEqual(status["eta_seconds"], 0)
+
+    @patch('signal.signal')
+    @patch('subprocess.run')
+    def test_archive_into_history(self, mock_run, mock_signal):
+        mock_run.return_value = MagicMock(stdout=b"", stderr=b"", returncode=0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logdir = os.path.join(tmpdir, "logs")
+            history = os.path.join(tmpdir, "history.sqlite3")
+            for run in range(3):
+                tracker = MockTracker(os.path.join(tmpdir, "t.db"), ["/src0", "/src1"], self.remote_name,
+                                      self.destination, logdir, history=history, keep_archives=2)
+                tracker.resume()
+            self.assertEqual(len(os.listdir(logdir)), 2)
+            with closing(sqlite3.connect(history)) as db:
+                self.assertEqual(db.execute("SELECT count(*), sum(done) FROM runs;").fetchone(), (3, 6))
+                self.assertEqual(db.execute("SELECT count(*) FROM paths;").fetchone(), (2,))
+
+    @patch('signal.signal')
+    @patch('subprocess.run')
+    def test_outputs(self, mock_run, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), ["/src0", "/src1", "/src2"], self.remote_name,
+                                  self.destination, os.path.join(tmpdir, "logs"), max_output_bytes=1000)
+            tracker._crawler.join()
+            stderr = b"x" * 5000 + b"\nERROR : src0: Failed to copy: boom\n"
+            mock_run.side_effect = subprocess.CalledProcessError(1, ["rclone"], output=b"", stderr=stderr)
+            tracker._process_source(0, (b"/src0", None, None))
+
+            # Only a summary of the failure is kept with the sources
+            failure = tracker._tracker.execute("SELECT failure FROM sources WHERE id = 0;").fetchone()[0]
+            self.assertEqual(failure, "ERROR : src0: Failed to copy: boom")
+            output = tracker.get_output(0)
+            self.assertEqual(output["returncode"], 1)
+            self.assertTrue(output["stderr"].endswith("Failed to copy: boom\n"))
+            self.assertLess(len(output["stderr"]), 1100)
+
+            # Nothing is kept for a quiet success, and a retry replaces the output of the failure
+            mock_run.side_effect = None
+            mock_run.return_value = MagicMock(args=["rclone"], stdout=b"out", stderr=b"", returncode=0)
+            tracker._process_source(0, (b"/src0", None, None))
+            self.assertIsNone(tracker.get_output(0))
+
+            tracker._verbosity = 2
+            tracker._process_source(1, (b"/src1", None, None))
+            self.assertEqual(tracker.get_output(1)["stdout"], "out")
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_crawl_restarts_when_incomplete(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "t.db")
+            sources = [f"/src{i}" for i in range(5)]
+            tracker = MockTracker(filename, sources, self.remote_name, self.destination, self.logdir)
+            tracker._crawler.join()
+            self.assertEqual(tracker.get_tracker_value("crawled"), 1)
+            # Pretend the crawl was interrupted after the first two sources
+            with tracker._tracker:
+                tracker._tracker.execute("DELETE FROM sources WHERE id > 1;")
+                tracker._tracker.execute("UPDATE tracker SET value = 0 WHERE key = 'crawled';")
+            tracker._tracker.close()
+
+            tracker = MockTracker(filename, sources, self.remote_name, self.destination, self.logdir)
+            tracker._crawler.join()
+            paths = [row[0] for row in tracker._tracker.execute("SELECT path FROM sources ORDER BY id;")]
+            self.assertEqual(paths, [source.encode() for source in sources])
+            self.assertEqual(tracker.get_tracker_value("crawled"), 1)
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_resume_crawl_error(self, mock_signal):
+        class FailingTracker(MockTracker):
+            def populate_source(self, source):
+                yield self._make_row(source)
+                raise OSError("listing failed")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = FailingTracker(os.path.join(tmpdir, "t.db"), self.sources, self.remote_name, self.destination,
+                                     os.path.join(tmpdir, "logs"))
+            with patch.object(tracker, "_process_source", return_value=None):
+                with self.assertRaises(RuntimeError):
+                    tracker.resume()
+            self.assertEqual(tracker.get_tracker_value("crawled"), 0)
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, "logs")))
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_resume_worker_error(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), ["/ok", "/bad", "/later"], self.remote_name,
+                                  self.destination, os.path.join(tmpdir, "logs"), workers=1, commit_batch=100)
+            tracker._crawler.join()
+
+            def process(source_id, source, attempt=1, shares=None):
+                if source[0] == b"/bad":
+                    raise OSError("no space left on device")
+                tracker.update_source(result(source_id, done="now"))
+
+            with patch.object(tracker, "_process_source", side_effect=process):
+                with self.assertRaises(OSError):
+                    tracker.resume()
+            # What finished is still written, and what wasn't started is handed back
+            rows = dict(tracker._tracker.execute("SELECT path, done IS NOT NULL OR claimed IS NOT NULL FROM sources;"))
+            self.assertEqual(rows, {b"/ok": 1, b"/bad": 0, b"/later": 0})
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    @patch('subprocess.run')
+    def test_resume_retries(self, mock_run, mock_signal):
+        calls = []
+
+        def run(command, **kwargs):
+            source = command[2]
+            calls.append(source)
+            if source.endswith("flaky") and calls.count(source) == 1:
+                raise subprocess.CalledProcessError(5, command, output=b"", stderr=b"ERROR : i/o timeout")
+            if source.endswith("broken"):
+                raise subprocess.CalledProcessError(1, command, output=b"", stderr=b"ERROR : connection reset")
+            if source.endswith("missing"):
+                raise subprocess.CalledProcessError(3, command, output=b"", stderr=b"ERROR : directory not found")
+            return MagicMock(args=command, stdout=b"", stderr=b"", returncode=0)
+
+        mock_run.side_effect = run
+        with tempfile.TemporaryDirectory() as tmpdir, patch.object(MockTracker, "__RETRY_SECONDS__", 0.01):
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), ["/flaky", "/broken", "/missing"], self.remote_name,
+                                  self.destination, os.path.join(tmpdir, "logs"), max_attempts=3)
+            tracker.resume()
+
+            attempts = dict(tracker._tracker.execute("SELECT path, attempts FROM sources;"))
+            # Retried in the same run until it worked, or it ran out of attempts; never if it can't work
+            self.assertEqual(attempts, {b"/flaky": 2, b"/broken": 3, b"/missing": 1})
+            self.assertEqual(calls.count("source_prefix/missing"), 1)
+            self.assertEqual([row[1] for row in tracker.get_failures()], [b"/broken", b"/missing"])
+            self.assertEqual(tracker.get_summary()[:2], (1, 2))
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    @patch('subprocess.run')
+    def test_resume_budget(self, mock_run, mock_signal):
+        mock_run.return_value = MagicMock(args=["rclone"], stdout=b"", returncode=0, stderr=(
+            b'{"level":"notice","msg":"done","stats":{"bytes":10,"checks":2,"elapsedTime":0.5,"transfers":1}}\n'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "t.db")
+            sources = [f"/src{i}" for i in range(5)]
+            tracker = MockTracker(filename, sources, self.remote_name, self.destination, os.path.join(tmpdir, "logs"),
+                                  workers=1, tps_limit=10, bw_limit=1000, daily_transactions=8)
+            tracker.resume()
+
+            # Each copy spends 4 transactions, so it stops after two of them
+            self.assertEqual(mock_run.call_count, 2)
+            command = mock_run.call_args[0][0]
+            self.assertEqual(command[command.index("--tpslimit") + 1], "10.000")
+            self.assertEqual(command[command.index("--bwlimit") + 1], "1000B")
+            self.assertEqual(tracker.get_tracker_value("budget_transactions"), 8)
+            self.assertEqual(tracker.get_tracker_value("budget_bytes"), 20)
+            self.assertTrue(tracker.has_pending_sources())
+            tracker._tracker.close()
+
+            # A resumed run respects what's left of today's budget
+            tracker = MockTracker(filename, sources, self.remote_name, self.destination, os.path.join(tmpdir, "logs"),
+                                  workers=1, daily_transactions=12)
+            tracker.resume()
+            self.assertEqual(mock_run.call_count, 3)
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    @patch('subprocess.run')
+    def test_resume_rate_shares_auto(self, mock_run, mock_signal):
+        mock_run.return_value = MagicMock(args=["rclone"], stdout=b"", stderr=b"", returncode=0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), ["/src1"], self.remote_name, self.destination,
+                                  os.path.join(tmpdir, "logs"), workers="auto", min_workers=1, max_workers=4,
+                                  tps_limit=8)
+            tracker.resume()
+        # Starting with one worker, the copy still leaves room for the three more there can be
+        command = mock_run.call_args[0][0]
+        self.assertEqual(command[command.index("--tpslimit") + 1], "2.000")
+
+    @patch('signal.signal')
+    def test_resume_asyncio(self, mock_signal):
+        calls = []
+
+        async def copy_async(source, destination, options):
+            calls.append(source)
+            await asyncio.sleep(0.01)
+            if source.endswith("flaky") and calls.count(source) == 1:
+                raise subprocess.CalledProcessError(5, ["rclone"], output=b"", stderr=b"ERROR : i/o timeout")
+            completed = subprocess.CompletedProcess(["rclone"], 0, stdout=b"", stderr=b"")
+            completed.columns = {"bytes_transferred": 10, "files_transferred": 1, "checks": 0, "elapsed": 0.01,
+                                 "retries": 0}
+            return completed
+
+        with tempfile.TemporaryDirectory() as tmpdir, patch.object(MockTracker, "__RETRY_SECONDS__", 0.01):
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), ["/flaky", "/src1", "/src2"], self.remote_name,
+                                  self.destination, os.path.join(tmpdir, "logs"), engine="asyncio")
+            with patch.object(tracker._executor, "copy_async", side_effect=copy_async):
+                tracker.resume()
+
+            self.assertEqual(sorted(calls), ["source_prefix/flaky"] * 2 + ["source_prefix/src1", "source_prefix/src2"])
+            # Everything was done, so the tracker was archived
+            archives = find_trackers(os.path.join(tmpdir, "logs"))
+            self.assertEqual(len(archives), 1)
+            self.assertEqual(sum(source["bytes_transferred"] for source in load_sources(archives[0])), 30)
+
+    @patch('signal.signal')
+    def test_resume_asyncio_interrupted(self, mock_signal):
+        stopped = []
+
+        async def copy_async(source, destination, options):
+            BaseTracker._sigint_handler(signal.SIGINT, None)
+            try:
+                await asyncio.sleep(60)
+            finally:
+                stopped.append(source)
+
+        with tempfile.TemporaryDirectory() as tmpdir, patch.object(BaseTracker, "_interrupt_requested", False):
+            tracker = MockTracker(os.path.join(tmpdir, "t.db"), ["/src1", "/src2"], self.remote_name,
+                                  self.destination, os.path.join(tmpdir, "logs"), engine="asyncio")
+            started = time.monotonic()
+            with patch.object(tracker._executor, "copy_async", side_effect=copy_async):
+                tracker.resume()
+
+            # The copies running were stopped rather than waited for, and left pending
+            self.assertLess(time.monotonic() - started, 30)
+            self.assertTrue(stopped)
+            self.assertEqual(tracker.get_failure_count(), 0)
+            self.assertEqual(tracker._tracker.execute("SELECT count(id) FROM sources WHERE claimed IS NULL;")
+                             .fetchone()[0], 2)
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_shared_tracker(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "t.db")
+            sources = [f"/src{i}" for i in range(6)]
+            first = MockTracker(filename, sources, self.remote_name, self.destination, self.logdir, lease_seconds=0)
+            first._crawler.join()
+            # Another process, as far as the tracker can tell
+            second = MockTracker(filename, sources, self.remote_name, self.destination, self.logdir)
+
+            self.assertEqual([row[0] for row in first.claim_sources(2)], [0, 1])
+            self.assertEqual([row[0] for row in second.claim_sources(2)], [2, 3])
+            self.assertEqual([row[0] for row in second.claim_sources(1)], [4])
+
+            # The first one's leases have expired, so they're taken over, and its results dropped
+            second._reclaim_expired()
+            self.assertEqual([row[0] for row in second.claim_sources(5)], [0, 1, 5])
+            first.update_source(result(0, done="first", owner=first._owner))
+            second.update_source(result(1, done="second", owner=second._owner))
+            done = dict(second._tracker.execute("SELECT id, done FROM sources WHERE id < 2;"))
+            self.assertEqual(done, {0: None, 1: "second"})
+
+            # Sources another process is working on aren't finished, and aren't released by a new one
+            self.assertTrue(first.has_leased_sources())
+            self.assertFalse(second.has_leased_sources())
+            third = MockTracker(filename, sources, self.remote_name, self.destination, self.logdir)
+            self.assertEqual(third.claim_sources(5), [])
+            second._release_claims()
+            self.assertEqual([row[0] for row in third.claim_sources(5)], [0, 2, 3, 4, 5])
+            for tracker in (first, second, third):
+                tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_shared_budget(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "t.db")
+            first = MockTracker(filename, ["/src"], self.remote_name, self.destination, self.logdir,
+                                daily_transactions=10)
+            first._crawler.join()
+            second = MockTracker(filename, ["/src"], self.remote_name, self.destination, self.logdir,
+                                 daily_transactions=10)
+            first._load_budget()
+            second._load_budget()
+            first._budget.spend(4, 0)
+            second._budget.spend(4, 0)
+            first._save_budget()
+            second._save_budget()
+            # Neither overwrote the other's spending, and both see all of it
+            self.assertEqual(first.get_tracker_value("budget_transactions"), 8)
+            self.assertEqual(second._budget.state()[1], 8)
+            first._budget.spend(2, 0)
+            first._save_budget()
+            second._save_budget()
+            self.assertTrue(second._budget.exhausted())
+            for tracker in (first, second):
+                tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_claim_largest_first(self, mock_signal):
+        class SizedTracker(MockTracker):
+            def populate_source(self, source):
+                yield self._make_row(source, own_files_only=True, own_size=(1, int(source[4:])))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = SizedTracker(os.path.join(tmpdir, "t.db"), ["/src10", "/src30", "/src20"], self.remote_name,
+                                   self.destination, self.logdir, non_overlapping=True)
+            tracker._crawler.join()
+            self.assertEqual([row[1] for row in tracker.claim_sources(2)], [b"/src30", b"/src20"])
+            self.assertEqual([row[1] for row in tracker.claim_sources(2)], [b"/src10"])
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_batches(self, mock_signal):
+        class TreeTracker(MockTracker):
+            def populate_source(self, source):
+                for name, size in (("a", 10), ("b", 10), ("big", 10_000), ("c", 10), ("d", 10), ("", 10)):
+                    path = f"{source}/{name}" if name else source
+                    yield self._make_row(path, own_files_only=True, own_size=(1, size))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = TreeTracker(os.path.join(tmpdir, "t.db"), ["/p"], self.remote_name, self.destination,
+                                  self.logdir, non_overlapping=True, batch_files=3, batch_bytes=1000)
+            tracker._crawler.join()
+            batches = dict(tracker._tracker.execute("SELECT path, batch FROM sources;"))
+            self.assertEqual(batches, {b"/p/a": b"/p/a", b"/p/b": b"/p/a", b"/p/big": None,
+                                       b"/p/c": b"/p/c", b"/p/d": b"/p/c", b"/p": b"/p/c"})
+
+            self.assertEqual(tracker.claim_sources(1), [(2, b"/p/big", 1, 10_000)])
+            # Claiming one row of a batch claims all of it
+            [job] = tracker.claim_sources(1)
+            self.assertEqual(job, (0, b"/p", None, 20, ((0, "a", 1, None), (1, "b", 1, None))))
+            [job] = tracker.claim_sources(5)
+            self.assertEqual(job, (3, b"/p", None, 30, ((3, "c", 1, None), (4, "d", 1, None), (5, "", 1, None))))
+
+            filters = []
+
+            def copy(source, destination, options):
+                with open(options["filter-from"]) as f:
+                    filters.append(f.read())
+                return subprocess.CompletedProcess([], 0, stdout=b"", stderr=b"")
+
+            tracker._executor.copy = MagicMock(side_effect=copy)
+            tracker._process_source(job[0], job[1:])
+            self.assertEqual(tracker._executor.copy.call_args[0][:2], ("source_prefix/p", "dest_prefix/p"))
+            self.assertEqual(filters, ["+ /c/*\n+ /d/*\n+ /*\n- **\n"])
+            done = dict(tracker._tracker.execute("SELECT id, done IS NOT NULL FROM sources;"))
+            self.assertEqual(done, {0: 0, 1: 0, 2: 0, 3: 1, 4: 1, 5: 1})
+            self.assertEqual(tracker.get_summary()[:2], (3, 3))
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    def test_slices(self, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            change_index = os.path.join(tmpdir, "changes.db")
+            tracker = SlicedTracker(os.path.join(tmpdir, "t.db"), ["/big"], self.remote_name, self.destination,
+                                    self.logdir, change_index=change_index)
+            tracker._crawler.join()
+            self.assertEqual(tracker.claim_sources(5), [(0, b"/big", None, None, ((0, "", None, "0/2"),)),
+                                                        (1, b"/big", None, None, ((1, "", None, "1/2"),))])
+            # Copying a slice needs a listing of the directory, which only backups have.
+            with self.assertRaises(ValueError):
+                tracker._copy("/big", {}, [("", None, "0/2")])
+
+            # The directory only counts as backed up once every slice of it is.
+            tracker.update_source(result(0, done="now"))
+            tracker._record_changes()
+            self.assertFalse(tracker._change_index.unchanged("/big", "same"))
+            tracker.update_source(result(1, done="now"))
+            tracker._record_changes()
+            self.assertTrue(tracker._change_index.unchanged("/big", "same"))
+            tracker._change_index.close()
+            tracker._tracker.close()
+
+    @patch('signal.signal')
+    @patch('subprocess.run')
+    def test_resume_slices(self, mock_run, mock_signal):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = SlicedTracker(os.path.join(tmpdir, "t.db"), ["/big"], self.remote_name, self.destination,
+                                    os.path.join(tmpdir, "logs"))
+            # Slices it can't copy fail on their own, without stopping the run or being tried again
+            tracker.resume()
+            mock_run.assert_not_called()
+            rows = tracker._tracker.execute("SELECT attempts, failure IS NOT NULL, lease_expiry FROM sources;").fetchall()
+            self.assertEqual(rows, [(1, 1, None), (1, 1, None)])
+            tracker._tracker.close()
+
+    def test_batch_filter(self):
+        self.assertEqual(BaseTracker._batch_filter([("a b", None, None), ("x/[1]*", 1, None)]),
+                         "+ /a b/**\n+ /x/\\[1\\]\\*/*\n- **\n")
+
+    def test_coalesce(self):
+        with patch('base_tracker.BaseTracker._init_tracker'):
+            tracker = MockTracker(self.filename, self.sources, self.remote_name, self.destination, self.logdir,
+                                  batch_files=2)
+
+        def row(path, files=1):
+            return {"path": path, "files": files, "bytes": 0}
+
+        rows = [row("/p/a/x"), row("/p/a"), row("/p/b"), row("/p/c"), row("/p/d", files=None), row("/p/e"),
+                row("/p")]
+        batches = [row.get("batch") for row in tracker._coalesce(iter(rows))]
+        # The parent closes a batch, it holds at most 2 files, and rows of unknown size stay on their own.
+        self.assertEqual(batches, ["/p/a/x", "/p/a/x", "/p/b", "/p/b", None, "/p/e", "/p/e"])
+        tracker._batch_files = None
+        self.assertEqual([row.get("batch") for row in tracker._coalesce(iter(rows))], [None] * 7)
+
+    @patch('subprocess.run')
+    @patch('base_tracker.BaseTracker.update_source')
+    def test_process_source_cap_pauses_everyone(self, mock_update, mock_run):
+        with patch('base_tracker.BaseTracker._init_tracker'):
+            tracker = MockTracker(self.filename, self.sources, self.remote_name, self.destination, self.logdir,
+                                  workers="auto", min_workers=1, max_workers=8)
+        tracker._concurrency._limit = 8
+        mock_run.side_effect = subprocess.CalledProcessError(7, ["rclone"], stderr=b"transaction_cap_exceeded")
+
+        retry_in = tracker._process_source(0, (b"/src1", None, None))
+
+        # The failing worker doesn't sleep, everybody is paused instead, and it's tried again afterwards
+        self.assertAlmostEqual(tracker._pause_remaining(), 300, delta=5)
+        self.assertEqual(retry_in, 300)
+        self.assertEqual(tracker._concurrency.limit, 4)
+        self.assertIsNotNone(mock_update.call_args[0][0]["failure"])
+
+        # Queued work waits for the pause, and gives up if interrupted
+        with patch.object(BaseTracker, "_interrupt_requested", True):
+            tracker._process_source(1, (b"/src2", None, None))
+        self.assertEqual(mock_run.call_count, 1)
+
+    @patch('signal.signal')
+    def test_change_index(self, mock_signal):
+        class SignedTracker(MockTracker):
+            signatures = {"/src1": "a", "/src2": "b"}
+
+            def populate_source(self, source):
+                yield self._make_row(source, total_signature=self.signatures[source])
+
+        def process(tracker):
+            def process_source(source_id, source, attempt=1, shares=None):
+                tracker.update_source(result(source_id, done="now"))
+            return process_source
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = os.path.join(tmpdir, "index.db")
+            logdir = os.path.join(tmpdir, "logs")
+            tracker = SignedTracker(os.path.join(tmpdir, "t.db"), self.sources, self.remote_name, self.destination,
+                                    logdir, change_index=index)
+            with patch.object(tracker, "_process_source", side_effect=process(tracker)):
+                tracker.resume()
+
+            # Only the source whose signature changed is tracked next time
+            SignedTracker.signatures = {"/src1": "a", "/src2": "c"}
+            tracker = SignedTracker(os.path.join(tmpdir, "t.db"), self.sources, self.remote_name, self.destination,
+                                    logdir, change_index=index)
+            tracker._crawler.join()
+            self.assertEqual([row[1] for row in tracker.claim_sources(5)], [b"/src2"])
+            tracker._tracker.close()
+
+            # Unless a full pass is asked for
+            os.remove(os.path.join(tmpdir, "t.db"))
+            tracker = SignedTracker(os.path.join(tmpdir, "t.db"), self.sources, self.remote_name, self.destination,
+                                    logdir, change_index=index, full=True)
+            tracker._crawler.join()
+            self.assertEqual(len(tracker.claim_sources(5)), 2)
+            tracker._tracker.close()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import patch
+import os
+import tempfile
+import benchmark
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tree = os.path.join(self.tmpdir.name, "tree")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_make_tree(self):
+        directories, files, total = benchmark.make_tree(self.tree, levels=2, fanout=2, files_per_dir=3,
+                                                        min_size=10, max_size=1000)
+        self.assertEqual(directories, 7)
+        self.assertEqual(files, 21)
+        sizes = [os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(self.tree) for name in names]
+        self.assertEqual(len(sizes), 21)
+        self.assertEqual(sum(sizes), total)
+        self.assertTrue(all(10 <= size <= 1000 for size in sizes))
+
+        # The same seed makes the same tree
+        _, _, again = benchmark.make_tree(os.path.join(self.tmpdir.name, "again"), levels=2, fanout=2,
+                                          files_per_dir=3, min_size=10, max_size=1000)
+        self.assertEqual(again, total)
+
+    @patch('signal.signal')
+    def test_run_setting(self, _):
+        benchmark.make_tree(self.tree, levels=1, fanout=2, files_per_dir=2, min_size=1, max_size=100)
+        benchmark.install_fake_rclone(os.path.join(self.tmpdir.name, "bin"))
+        options = {"latency": 0, "rclone": "fake", "non_overlapping": True, "executor": "subprocess"}
+        with patch.dict(os.environ):
+            backup = benchmark.run_setting("backup", self.tree, self.tmpdir.name, 1, 2, options)
+            restore = benchmark.run_setting("restore", self.tree, self.tmpdir.name, 1, 2, options)
+
+        for result in (backup, restore):
+            self.assertEqual(result["rows"], 3)
+            self.assertEqual(result["tasks"], 3)
+            self.assertIsNotNone(result["crawl_seconds"])
+            self.assertGreater(result["peak_rss"], 0)
+
+    @patch('signal.signal')
+    def test_startup(self, _):
+        filename = benchmark.make_large_tracker(self.tmpdir.name, 1000)
+        startup = benchmark.run_startup(filename, os.path.join(self.tmpdir.name, "logs"))
+        self.assertEqual(startup["rows"], 1001)
+        self.assertGreaterEqual(startup["startup_seconds"], startup["open_seconds"])
+
+    def test_compare(self):
+        previous = {"results": [{"mode": "backup", "depth": 1, "workers": 4,
+                                 "crawl_seconds": 2.0, "wall_seconds": 10.0, "peak_rss": 100}]}
+        current = {"results": [{"mode": "backup", "depth": 1, "workers": 4,
+                                "crawl_seconds": 1.0, "wall_seconds": 11.0, "peak_rss": 100},
+                               {"mode": "backup", "depth": 2, "workers": 4,
+                                "crawl_seconds": 1.0, "wall_seconds": 11.0, "peak_rss": 100}]}
+        self.assertEqual(benchmark.compare(previous, current),
+                         ["backup  depth=1 workers=4: crawl_seconds -50.0%, wall_seconds +10.0%, peak_rss +0.0%"])
+
+if __name__ == '__main__':
+    unittest.main()
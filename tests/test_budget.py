@@ -0,0 +1,72 @@
+import unittest
+from budget import DailyBudget, RateShares
+
+class TestRateShares(unittest.TestCase):
+    def test_unlimited(self):
+        shares = RateShares()
+        self.assertFalse(shares.limited)
+        self.assertEqual(shares.acquire(4), {})
+        self.assertEqual(RateShares.options({}), {})
+
+    def test_shares(self):
+        shares = RateShares(tps_limit=8, bw_limit=4000)
+        first = shares.acquire(4)
+        self.assertEqual(first, {"tpslimit": 2, "bwlimit": 1000})
+        self.assertEqual(RateShares.options(first), {"tpslimit": "2.000", "bwlimit": "1000B"})
+        taken = [first] + [shares.acquire(4) for _ in range(3)]
+        # Nothing's left until a copy finishes
+        self.assertIsNone(shares.acquire(4))
+        shares.release(taken.pop())
+        self.assertEqual(shares.acquire(4), {"tpslimit": 2, "bwlimit": 1000})
+
+    def test_more_slots_never_exceed_the_limit(self):
+        shares = RateShares(tps_limit=8)
+        taken = [shares.acquire(2), shares.acquire(2)]
+        # The limit went up while both are still running
+        self.assertIsNone(shares.acquire(4))
+        shares.release(taken.pop())
+        taken += [shares.acquire(4), shares.acquire(4)]
+        self.assertEqual(sum(share["tpslimit"] for share in taken), 8)
+
+class TestDailyBudget(unittest.TestCase):
+    def setUp(self):
+        self.day = 1000
+        self.budget = DailyBudget(transactions=10, size=None, today=lambda: self.day)
+
+    def test_spend(self):
+        self.assertTrue(self.budget.limited)
+        self.assertFalse(DailyBudget().limited)
+        self.budget.spend(9, 10 ** 9)
+        self.assertFalse(self.budget.exhausted())
+        self.budget.spend(1, 0)
+        self.assertTrue(self.budget.exhausted())
+        self.assertEqual(self.budget.state(), (1000, 10, 10 ** 9))
+
+        # A new day, a new budget
+        self.day += 1
+        self.assertFalse(self.budget.exhausted())
+        self.assertEqual(self.budget.state(), (1001, 0, 0))
+
+    def test_load(self):
+        self.budget.load(1000, 10, 5)
+        self.assertTrue(self.budget.exhausted())
+        # What was spent on another day doesn't count
+        budget = DailyBudget(transactions=10, today=lambda: self.day)
+        budget.load(999, 10, 5)
+        self.assertFalse(budget.exhausted())
+        budget.load(None, None, None)
+        self.assertEqual(budget.state(), (1000, 0, 0))
+
+    def test_take_unsaved(self):
+        self.budget.spend(3, 30)
+        self.assertEqual(self.budget.take_unsaved(), (1000, 3, 30))
+        self.assertEqual(self.budget.take_unsaved(), (1000, 0, 0))
+        # Another process spent 5 meanwhile, and this one spent 2 more since it saved
+        self.budget.spend(2, 0)
+        self.budget.load(1000, 8, 30)
+        self.assertEqual(self.budget.state(), (1000, 10, 30))
+        self.assertTrue(self.budget.exhausted())
+        self.assertEqual(self.budget.take_unsaved(), (1000, 2, 0))
+
+if __name__ == '__main__':
+    unittest.main()
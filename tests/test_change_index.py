@@ -0,0 +1,61 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
+from change_index import ChangeIndex
+
+class TestChangeIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.index = ChangeIndex(os.path.join(self.tmpdir.name, "index.db"), "remote:dest/host")
+
+    def tearDown(self):
+        self.index.close()
+        self.tmpdir.cleanup()
+
+    def test_unchanged(self):
+        self.assertFalse(self.index.unchanged("/src", "abc"))
+        self.index.record([(b"/src", "abc"), ("/src/dir", "def")])
+        self.assertTrue(self.index.unchanged("/src", "abc"))
+        self.assertTrue(self.index.unchanged(b"/src/dir", "def"))
+        self.assertFalse(self.index.unchanged("/src", "xyz"))
+        self.assertFalse(self.index.unchanged("/src", None))
+
+    def test_record_replaces(self):
+        self.index.record([("/src", "abc")])
+        self.index.record([("/src", "xyz")])
+        self.assertTrue(self.index.unchanged("/src", "xyz"))
+
+    def test_persists(self):
+        self.index.record([("/src", "abc")])
+        self.index.close()
+        reopened = ChangeIndex(os.path.join(self.tmpdir.name, "index.db"), "remote:dest/host")
+        self.assertTrue(reopened.unchanged("/src", "abc"))
+        reopened.close()
+
+    def test_targets(self):
+        self.index.record([("/src", "abc")])
+        other = ChangeIndex(os.path.join(self.tmpdir.name, "index.db"), "other:dest/host")
+        # Backed up somewhere else, not to this target yet
+        self.assertFalse(other.unchanged("/src", "abc"))
+        other.record([("/src", "xyz")])
+        self.assertTrue(other.unchanged("/src", "xyz"))
+        self.assertTrue(self.index.unchanged("/src", "abc"))
+        other.close()
+
+    def test_upgrade(self):
+        filename = os.path.join(self.tmpdir.name, "old.db")
+        with closing(sqlite3.connect(filename)) as old:
+            old.execute("CREATE TABLE directories ( path text NOT NULL PRIMARY KEY, signature text NOT NULL, "
+                        "updated timestamp );")
+            old.execute("INSERT INTO directories VALUES ( '/src', 'abc', NULL );")
+            old.commit()
+        index = ChangeIndex(filename, "remote:dest/host")
+        self.assertFalse(index.unchanged("/src", "abc"))
+        index.record([("/src", "abc")])
+        self.assertTrue(index.unchanged("/src", "abc"))
+        index.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from unittest.mock import patch
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
+from checksum_cache import ChecksumCache
+
+class TestChecksumCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, "src")
+        self.cache = ChecksumCache(os.path.join(self.tmpdir.name, "checksums.sqlite3"), "remote:dest/host")
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def write(self, path, contents):
+        os.makedirs(os.path.dirname(os.path.join(self.src, path)), exist_ok=True)
+        with open(os.path.join(self.src, path), "wb") as f:
+            f.write(contents)
+
+    def test_changed(self):
+        self.write("a.txt", b"a")
+        self.write("sub/b.txt", b"b")
+        os.symlink("a.txt", os.path.join(self.src, "link"))
+        names, records = self.cache.changed(self.src)
+        self.assertEqual(sorted(names), ["a.txt", "sub/b.txt"])
+        self.assertEqual(self.cache.changed(self.src, recursive=False)[0], ["a.txt"])
+        self.cache.record(records)
+        self.assertEqual(self.cache.changed(self.src), ([], []))
+
+        # Touched, so it's hashed again, but not copied
+        os.utime(os.path.join(self.src, "a.txt"), (0, 0))
+        with patch.object(ChecksumCache, "file_hash", wraps=ChecksumCache.file_hash) as file_hash:
+            names, records = self.cache.changed(self.src)
+        self.assertEqual(names, [])
+        self.assertEqual(file_hash.call_count, 1)
+        self.cache.record(records)
+        with patch.object(ChecksumCache, "file_hash") as file_hash:
+            self.assertEqual(self.cache.changed(self.src), ([], []))
+        file_hash.assert_not_called()
+
+        self.write("sub/b.txt", b"changed")
+        self.assertEqual(self.cache.changed(self.src)[0], ["sub/b.txt"])
+        self.assertEqual(self.cache.changed(os.path.join(self.src, "sub"))[0], ["b.txt"])
+
+    def test_targets(self):
+        self.write("a.txt", b"a")
+        self.cache.record(self.cache.changed(self.src)[1])
+        self.assertEqual(self.cache.changed(self.src), ([], []))
+        # Never backed up there
+        other = ChecksumCache(os.path.join(self.tmpdir.name, "checksums.sqlite3"), "other:dest/host")
+        self.assertEqual(other.changed(self.src)[0], ["a.txt"])
+        other.close()
+
+    def test_upgrade(self):
+        filename = os.path.join(self.tmpdir.name, "old.sqlite3")
+        with closing(sqlite3.connect(filename)) as old:
+            old.execute("CREATE TABLE files ( path blob NOT NULL PRIMARY KEY, inode integer, size bigint, "
+                        "mtime_ns bigint, hash text, updated timestamp );")
+            old.commit()
+        self.write("a.txt", b"a")
+        cache = ChecksumCache(filename, "remote:dest/host")
+        cache.record(cache.changed(self.src)[1])
+        self.assertEqual(cache.changed(self.src), ([], []))
+        cache.close()
+
+    def test_newline(self):
+        self.write("odd\nname", b"x")
+        self.assertIsNone(self.cache.changed(self.src))
+
+    def test_file_hash(self):
+        self.write("a.txt", b"abc")
+        self.assertEqual(ChecksumCache.file_hash(os.path.join(self.src, "a.txt")),
+                         "a9993e364706816aba3e25717850c26c9cd0d89d")
+        self.assertIsNone(ChecksumCache.file_hash(os.path.join(self.src, "missing")))
+
+if __name__ == '__main__':
+    unittest.main()
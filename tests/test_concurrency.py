@@ -0,0 +1,86 @@
+import unittest
+from concurrency import AdaptiveConcurrency
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.concurrency = AdaptiveConcurrency(1, 4, interval=10, clock=self.clock)
+
+    def window(self, size):
+        # Each worker copies for the whole interval, moving size bytes between them
+        self.concurrency.record_transfer(size / self.concurrency.limit, 10)
+        self.clock.now += 10
+        self.concurrency.update()
+        return self.concurrency.limit
+
+    def test_fixed(self):
+        concurrency = AdaptiveConcurrency(3, 3, interval=10, clock=self.clock)
+        self.assertFalse(concurrency.adaptive)
+        concurrency.record_transfer(100, 10)
+        self.clock.now += 10
+        concurrency.update()
+        concurrency.record_throttle()
+        self.assertEqual(concurrency.limit, 3)
+
+    def test_grows_while_throughput_rises(self):
+        self.assertEqual(self.concurrency.limit, 1)
+        # The first window is a baseline, and one more worker is tried
+        self.assertEqual(self.window(100), 2)
+        self.assertEqual(self.window(200), 3)
+        self.assertEqual(self.window(300), 4)
+        # Never more than the maximum
+        self.assertEqual(self.window(400), 4)
+
+    def test_holds_then_shrinks(self):
+        self.window(100)
+        self.assertEqual(self.window(200), 3)
+        # Within the tolerance: hold
+        self.assertEqual(self.window(201), 3)
+        # Dropping: shrink
+        self.assertEqual(self.window(100), 2)
+
+    def test_not_before_interval(self):
+        self.concurrency.record_transfer(100, 5)
+        self.clock.now += 5
+        self.concurrency.update()
+        self.assertEqual(self.concurrency.limit, 1)
+
+    def test_nothing_finished(self):
+        self.window(100)
+        self.assertEqual(self.window(200), 3)
+        # No copy finished in this interval, which isn't a drop
+        self.clock.now += 10
+        self.concurrency.update()
+        self.assertEqual(self.concurrency.limit, 3)
+        # A long copy finishing later is counted at the rate it ran at, over the longer interval
+        self.concurrency.record_transfer(800, 20)
+        self.clock.now += 10
+        self.concurrency.update()
+        self.assertEqual(self.concurrency.limit, 4)
+
+    def test_throttle(self):
+        self.window(100)
+        self.window(200)
+        self.window(300)
+        self.assertEqual(self.concurrency.limit, 4)
+        self.concurrency.record_throttle()
+        self.assertEqual(self.concurrency.limit, 2)
+        self.concurrency.record_throttle()
+        self.concurrency.record_throttle()
+        self.assertEqual(self.concurrency.limit, 1)
+
+    def test_invalid_bounds(self):
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrency(0, 4)
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrency(4, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from crawler import Prefetcher, merge
+
+
+class TestPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def square(self, value):
+        with self.lock:
+            self.calls.append((threading.current_thread().name, value))
+        return value * value
+
+    def test_prefetch(self):
+        prefetcher = Prefetcher(self.executor, self.square, lookahead=2)
+        prefetcher.prefetch([(1,), (2,), (3,)])
+        self.assertEqual([prefetcher.get((value,)) for value in (1, 2, 3, 4)], [1, 4, 9, 16])
+
+        # Only two were run ahead, the rest were run by get()
+        main = threading.current_thread().name
+        self.assertEqual(sorted(value for name, value in self.calls if name != main), [1, 2])
+        self.assertEqual(sorted(value for name, value in self.calls if name == main), [3, 4])
+
+    def test_cancel(self):
+        prefetcher = Prefetcher(self.executor, self.square)
+        prefetcher.prefetch([(1,), (2,)])
+        prefetcher.cancel()
+        # Cancelled or not, the result is still there when it's asked for
+        self.assertEqual(prefetcher.get((2,)), 4)
+
+
+class TestMerge(unittest.TestCase):
+    def test_merge(self):
+        items = list(merge([range(0, 100), range(100, 150), iter(())]))
+        self.assertEqual(sorted(items), list(range(150)))
+        # Each iterable keeps its order
+        self.assertEqual([item for item in items if item < 100], list(range(100)))
+
+    def test_single(self):
+        self.assertEqual(list(merge([range(3)])), [0, 1, 2])
+
+    def test_error(self):
+        def failing():
+            yield 1
+            raise OSError("unreadable")
+
+        with self.assertRaises(OSError):
+            list(merge([failing(), range(10)]))
+
+    def test_close(self):
+        closed = threading.Event()
+
+        def endless():
+            try:
+                while True:
+                    yield 1
+            finally:
+                closed.set()
+
+        rows = merge([endless(), endless()], buffer_size=10)
+        self.assertEqual(next(rows), 1)
+        rows.close()
+        self.assertTrue(closed.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, wait
+from event_loop import EventLoopExecutor
+
+class TestEventLoopExecutor(unittest.TestCase):
+    def test_submit(self):
+        async def double(value, delay=0):
+            await asyncio.sleep(delay)
+            return value * 2
+
+        with EventLoopExecutor() as executor:
+            slow = executor.submit(double, 1, delay=10)
+            quick = executor.submit(double, 2)
+            finished, _ = wait([slow, quick], timeout=5, return_when=FIRST_COMPLETED)
+            self.assertEqual(finished, {quick})
+            self.assertEqual(quick.result(), 4)
+        # Still running when the block was left
+        self.assertTrue(slow.cancelled())
+
+    def test_cancel_cleans_up(self):
+        cleaned_up = []
+
+        async def copy():
+            try:
+                await asyncio.sleep(10)
+            finally:
+                cleaned_up.append(True)
+
+        with EventLoopExecutor() as executor:
+            future = executor.submit(copy)
+            executor.submit(asyncio.sleep, 0).result(timeout=5)
+            future.cancel()
+        self.assertEqual(cleaned_up, [True])
+
+    def test_exception(self):
+        async def fail():
+            raise ValueError("failed")
+
+        with EventLoopExecutor() as executor:
+            with self.assertRaises(ValueError):
+                executor.submit(fail).result(timeout=5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+import unittest
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from executors import RcdExecutor, SubprocessExecutor
+from failures import TRANSIENT, classify
+
+
+class FakeRcd(BaseHTTPRequestHandler):
+    """Stands in for `rclone rcd`, answering just the calls the executor makes."""
+
+    def do_POST(self):
+        params = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.calls.append((self.path, params, self.headers.get("Authorization")))
+        if self.path == "/sync/copy":
+            if params["srcFs"].endswith("missing"):
+                self._reply(500, {"error": "directory not found"})
+                return
+            job_id = len(self.server.jobs) + 1
+            self.server.jobs[job_id] = params
+            self._reply(200, {"jobid": job_id})
+        elif self.path == "/job/status":
+            job = self.server.jobs[params["jobid"]]
+            if job["srcFs"].endswith("stalled"):
+                time.sleep(1)
+            # Report the job as running the first time it's polled.
+            job["polled"] = job.get("polled", 0) + 1
+            if job["polled"] < 2 or job["srcFs"].endswith("slow"):
+                self._reply(200, {"finished": False, "success": False, "error": ""})
+            elif job["srcFs"].endswith("capped"):
+                self._reply(200, {"finished": True, "success": False, "error": "transaction_cap_exceeded"})
+            else:
+                self._reply(200, {"finished": True, "success": True, "error": ""})
+        elif self.path == "/core/stats":
+            self._reply(200, {"bytes": 2048, "transfers": 2, "checks": 3, "elapsedTime": 1.5,
+                              "group": params["group"]})
+        else:
+            self._reply(200, {})
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestRcdExecutor(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeRcd)
+        self.server.calls = []
+        self.server.jobs = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.executor = RcdExecutor(url=url, user="user", password="secret")
+        self.executor.__POLL_SECONDS__ = 0.01
+        self.executor.start()
+
+    def tearDown(self):
+        self.executor.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_copy(self):
+        result = self.executor.copy("/src/dir", "remote:bucket/src/dir", {"max-depth": 1})
+        self.assertEqual(result.returncode, 0)
+        self.assertTrue(json.loads(result.stdout)["status"]["success"])
+        self.assertEqual(RcdExecutor.stats(result), {"bytes_transferred": 2048, "files_transferred": 2, "checks": 3,
+                                                     "elapsed": 1.5, "retries": 0})
+
+        methods = [call[0] for call in self.server.calls]
+        self.assertEqual(methods, ["/sync/copy", "/job/status", "/job/status", "/core/stats"])
+        self.assertEqual(self.server.calls[-1][1], {"group": "job/1"})
+        params = self.server.calls[0][1]
+        self.assertEqual(params["srcFs"], "/src/dir")
+        self.assertEqual(params["dstFs"], "remote:bucket/src/dir")
+        self.assertTrue(params["_async"])
+        self.assertEqual(params["_config"], {"MaxDepth": 1})
+        self.assertTrue(all(call[2].startswith("Basic ") for call in self.server.calls))
+
+    def test_files_from(self):
+        self.executor.copy("/src/dir", "remote:bucket/src/dir", {"files-from-raw": "/tmp/files", "no-traverse": True})
+        params = self.server.calls[0][1]
+        self.assertEqual(params["_filter"], {"FilesFromRaw": ["/tmp/files"]})
+        self.assertEqual(params["_config"], {"NoTraverse": True})
+
+    def test_copy_async(self):
+        result = asyncio.run(self.executor.copy_async("/src/dir", "remote:bucket/src/dir", {"max-depth": 1}))
+        self.assertEqual(RcdExecutor.stats(result)["bytes_transferred"], 2048)
+        self.assertEqual([call[0] for call in self.server.calls],
+                         ["/sync/copy", "/job/status", "/job/status", "/core/stats"])
+        with self.assertRaises(subprocess.CalledProcessError):
+            asyncio.run(self.executor.copy_async("/src/capped", "remote:bucket/src/capped", {}))
+
+    def test_copy_async_cancelled(self):
+        async def cancel():
+            task = asyncio.create_task(self.executor.copy_async("/src/slow", "remote:bucket/src/slow", {}))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return task
+
+        self.assertTrue(asyncio.run(cancel()).cancelled())
+        self.assertEqual(self.server.calls[-1][:2], ("/job/stop", {"jobid": 1}))
+
+    def test_copy_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            self.executor.copy("/src/capped", "remote:bucket/src/capped", {})
+        self.assertIn(b"transaction_cap_exceeded", context.exception.stderr)
+        self.assertEqual(context.exception.cmd[:2], ["rc", "sync/copy"])
+        # What was transferred before it failed is still counted
+        self.assertEqual(RcdExecutor.stats(context.exception)["bytes_transferred"], 2048)
+
+    def test_copy_stalled(self):
+        self.executor.__CALL_SECONDS__ = 0.1
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            self.executor.copy("/src/stalled", "remote:bucket/src/stalled", {})
+        # Tried again, like any other trouble reaching the rcd
+        self.assertEqual(classify(context.exception.returncode, context.exception.stderr), TRANSIENT)
+
+    def test_copy_rejected(self):
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            self.executor.copy("/src/missing", "remote:bucket/src/missing", {})
+        self.assertIn(b"directory not found", context.exception.stderr)
+
+    def test_unsupported_option(self):
+        with self.assertRaises(ValueError):
+            self.executor.copy("/src/dir", "remote:bucket/src/dir", {"fast-list": True})
+        self.assertEqual(self.server.calls, [])
+
+    def test_stop_without_daemon(self):
+        # Nothing was launched, so there's nothing to quit.
+        self.executor.stop()
+        self.assertNotIn("/core/quit", [call[0] for call in self.server.calls])
+
+
+class TestSubprocessExecutor(unittest.TestCase):
+    @patch('subprocess.run')
+    def test_copy(self, mock_run):
+        SubprocessExecutor(verbosity=2).copy("/src/dir", "remote:bucket/src/dir", {"max-depth": 1})
+        mock_run.assert_called_once_with(
+            ["rclone", "copy", "/src/dir", "remote:bucket/src/dir", "--max-depth", "1",
+             "--use-json-log", "--stats-log-level", "NOTICE", "--stats-one-line", "-vv"],
+            capture_output=True, check=True)
+
+    @patch('subprocess.run')
+    def test_flags_without_values(self, mock_run):
+        SubprocessExecutor().copy("/src/dir", "remote:bucket/src/dir", {"files-from-raw": "/tmp/files",
+                                                                      "no-traverse": True})
+        self.assertEqual(mock_run.call_args[0][0][4:8], ["--files-from-raw", "/tmp/files", "--no-traverse",
+                                                         "--use-json-log"])
+
+    def test_stats(self):
+        stderr = b"\n".join([
+            b'{"level":"error","msg":"Attempt 1/3 failed with 1 errors and: timeout","source":"fs/log.go"}',
+            b'{"level":"notice","msg":"1 KiB / 1 KiB, 100%","stats":{"bytes":1024,"checks":1,"elapsedTime":0.5,'
+            b'"transfers":1}}',
+            b'{"level":"notice","msg":"2 KiB / 2 KiB, 100%","stats":{"bytes":2048,"checks":4,"elapsedTime":1.25,'
+            b'"transfers":2}}',
+            b'not json',
+        ])
+        completed = subprocess.CompletedProcess([], 0, stdout=b"", stderr=stderr)
+        self.assertEqual(SubprocessExecutor.stats(completed), {"bytes_transferred": 2048, "files_transferred": 2,
+                                                               "checks": 4, "elapsed": 1.25, "retries": 1})
+        self.assertEqual(SubprocessExecutor.stats(subprocess.CompletedProcess([], 0, stderr=b"")), {})
+
+    def run_script(self, script, max_output_bytes=64 * 1024):
+        """Runs copy_async() with a python script standing in for rclone."""
+        executor = SubprocessExecutor(max_output_bytes=max_output_bytes)
+        with patch.object(executor, "_command", return_value=[sys.executable, "-c", script]):
+            return asyncio.run(executor.copy_async("/src/dir", "remote:bucket/src/dir", {}))
+
+    def test_copy_async(self):
+        # Far more log than is kept, with the stats at the start
+        result = self.run_script(
+            "import json, sys\n"
+            "sys.stderr.write(json.dumps({'msg': '', 'stats': {'bytes': 2048, 'transfers': 2}}) + '\\n')\n"
+            "sys.stderr.write(json.dumps({'msg': 'Attempt 1/3 failed'}) + '\\n')\n"
+            "for i in range(10000): sys.stderr.write('x' * 100 + '\\n')\n"
+            "print('done')\n", max_output_bytes=1000)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, b"done\n")
+        self.assertEqual(len(result.stderr), 1000)
+        self.assertEqual(SubprocessExecutor.stats(result)["bytes_transferred"], 2048)
+        self.assertEqual(SubprocessExecutor.stats(result)["retries"], 1)
+
+    def test_copy_async_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            self.run_script("import sys\nsys.stderr.write('transaction_cap_exceeded')\nsys.exit(7)\n")
+        self.assertEqual(context.exception.returncode, 7)
+        self.assertEqual(context.exception.stderr, b"transaction_cap_exceeded")
+        self.assertEqual(SubprocessExecutor.stats(context.exception), {})
+
+    def test_copy_async_cancelled(self):
+        executor = SubprocessExecutor()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pid_file = os.path.join(tmpdir, "pid")
+            script = f"import os, time\nopen({pid_file!r}, 'w').write(str(os.getpid()))\ntime.sleep(60)\n"
+
+            async def cancel():
+                task = asyncio.create_task(executor.copy_async("/src/dir", "remote:bucket/src/dir", {}))
+                while not os.path.exists(pid_file) or not open(pid_file).read():
+                    await asyncio.sleep(0.05)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                return task
+
+            with patch.object(executor, "_command", return_value=[sys.executable, "-c", script]):
+                self.assertTrue(asyncio.run(asyncio.wait_for(cancel(), 10)).cancelled())
+            # Terminated and reaped
+            with self.assertRaises(ProcessLookupError):
+                os.kill(int(open(pid_file).read()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
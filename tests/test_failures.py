@@ -0,0 +1,36 @@
+import unittest
+import random
+from failures import CAP, PERMANENT, TRANSIENT, backoff, classify, is_throttled
+
+class TestFailures(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual(classify(7, b"ERROR : dir: Failed to copy: transaction_cap_exceeded"), CAP)
+        self.assertEqual(classify(2, b"storage_cap_exceeded (403)"), CAP)
+        # --max-transfer was reached, which waiting won't change
+        self.assertEqual(classify(8, b"max transfer limit reached"), PERMANENT)
+        self.assertEqual(classify(8, b"transaction_cap_exceeded"), CAP)
+        self.assertEqual(classify(5, b"i/o timeout"), TRANSIENT)
+        self.assertEqual(classify(3, b"directory not found"), PERMANENT)
+        self.assertEqual(classify(2, b"unknown flag: --bogus"), PERMANENT)
+        # The generic exit code goes by what rclone printed, and anything unknown gets retried
+        self.assertEqual(classify(1, b"open /src/file: permission denied"), PERMANENT)
+        self.assertEqual(classify(1, b"Too Many Requests (429)"), TRANSIENT)
+        self.assertEqual(classify(1, b"unauthorized: too_many_requests"), TRANSIENT)
+        self.assertEqual(classify(1, b"read tcp: i/o timeout"), TRANSIENT)
+        self.assertEqual(classify(1, b"something new"), TRANSIENT)
+        self.assertEqual(classify(1, None), TRANSIENT)
+
+    def test_is_throttled(self):
+        self.assertTrue(is_throttled(b"too many requests (429)"))
+        self.assertFalse(is_throttled(b"i/o timeout"))
+
+    def test_backoff(self):
+        generator = random.Random(0)
+        for attempt, ceiling in ((1, 5), (2, 10), (3, 20), (10, 300)):
+            delays = [backoff(attempt, base=5, maximum=300, generator=generator) for _ in range(100)]
+            self.assertTrue(all(0 <= delay <= ceiling for delay in delays))
+            # Jittered, so they don't all come back at once
+            self.assertGreater(len(set(delays)), 50)
+
+if __name__ == '__main__':
+    unittest.main()
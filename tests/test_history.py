@@ -0,0 +1,106 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from history import History, history_report
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.logdir = self.tmpdir.name
+        self.history = History(os.path.join(self.logdir, "history.sqlite3"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def tracker(self, name, rows):
+        """rows are (path, max_depth, claimed, done, failure, bytes_transferred)"""
+        with closing(sqlite3.connect(os.path.join(self.logdir, name))) as tracker:
+            with tracker:
+                tracker.execute("CREATE TABLE sources ( path text, max_depth integer, claimed timestamp, "
+                                "done timestamp, failure text, bytes_transferred bigint );")
+                tracker.executemany("INSERT INTO sources VALUES ( ?, ?, ?, ?, ?, ? );", rows)
+
+    def test_merge(self):
+        self.tracker("2024-01-01-tracker.sqlite3", [
+            (b"/volume1/", 1, "2024-01-01T00:00:00+00:00", "2024-01-01T00:00:05+00:00", None, 100),
+            (b"/volume1/x/", None, "2024-01-01T00:00:00+00:00", "2024-01-01T00:01:00+00:00", None, 900),
+            (b"/volume1/y/", None, "2024-01-01T00:00:00+00:00", None, "timeout", None),
+        ])
+        self.assertTrue(self.history.merge(os.path.join(self.logdir, "2024-01-01-tracker.sqlite3")))
+        # Merging it again changes nothing
+        self.assertFalse(self.history.merge(os.path.join(self.logdir, "2024-01-01-tracker.sqlite3")))
+
+        [run] = self.history.runs()
+        self.assertEqual(run["archive"], "2024-01-01-tracker.sqlite3")
+        self.assertEqual(run["duration"], 60)
+        self.assertEqual((run["rows"], run["done"], run["failures"], run["bytes"]), (3, 2, 1, 1000))
+
+        self.assertEqual(self.history.last_success("/volume1/x"), ("2024-01-01T00:01:00+00:00", "/volume1/x/"))
+        # Covered by the recursive copy of its parent
+        self.assertEqual(self.history.last_success("/volume1/x/deeper/still"),
+                         ("2024-01-01T00:01:00+00:00", "/volume1/x/"))
+        # /volume1/ only copied its own files, and /volume1/y failed
+        self.assertIsNone(self.history.last_success("/volume1/y"))
+        self.assertIsNone(self.history.last_success("/volume1/z"))
+        self.assertEqual(self.history.last_success("/volume1"), ("2024-01-01T00:00:05+00:00", "/volume1/"))
+
+    def test_slices(self):
+        # Two slices of /volume1/big, one of which failed
+        self.tracker("2024-01-01-tracker.sqlite3", [
+            (b"/volume1/big/", 1, None, "2024-01-01T00:00:00+00:00", None, 1),
+            (b"/volume1/big/", 1, None, None, "timeout", None),
+            (b"/volume1/small/", 1, None, "2024-01-01T00:00:00+00:00", None, 1),
+        ])
+        self.history.merge_all(self.logdir)
+        self.assertIsNone(self.history.last_success("/volume1/big"))
+        self.assertIsNotNone(self.history.last_success("/volume1/small"))
+
+    def test_later_runs_win(self):
+        self.tracker("2024-01-02-tracker.sqlite3", [(b"/volume1/x/", None, None, "2024-01-02T00:00:00+00:00", None, 1)])
+        self.tracker("2024-01-01-tracker.sqlite3", [(b"/volume1/x/", None, None, "2024-01-01T00:00:00+00:00", None, 1)])
+        self.assertEqual(self.history.merge_all(self.logdir), 2)
+        self.assertEqual(self.history.last_success("/volume1/x/")[0], "2024-01-02T00:00:00+00:00")
+        self.assertEqual([run["archive"] for run in self.history.runs()],
+                         ["2024-01-02-tracker.sqlite3", "2024-01-01-tracker.sqlite3"])
+
+    def test_newer_ancestor(self):
+        self.tracker("2024-01-01-tracker.sqlite3", [(b"/volume1/x/", None, None, "2024-01-01T00:00:00+00:00", None, 1)])
+        # A later recursive copy of an ancestor covers x as well
+        self.tracker("2024-01-02-tracker.sqlite3", [(b"/volume1/", None, None, "2024-01-02T00:00:00+00:00", None, 1)])
+        # An even later copy of just the files of another ancestor doesn't
+        self.tracker("2024-01-03-tracker.sqlite3", [(b"/", 1, None, "2024-01-03T00:00:00+00:00", None, 1)])
+        self.history.merge_all(self.logdir)
+        self.assertEqual(self.history.last_success("/volume1/x"), ("2024-01-02T00:00:00+00:00", "/volume1/"))
+
+    def test_retention(self):
+        now = datetime.now(timezone.utc)
+        for days in (30, 2, 1):
+            done = (now - timedelta(days=days)).isoformat()
+            self.tracker(f"{done}-tracker.sqlite3", [(f"/volume1/{days}/".encode(), None, None, done, None, 1)])
+        self.history.merge_all(self.logdir)
+        unmerged = (now - timedelta(days=40)).isoformat()
+        self.tracker(f"{unmerged}-tracker.sqlite3", [(b"/volume1/40/", None, None, unmerged, None, 1)])
+
+        self.history.apply_retention(self.logdir, keep_archives=1, keep_days=7)
+        remaining = sorted(name for name in os.listdir(self.logdir) if name.endswith("-tracker.sqlite3"))
+        # Archives that aren't in the history yet are never deleted
+        self.assertEqual(remaining, [f"{unmerged}-tracker.sqlite3", f"{(now - timedelta(days=1)).isoformat()}-tracker.sqlite3"])
+        self.assertEqual(len(self.history.runs()), 2)
+        # When a directory was last copied outlives the summary of its run
+        self.assertIsNotNone(self.history.last_success("/volume1/30"))
+
+    def test_history_report(self):
+        self.tracker("2024-01-01-tracker.sqlite3", [(b"/volume1/x/", None, None, "2024-01-01T00:00:00+00:00", None, 1)])
+        self.assertEqual(history_report(self.history, self.logdir, ["/volume1/x/a", "/volume2"]), [
+            "/volume1/x/a: 2024-01-01T00:00:00+00:00 (with /volume1/x/)",
+            "/volume2: never copied successfully",
+        ])
+        lines = history_report(self.history, self.logdir, [])
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith("2024-01-01-tracker.sqlite3"))
+
+if __name__ == '__main__':
+    unittest.main()
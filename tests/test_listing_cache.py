@@ -0,0 +1,37 @@
+import unittest
+import os
+import tempfile
+from unittest.mock import patch
+from listing_cache import ListingCache
+
+class TestListingCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ListingCache(os.path.join(self.tmpdir.name, "listings.db"), ttl=60)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get(self):
+        self.assertIsNone(self.cache.get("remote", "src/", 1))
+        self.cache.put("remote", "src/", 1, {"": [True, [1, 2], [3, 4]]})
+        self.assertEqual(self.cache.get("remote", "src/", 1), {"": [True, [1, 2], [3, 4]]})
+        self.assertIsNone(self.cache.get("remote", "src/", 2))
+        self.assertIsNone(self.cache.get("remote", "src/", None))
+        self.assertIsNone(self.cache.get("other", "src/", 1))
+
+    def test_unlimited_depth(self):
+        self.cache.put("remote", "src/", None, {"a": 1})
+        self.cache.put("remote", "src/", None, {"b": 2})
+        self.assertEqual(self.cache.get("remote", "src/", None), {"b": 2})
+
+    def test_expired(self):
+        with patch('listing_cache.time', return_value=1000):
+            self.cache.put("remote", "src/", 1, {})
+        with patch('listing_cache.time', return_value=1060):
+            self.assertEqual(self.cache.get("remote", "src/", 1), {})
+        with patch('listing_cache.time', return_value=1061):
+            self.assertIsNone(self.cache.get("remote", "src/", 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import json
+import os
+import tempfile
+import urllib.request
+from metrics import MetricsServer, ProgressMetrics
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestProgressMetrics(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = ProgressMetrics(clock=self.clock)
+        self.metrics.reset(done=10, pending=4, pending_bytes=400)
+
+    def test_snapshot(self):
+        self.metrics.add_pending(1, 100)
+        self.metrics.started()
+        self.metrics.started()
+        self.assertEqual(self.metrics.snapshot()["active_workers"], 2)
+        self.assertIsNone(self.metrics.snapshot()["eta_seconds"])
+
+        self.clock.now = 10
+        self.metrics.finished(100, transferred=50)
+        self.metrics.finished(100, failed=True)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual((snapshot["done"], snapshot["pending"], snapshot["failed"], snapshot["active_workers"]),
+                         (11, 3, 1, 0))
+        self.assertEqual(snapshot["bytes"], 150)
+        self.assertEqual(snapshot["bytes_per_second"], 15)
+        # 300 bytes to go at 15 bytes/sec
+        self.assertEqual(snapshot["eta_seconds"], 20)
+
+    def test_eta_by_sources(self):
+        self.metrics.reset(done=0, pending=3, pending_bytes=0)
+        self.metrics.started()
+        self.clock.now = 5
+        self.metrics.finished(None, transferred=0)
+        self.assertEqual(self.metrics.snapshot()["eta_seconds"], 10)
+
+    def test_prometheus(self):
+        self.metrics.set_scheduling(worker_limit=4, paused_seconds=0, backoff_seconds=300)
+        text = self.metrics.prometheus()
+        self.assertIn('rclone_backups_sources{state="pending"} 4\n', text)
+        self.assertIn("rclone_backups_worker_limit 4.0\n", text)
+        self.assertIn("rclone_backups_backoff_seconds 300.0\n", text)
+        self.assertIn("rclone_backups_eta_seconds NaN\n", text)
+        self.assertIn("# TYPE rclone_backups_bytes counter\n", text)
+
+    def test_write_status(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "status.json")
+            self.metrics.write_status(filename)
+            with open(filename) as f:
+                self.assertEqual(json.load(f)["pending"], 4)
+            self.assertEqual(os.listdir(tmpdir), ["status.json"])
+
+    def test_server(self):
+        server = MetricsServer(self.metrics, 0)
+        server.start()
+        try:
+            url = f"http://127.0.0.1:{server.port}"
+            with urllib.request.urlopen(f"{url}/metrics") as response:
+                self.assertIn(b'rclone_backups_sources{state="done"} 10', response.read())
+            with urllib.request.urlopen(f"{url}/status") as response:
+                self.assertEqual(json.load(response)["done"], 10)
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"{url}/other")
+        finally:
+            server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from outputs import pack, summarize_failure, unpack
+
+class TestOutputs(unittest.TestCase):
+    def test_pack(self):
+        text = "Transferred: 1 / 1, 100%\n" * 100
+        blob = pack(text)
+        self.assertLess(len(blob), len(text))
+        self.assertEqual(unpack(blob), text)
+        self.assertIsNone(pack(None))
+        self.assertIsNone(unpack(None))
+
+    def test_truncate(self):
+        text = "start" + "x" * 1000 + "end"
+        unpacked = unpack(pack(text, limit=100))
+        self.assertTrue(unpacked.startswith("start"))
+        self.assertTrue(unpacked.endswith("end"))
+        self.assertIn("[... 908 bytes truncated ...]", unpacked)
+        self.assertEqual(unpack(pack(text, limit=None)), text)
+
+    def test_summarize_failure(self):
+        stderr = "\n".join([
+            '{"level":"notice","msg":"starting"}',
+            '{"level":"error","msg":"dir/file: Failed to copy: transaction_cap_exceeded"}',
+            '{"level":"notice","msg":"0 B / 0 B","stats":{"bytes":0}}',
+        ])
+        self.assertEqual(summarize_failure(stderr), "dir/file: Failed to copy: transaction_cap_exceeded")
+        self.assertEqual(summarize_failure("2024/01/01 ERROR : dir: failed\nsome notice\n"),
+                         "2024/01/01 ERROR : dir: failed")
+        self.assertEqual(summarize_failure("just this\n"), "just this")
+        self.assertEqual(summarize_failure(""), "rclone failed without any output")
+        self.assertEqual(len(summarize_failure("ERROR " + "x" * 500, limit=50)), 50)
+
+if __name__ == '__main__':
+    unittest.main()
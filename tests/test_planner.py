@@ -0,0 +1,96 @@
+import unittest
+import os
+import tempfile
+from backup_tracker import BackupTracker
+from planner import (DEFAULT_MODEL, Model, Row, crawl, estimate_seconds, fit_model, format_plan, makespan, plan,
+                     rows_for_depth, suggest, summarize_directories)
+
+class TestPlanner(unittest.TestCase):
+    def setUp(self):
+        # /src         1 file,  10 bytes
+        # ├── a        2 files, 20 bytes
+        # │   └── b    3 files, 300 bytes
+        # └── c        4 files, 40 bytes
+        self.sizes = [
+            ("/src/a/b/", 1, 3, 300),
+            ("/src/a/", 1, 2, 20),
+            ("/src/c/", 1, 4, 40),
+            ("/src/", 1, 1, 10),
+        ]
+        self.directories = summarize_directories(self.sizes)
+
+    def test_summarize_directories(self):
+        self.assertEqual({path: directory["depth"] for path, directory in self.directories.items()},
+                         {"/src/a/b": 2, "/src/a": 1, "/src/c": 1, "/src": 0})
+        self.assertEqual(self.directories["/src"]["total_files"], 10)
+        self.assertEqual(self.directories["/src"]["total_bytes"], 370)
+        self.assertEqual(self.directories["/src"]["total_dirs"], 4)
+        self.assertEqual(self.directories["/src/a"]["total_bytes"], 320)
+
+    def test_rows_for_depth(self):
+        self.assertEqual(rows_for_depth(self.directories, -1), [Row(10, 0, 370, 4)])
+        self.assertEqual(sorted(rows_for_depth(self.directories, 0, non_overlapping=True)),
+                         [Row(1, 0, 10, 1), Row(4, 0, 40, 1), Row(5, 0, 320, 2)])
+        # Overlapping rows list their whole subtree and check what the deeper rows copied.
+        self.assertEqual(sorted(rows_for_depth(self.directories, 0)),
+                         [Row(1, 9, 10, 4), Row(4, 0, 40, 1), Row(5, 0, 320, 2)])
+        self.assertEqual(len(rows_for_depth(self.directories, 1)), 4)
+
+    def test_makespan(self):
+        self.assertEqual(makespan([5, 4, 3, 3, 3], 1), 18)
+        # Longest first: 5+3 and 4+3+3
+        self.assertEqual(makespan([3, 5, 3, 4, 3], 2), 10)
+        self.assertEqual(makespan([3, 5], 8), 5)
+        self.assertEqual(makespan([], 4), 0)
+        self.assertEqual(makespan([1], 4, total_bytes=100, bandwidth=10), 10)
+
+    def test_fit_model(self):
+        model = Model(overhead=1.5, seconds_per_file=0.1, bytes_per_second=1e6, samples=0)
+        samples = [(estimate_seconds(Row(files, 0, size, 1), model), files, size)
+                   for files in range(0, 50, 7) for size in range(0, 10**8, 3 * 10**7)]
+        fitted = fit_model(samples)
+        self.assertAlmostEqual(fitted.overhead, 1.5)
+        self.assertAlmostEqual(fitted.seconds_per_file, 0.1)
+        self.assertAlmostEqual(fitted.bytes_per_second, 1e6)
+        self.assertEqual(fitted.samples, len(samples))
+        self.assertEqual(fit_model(samples[:3]), DEFAULT_MODEL)
+        # Nothing varies, so nothing can be measured
+        self.assertEqual(fit_model([(1.0, 0, 0)] * 30), DEFAULT_MODEL._replace(samples=30))
+
+    def test_plan_and_suggest(self):
+        model = Model(overhead=1.0, seconds_per_file=0.0, bytes_per_second=100, samples=0)
+        estimates = plan(self.directories, model, [1, 2, 4])
+        self.assertEqual([estimate["depth"] for estimate in estimates], [-1, 0, 1])
+        whole, top, every = estimates
+        self.assertEqual(whole["rows"], 1)
+        self.assertAlmostEqual(whole["wall_seconds"][4], 4.7)
+        self.assertEqual(whole["transactions"], 14)
+        self.assertEqual(top["rows"], 3)
+        self.assertAlmostEqual(top["wall_seconds"][4], 4.2)
+        self.assertEqual(top["largest_row_bytes"], 320)
+        # /src/a/b is the longest row either way, so two workers are as quick as four.
+        self.assertEqual(suggest(estimates), (0, 2, estimates[1]["wall_seconds"][2]))
+        lines = format_plan(estimates, model, suggest(estimates))
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[-1].startswith("Suggested: --depth 0 --workers 2"))
+
+    def test_crawl(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, "src")
+            os.makedirs(os.path.join(source, "a", "b"))
+            for path, size in (("top", 10), ("a/one", 20), ("a/b/two", 300)):
+                with open(os.path.join(source, path), "wb") as f:
+                    f.write(b"x" * size)
+            plandir = os.path.join(tmpdir, "plans")
+            sizes = crawl(BackupTracker, [source], plandir, remote_name="remote", destination="dest/")
+            self.assertEqual(sorted((os.path.relpath(path, tmpdir), files, size) for path, _, files, size in sizes),
+                             [("src", 1, 10), ("src/a", 1, 20), ("src/a/b", 1, 300)])
+            # Used again while it's fresh
+            os.remove(os.path.join(source, "top"))
+            self.assertEqual(crawl(BackupTracker, [source], plandir, remote_name="remote", destination="dest/"),
+                             sizes)
+            sizes = crawl(BackupTracker, [source], plandir, ttl=-1, remote_name="remote", destination="dest/")
+            self.assertIn(0, [files for _, _, files, _ in sizes])
+
+if __name__ == '__main__':
+    unittest.main()
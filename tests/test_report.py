@@ -0,0 +1,50 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
+from report import find_trackers, report
+
+class TestReport(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.logdir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def tracker(self, name, rows, stats=True):
+        columns = "path text, claimed timestamp, done timestamp"
+        if stats:
+            columns += ", elapsed real, bytes_transferred bigint, files_transferred bigint, checks bigint, retries integer"
+        with closing(sqlite3.connect(os.path.join(self.logdir, name))) as tracker:
+            with tracker:
+                tracker.execute(f"CREATE TABLE sources ( {columns} );")
+                tracker.executemany(f"INSERT INTO sources VALUES ( {', '.join('?' * len(rows[0]))} );", rows)
+
+    def test_find_trackers(self):
+        self.tracker("2024-01-01-tracker.sqlite3", [(b"/src", None, "2024-01-01T00:00:00", 1, 1, 1, 0, 0)])
+        self.tracker("2023-01-01-tracker.sqlite3", [(b"/src", None, "2023-01-01T00:00:00")], stats=False)
+        with open(os.path.join(self.logdir, "run.log"), "w") as f:
+            f.write("not a database")
+        self.assertEqual([os.path.basename(path) for path in find_trackers(self.logdir)],
+                         ["2024-01-01-tracker.sqlite3"])
+
+    def test_report(self):
+        self.tracker("2024-01-01-tracker.sqlite3", [
+            (b"/src/fast", "2024-01-01T00:00:00+00:00", "2024-01-01T00:00:02+00:00", 2.0, 2000, 2, 1, 0),
+            (b"/src/slow", "2024-01-01T00:00:00+00:00", "2024-01-01T00:00:10+00:00", 10.0, 1000, 1, 0, 2),
+            (b"/src/pending", None, None, None, None, None, None, None),
+        ])
+        lines = report(self.logdir, limit=1)
+        self.assertEqual(lines[0], "2024-01-01-tracker.sqlite3: 2 sources, 3,000 bytes in 3 files, 300 bytes/sec overall")
+        self.assertEqual(lines[1], "All: 2 sources, 3,000 bytes, 250 bytes/sec per source on average")
+        self.assertEqual(lines[3], "Slowest 1 sources:")
+        self.assertTrue(lines[5].endswith("/src/slow"))
+        self.assertEqual(lines[5].split()[:6], ["10.0", "100", "1,000", "1", "0", "2"])
+
+    def test_empty(self):
+        self.assertEqual(report(self.logdir), [f"No archived trackers with transfer stats in {self.logdir}"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,18 @@
 import unittest
 from unittest.mock import patch, MagicMock
+import io
+import os
 import subprocess
 import json
-from restore_tracker import RestoreTracker
+import tempfile
+from restore_tracker import RestoreTracker, iter_json_array
+
+
+def lsjson(mock_popen, entries, returncode=0):
+    """Makes the mocked rclone lsjson print entries."""
+    rclone_proc = MagicMock(stdout=io.StringIO(json.dumps(entries, indent=1)), returncode=returncode)
+    mock_popen.return_value.__enter__.return_value = rclone_proc
+    return rclone_proc
 
 class TestRestoreTracker(unittest.TestCase):
     def setUp(self):
@@ -22,7 +32,7 @@ class TestRestoreTracker(unittest.TestCase):
     def test_source_prefix(self):
         self.assertEqual(self.tracker.source_prefix, "remote:")
 
-    @patch('subprocess.run')
+    @patch('subprocess.Popen')
     def test_populate_source_recursive(self, mock_run):
         # Mock rclone lsjson output
         mock_output = [
@@ -30,9 +40,9 @@ class TestRestoreTracker(unittest.TestCase):
             {"Path": "dir1/sub1", "IsDir": True},
             {"Path": "file1.txt", "IsDir": False}
         ]
-        mock_run.return_value = MagicMock(stdout=json.dumps(mock_output), returncode=0)
+        lsjson(mock_run, mock_output)
         
-        sources = self.tracker.populate_source("src/")
+        sources = list(self.tracker.populate_source("src/"))
         
         # depth=1
         # dir1: depth=0 (<1) -> OK
@@ -40,32 +50,157 @@ class TestRestoreTracker(unittest.TestCase):
         # Final append: src/
         
         expected = ["src/dir1", "src/"]
-        self.assertEqual(sorted(sources), sorted(expected))
+        self.assertEqual(sorted(source["path"] for source in sources), sorted(expected))
 
-    @patch('subprocess.run')
+    @patch('subprocess.Popen')
     def test_populate_source_no_depth(self, mock_run):
         self.tracker._depth = None
         mock_output = [
             {"Path": "dir1", "IsDir": True},
             {"Path": "dir1/sub1", "IsDir": True}
         ]
-        mock_run.return_value = MagicMock(stdout=json.dumps(mock_output), returncode=0)
+        lsjson(mock_run, mock_output)
         
-        sources = self.tracker.populate_source("src/")
+        sources = list(self.tracker.populate_source("src/"))
         
         expected = ["src/dir1", "src/dir1/sub1", "src/"]
-        self.assertEqual(sorted(sources), sorted(expected))
+        self.assertEqual(sorted(source["path"] for source in sources), sorted(expected))
+
+    @patch('subprocess.Popen')
+    def test_populate_source_non_overlapping(self, mock_run):
+        self.tracker._depth = 2
+        self.tracker._non_overlapping = True
+        mock_output = [
+            {"Path": "dir1", "IsDir": True},
+            {"Path": "dir1/sub1", "IsDir": True},
+            {"Path": "dir1/sub1/deeper", "IsDir": True},
+        ]
+        lsjson(mock_run, mock_output)
+
+        sources = list(self.tracker.populate_source("src/"))
+
+        max_depths = {source["path"]: source["max_depth"] for source in sources}
+        self.assertEqual(max_depths, {"src/": 1, "src/dir1": 1, "src/dir1/sub1": None})
+
+    @patch('subprocess.Popen')
+    def test_populate_source_non_overlapping_depth_0(self, mock_run):
+        self.tracker._depth = 0
+        self.tracker._non_overlapping = True
+        lsjson(mock_run, [{"Path": "dir1", "IsDir": True}])
+
+        sources = list(self.tracker.populate_source("src/"))
+
+        self.assertEqual([(source["path"], source["max_depth"]) for source in sources], [("src/", None)])
 
     def test_populate_source_negative_depth(self):
         self.tracker._depth = -1
-        sources = self.tracker.populate_source("src/")
-        self.assertEqual(sources, ["src/"])
+        sources = list(self.tracker.populate_source("src/"))
+        self.assertEqual([(source["path"], source["max_depth"]) for source in sources], [("src/", None)])
+
+    @patch('subprocess.Popen')
+    def test_populate_source_sizes(self, mock_run):
+        self.tracker._non_overlapping = True
+        # What `lsjson --max-depth 2` prints at depth 1: dir1/sub1/b.txt is too deep to be listed.
+        mock_output = [
+            {"Path": "dir1", "IsDir": True, "Size": -1},
+            {"Path": "dir2", "IsDir": True, "Size": -1},
+            {"Path": "dir1/sub1", "IsDir": True, "Size": -1},
+            {"Path": "top.txt", "IsDir": False, "Size": 1},
+            {"Path": "dir1/a.txt", "IsDir": False, "Size": 10},
+            {"Path": "dir2/b.txt", "IsDir": False, "Size": 100},
+        ]
+        lsjson(mock_run, mock_output)
+
+        sources = list(self.tracker.populate_source("src/"))
+
+        # The deepest rows count the files directly in them, and so are claimed largest first.
+        sizes = {source["path"]: (source["max_depth"], source["files"], source["bytes"], source["priority"])
+                 for source in sources}
+        self.assertEqual(sizes, {
+            "src/": (1, 1, 1, 1),
+            "src/dir1": (None, 1, 10, 10),
+            "src/dir2": (None, 1, 100, 100),
+        })
 
-    @patch('subprocess.run')
+    @patch('subprocess.Popen')
     def test_populate_source_error(self, mock_run):
-        mock_run.side_effect = subprocess.CalledProcessError(1, "rclone", stderr="error")
+        lsjson(mock_run, [], returncode=1)
         with self.assertRaises(subprocess.CalledProcessError):
-            self.tracker.populate_source("src/")
+            list(self.tracker.populate_source("src/"))
+
+    @patch('subprocess.Popen')
+    def test_populate_source_max_depth(self, mock_run):
+        self.tracker._depth = 2
+        lsjson(mock_run, [])
+        list(self.tracker.populate_source("src/"))
+        # Without sizes to count, only the directories with rows are listed
+        self.assertEqual(mock_run.call_args[0][0],
+                         ["rclone", "lsjson", "remote:src/", "--recursive", "--max-depth", "2", "--dirs-only"])
+
+        self.tracker._depth = 0
+        lsjson(mock_run, [])
+        list(self.tracker.populate_source("src/"))
+        self.assertEqual(mock_run.call_args[0][0], ["rclone", "lsjson", "remote:src/", "--dirs-only"])
+
+        self.tracker._non_overlapping = True
+        self.tracker._depth = 2
+        lsjson(mock_run, [])
+        list(self.tracker.populate_source("src/"))
+        self.assertEqual(mock_run.call_args[0][0],
+                         ["rclone", "lsjson", "remote:src/", "--recursive", "--max-depth", "3"])
+
+    @patch('subprocess.Popen')
+    def test_populate_source_files_first(self, mock_run):
+        self.tracker._depth = None
+        self.tracker._non_overlapping = True
+        # Files can be listed before the directories they're in
+        lsjson(mock_run, [
+            {"Path": "dir1/sub1/b.txt", "IsDir": False, "Size": 100},
+            {"Path": "dir1/sub1", "IsDir": True, "Size": -1},
+            {"Path": "dir1", "IsDir": True, "Size": -1},
+        ])
+        sources = list(self.tracker.populate_source("src/"))
+        sizes = {source["path"]: (source["max_depth"], source["files"], source["bytes"]) for source in sources}
+        self.assertEqual(sizes, {
+            "src/": (1, 0, 0),
+            "src/dir1": (1, 0, 0),
+            "src/dir1/sub1": (1, 1, 100),
+        })
+
+    @patch('subprocess.Popen')
+    def test_populate_source_listing_cache(self, mock_run):
+        with tempfile.TemporaryDirectory() as tmpdir, patch('base_tracker.BaseTracker._init_tracker'):
+            tracker = RestoreTracker(filename="test.db", sources=["src/"], remote_name="remote",
+                                     destination="/dest", logdir="logs", depth=1,
+                                     listing_cache=os.path.join(tmpdir, "listings.db"))
+            lsjson(mock_run, [{"Path": "dir1", "IsDir": True}, {"Path": "dir1/a.txt", "IsDir": False, "Size": 10}])
+            listed = list(tracker.populate_source("src/"))
+            # The second time, the remote isn't listed again
+            cached = list(tracker.populate_source("src/"))
+            self.assertEqual(mock_run.call_count, 1)
+            self.assertEqual(cached, listed)
+            self.assertIsNone(listed[0]["files"])
+
+            # A listing without sizes doesn't do for rows that need them
+            tracker._non_overlapping = True
+            lsjson(mock_run, [{"Path": "dir1", "IsDir": True}, {"Path": "dir1/a.txt", "IsDir": False, "Size": 10}])
+            self.assertEqual([source["bytes"] for source in tracker.populate_source("src/")], [10, 0])
+            self.assertEqual(mock_run.call_count, 2)
+            tracker._non_overlapping = False
+
+            # Listings are kept per depth
+            tracker._depth = None
+            lsjson(mock_run, [])
+            self.assertEqual([source["path"] for source in tracker.populate_source("src/")], ["src/"])
+            self.assertEqual(mock_run.call_count, 3)
+
+    def test_iter_json_array(self):
+        entries = [{"Path": f"dir{i}/\u00e9t\u00e9 [1], {{x}}", "IsDir": i % 2 == 0} for i in range(50)]
+        for text in (json.dumps(entries), json.dumps(entries, indent=1)):
+            self.assertEqual(list(iter_json_array(io.StringIO(text), chunk_size=7)), entries)
+        self.assertEqual(list(iter_json_array(io.StringIO("[]\n"))), [])
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json_array(io.StringIO('[{"Path": "dir1"')))
 
 if __name__ == '__main__':
     unittest.main()
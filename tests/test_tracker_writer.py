@@ -0,0 +1,79 @@
+import unittest
+import sqlite3
+import threading
+from tracker_writer import TrackerWriter
+
+class TestTrackerWriter(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self.connection.execute("CREATE TABLE sources ( id integer PRIMARY KEY, done text );")
+        self.connection.executemany("INSERT INTO sources (id) VALUES (?);", [(i,) for i in range(10)])
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.connection.close()
+
+    def done_count(self):
+        with self.lock:
+            return self.connection.execute("SELECT count(id) FROM sources WHERE done IS NOT NULL;").fetchone()[0]
+
+    def test_flush(self):
+        writer = TrackerWriter(self.connection, self.lock, "UPDATE sources SET done = :done WHERE id = :id;",
+                               batch_size=100, interval=60)
+        for i in range(5):
+            writer.put({"id": i, "done": "now"})
+        writer.flush()
+        self.assertEqual(self.done_count(), 5)
+        self.assertEqual(writer.written, 5)
+        writer.close()
+
+    def test_batch_size(self):
+        commits = []
+        writer = TrackerWriter(self.connection, self.lock, "UPDATE sources SET done = :done WHERE id = :id;",
+                               batch_size=3, interval=60)
+        original = writer._commit
+        writer._commit = lambda batch, waiting: (commits.append(len(batch)), original(batch, waiting))
+        for i in range(7):
+            writer.put({"id": i, "done": "now"})
+        writer.close()
+        self.assertEqual(self.done_count(), 7)
+        self.assertEqual(commits[:2], [3, 3])
+        self.assertEqual(sum(commits), 7)
+
+    def test_put_list(self):
+        commits = []
+        writer = TrackerWriter(self.connection, self.lock, "UPDATE sources SET done = :done WHERE id = :id;",
+                               batch_size=3, interval=60)
+        original = writer._commit
+        writer._commit = lambda batch, waiting: (commits.append(len(batch)), original(batch, waiting))
+        writer.put({"id": 0, "done": "now"})
+        # A list is never split between commits
+        writer.put([{"id": i, "done": "now"} for i in range(1, 6)])
+        writer.close()
+        self.assertEqual(self.done_count(), 6)
+        self.assertEqual(commits[0], 6)
+
+    def test_error(self):
+        writer = TrackerWriter(self.connection, self.lock, "UPDATE missing SET done = :done WHERE id = :id;")
+        writer.put({"id": 0, "done": "now"})
+        with self.assertRaises(RuntimeError):
+            writer.flush()
+        with self.assertRaises(RuntimeError):
+            writer.put({"id": 1, "done": "now"})
+
+    def test_repeated_key(self):
+        self.connection.execute("CREATE TABLE outputs ( id integer PRIMARY KEY, text text );")
+        statements = ["DELETE FROM outputs WHERE id = :id;",
+                      "INSERT INTO outputs (id, text) SELECT :id, :text WHERE :text IS NOT NULL;"]
+        writer = TrackerWriter(self.connection, self.lock, statements, batch_size=100, interval=60, key="id")
+        # A failure and then its retry, committed together
+        writer.put({"id": 0, "text": "failed"})
+        writer.put({"id": 1, "text": "other"})
+        writer.put({"id": 0, "text": None})
+        writer.close()
+        self.assertEqual(self.connection.execute("SELECT id, text FROM outputs;").fetchall(), [(1, "other")])
+        self.assertEqual(writer.written, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import logging
+import queue
+import sqlite3
+import threading
+from time import monotonic
+
+
+class TrackerWriter:
+    """
+    Applies updates to the tracker database from a single thread, committing them in groups of up to
+    batch_size updates or every interval seconds, whichever comes first.  This turns one commit (and
+    fsync) per finished source into one per group.
+    """
+
+    def __init__(self, connection, lock, statements, batch_size=100, interval=0.5, key=None) -> None:
+        self._connection = connection
+        self._lock = lock
+        # Every statement is run for every update, in order, in the same transaction.
+        self._statements = [statements] if isinstance(statements, str) else list(statements)
+        # Updates with the same key must be applied one after the other, rather than statement by statement.
+        self._key = key
+        self._batch_size = batch_size
+        self._interval = interval
+        self._queue = queue.Queue()
+        self._error = None
+        self._written = 0
+        self._thread = threading.Thread(target=self._run, name="tracker-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def written(self):
+        """The number of updates committed so far."""
+        return self._written
+
+    def put(self, values):
+        """Queues an update, or a list of updates to commit in the same transaction."""
+        if self._error is not None:
+            raise RuntimeError("Tracker writer has failed") from self._error
+        self._queue.put(values)
+
+    def flush(self):
+        """Blocks until everything put() so far has been committed."""
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        flushed.wait()
+        if self._error is not None:
+            raise RuntimeError("Tracker writer has failed") from self._error
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = []
+            waiting = []
+            item = self._queue.get()
+            deadline = monotonic() + self._interval
+            while True:
+                if item is None:
+                    self._commit(batch, waiting)
+                    return
+                if isinstance(item, threading.Event):
+                    # Commit right away, somebody's waiting on it.
+                    waiting.append(item)
+                    break
+                if isinstance(item, list):
+                    batch.extend(item)
+                else:
+                    batch.append(item)
+                if len(batch) >= self._batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - monotonic()))
+                except queue.Empty:
+                    break
+            self._commit(batch, waiting)
+
+    def _groups(self, batch):
+        """Splits the batch wherever an update repeats the key of an earlier one in the same group."""
+        if self._key is None:
+            yield batch
+            return
+        group = []
+        keys = set()
+        for values in batch:
+            if values[self._key] in keys:
+                yield group
+                group = []
+                keys = set()
+            group.append(values)
+            keys.add(values[self._key])
+        yield group
+
+    def _commit(self, batch, waiting):
+        try:
+            if batch and self._error is None:
+                with self._lock:
+                    with self._connection:
+                        for group in self._groups(batch):
+                            for statement in self._statements:
+                                self._connection.executemany(statement, group)
+                self._written += len(batch)
+                logging.debug("Committed %d tracker updates", len(batch))
+        except sqlite3.Error as exception:
+            logging.exception(exception)
+            self._error = exception
+        finally:
+            for flushed in waiting:
+                flushed.set()